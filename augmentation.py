@@ -0,0 +1,54 @@
+"""
+Batched on-device augmentation of (f1, f2, V) phase-plane stacks by the symmetries of
+the square grid.
+
+A change of coordinates y = R x with R a signed permutation matrix maps the system
+x' = f(x) with Lyapunov function V to y' = R f(R^-1 y) with Lyapunov function
+V(R^-1 y), so a transformed stack is again a valid (field, Lyapunov function) pair.
+On the grid (columns along x1, rows along x2, as produced by np.meshgrid):
+
+    x1 -> -x1:       flip the columns, negate f1.
+    x2 -> -x2:       flip the rows, negate f2.
+    x1 <-> x2:       transpose the grid, swap f1 and f2.
+
+Plain image flips would move the vectors without turning them, which no longer
+describes the same dynamics. Each sample of a batch gets a random element of the
+group, applied as a few masked whole-batch ops instead of per-sample transforms in
+the DataLoader workers.
+"""
+import torch
+
+# flips: the reflections of the two axes (4 elements), dihedral: flips and the
+# transpose, all 8 symmetries of the square
+AUGMENTATIONS = ("none", "flips", "dihedral")
+
+
+def reflect_x1(x):
+    x = x.flip(-1)
+    return torch.cat([-x[:, :1], x[:, 1:]], dim=1)
+
+
+def reflect_x2(x):
+    x = x.flip(-2)
+    return torch.cat([x[:, :1], -x[:, 1:2], x[:, 2:]], dim=1)
+
+
+def swap_axes(x):
+    x = x.transpose(-1, -2)
+    return torch.cat([x[:, 1:2], x[:, :1], x[:, 2:]], dim=1)
+
+
+def augment_fields(x, group="dihedral"):
+    """
+    Apply a random symmetry of `group` to every (f1, f2, V) stack of the [N x 3 x H x W]
+    batch `x`, on its device.
+    """
+    if group == "none":
+        return x
+    if group not in AUGMENTATIONS:
+        raise ValueError(f"unknown augmentation: {group}")
+    ops = [reflect_x1, reflect_x2] + ([swap_axes] if group == "dihedral" else [])
+    masks = torch.randint(2, (len(ops), len(x), 1, 1, 1), device=x.device, dtype=torch.bool)
+    for op, mask in zip(ops, masks):
+        x = torch.where(mask, op(x), x)
+    return x
@@ -0,0 +1,125 @@
+"""
+Largest batch size that fits on the device, and the gradient accumulation that
+reaches an effective batch size with it.
+
+On GPU the batch size is doubled until a step runs out of memory, then bisected
+between the last size that fit and the first one that did not. A CPU slows down
+long before it runs out of memory, so there the batch size is doubled only while
+it still raises the throughput. The probe runs the model as configured (attention
+backend, activation checkpointing), on random inputs.
+"""
+import math
+from time import perf_counter
+
+import torch
+import torch.distributed as dist
+
+
+def is_out_of_memory(e):
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e)
+
+
+def time_batch(step, batch_size, device):
+    """Seconds per sample of step(batch_size), None if it runs out of memory."""
+    cuda = torch.device(device).type == "cuda"
+    try:
+        # first call warms up cudnn autotuning and the allocator
+        step(batch_size)
+        if cuda:
+            torch.cuda.synchronize(device)
+        start = perf_counter()
+        step(batch_size)
+        if cuda:
+            torch.cuda.synchronize(device)
+        return (perf_counter() - start) / batch_size
+    except RuntimeError as e:
+        if not is_out_of_memory(e):
+            raise
+        return None
+    finally:
+        if cuda:
+            torch.cuda.empty_cache()
+
+
+def probe_max_batch(step, device, limit=4096, min_gain=0.05, margin=0.9):
+    """
+    Largest batch size for step(batch_size), up to `limit`.
+
+    :param step: runs one batch, e.g. training_step or sampling_step.
+    :param min_gain: on CPU, the batch size is doubled while the throughput grows by this fraction.
+    :param margin: fraction of the largest GPU batch size kept, for the optimizer state and
+                   allocator fragmentation that the probe does not see.
+
+    With a process group, all processes agree on the smallest result.
+    """
+    cuda = torch.device(device).type == "cuda"
+    best, best_time, n = None, None, 1
+    while True:
+        seconds = time_batch(step, n, device)
+        if seconds is None:
+            break
+        if not cuda and best_time is not None and seconds > (1 - min_gain) * best_time:
+            break
+        best, best_time = n, seconds
+        if n >= limit:
+            break
+        n = min(2 * n, limit)
+    if best is None:
+        raise RuntimeError(f"a batch of one sample does not fit on {device}")
+    if cuda and best < n:
+        # bisect between the last fitting and the first failing size, to 1/8 of a step
+        low, high = best, n
+        while high - low > max(1, low // 8):
+            mid = (low + high) // 2
+            if time_batch(step, mid, device) is None:
+                high = mid
+            else:
+                low = mid
+        best = max(1, int(low * margin))
+    if dist.is_available() and dist.is_initialized():
+        best = torch.tensor(best, device=device)
+        dist.all_reduce(best, op=dist.ReduceOp.MIN)
+        best = int(best.item())
+    return best
+
+
+def training_step(model, diffusion, shape, num_classes=None, device="cpu", draws=1):
+    """
+    step(batch_size): forward and backward pass on a random batch. `draws` loss terms per
+    image (--draws-per-image, --antithetic) multiply the batch seen by the model.
+    """
+
+    def step(batch_size):
+        n = batch_size * draws
+        x0 = torch.randn(n, *shape, device=device)
+        t = torch.randint(diffusion.timesteps, (n,), device=device)
+        y = torch.randint(num_classes, (n,), device=device) if num_classes else None
+        xt, eps = diffusion.sample_from_forward_process(x0, t)
+        ((model(xt, t, y=y) - eps) ** 2).mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    return step
+
+
+def sampling_step(model, diffusion, shape, num_classes=None, device="cpu"):
+    """step(batch_size): denoiser evaluation on a random batch, as in a reverse step."""
+
+    def step(batch_size):
+        xt = torch.randn(batch_size, *shape, device=device)
+        t = torch.randint(diffusion.timesteps, (batch_size,), device=device)
+        y = torch.randint(num_classes, (batch_size,), device=device) if num_classes else None
+        with torch.no_grad():
+            model(xt, t, y=y)
+
+    return step
+
+
+def accumulation(effective_batch_size, max_batch_size, world_size=1):
+    """
+    (batch size per process and step, accumulation steps) for an effective batch size of
+    `effective_batch_size` samples per optimizer step over `world_size` processes. The
+    effective batch size is rounded up when it does not split evenly.
+    """
+    per_process = math.ceil(effective_batch_size / world_size)
+    steps = math.ceil(per_process / max_batch_size)
+    return math.ceil(per_process / steps), steps
@@ -0,0 +1,98 @@
+"""
+Convolutional autoencoder for (f1, f2, V) field stacks, used to train and sample the
+diffusion model in a compressed latent space (e.g. [3, 64, 64] -> [4, 16, 16]).
+"""
+import torch as th
+import torch.nn as nn
+
+from unets import conv_nd, normalization, Downsample, Upsample
+
+
+class Block(nn.Module):
+    """
+    A residual block without timestep conditioning.
+    :param channels: the number of input channels.
+    :param out_channels: the number of output channels.
+    """
+
+    def __init__(self, channels, out_channels):
+        super().__init__()
+        self.layers = nn.Sequential(
+            normalization(channels),
+            nn.SiLU(),
+            conv_nd(2, channels, out_channels, 3, padding=1),
+            normalization(out_channels),
+            nn.SiLU(),
+            conv_nd(2, out_channels, out_channels, 3, padding=1),
+        )
+        self.skip_connection = (
+            nn.Identity()
+            if channels == out_channels
+            else conv_nd(2, channels, out_channels, 1)
+        )
+
+    def forward(self, x):
+        return self.skip_connection(x) + self.layers(x)
+
+
+class FieldAutoencoder(nn.Module):
+    """
+    Deterministic autoencoder with a spatial latent. Every level but the last halves
+    the resolution, so the default channel_mult maps 64x64 fields to 16x16 latents.
+    Latents are multiplied by `scale_factor` (set after training, see
+    set_scale_factor) so that they have roughly unit variance for the diffusion model.
+    :param in_channels: channels of the fields.
+    :param latent_channels: channels of the latent.
+    :param base_width: base channel count.
+    :param channel_mult: channel multiplier for each level.
+    """
+
+    def __init__(self, in_channels=3, latent_channels=4, base_width=64, channel_mult=(1, 2, 4)):
+        super().__init__()
+        self.in_channels = in_channels
+        self.latent_channels = latent_channels
+        self.downsample_factor = 2 ** (len(channel_mult) - 1)
+        self.register_buffer("scale_factor", th.tensor(1.0))
+
+        chans = [int(base_width * m) for m in channel_mult]
+        encoder = [conv_nd(2, in_channels, chans[0], 3, padding=1)]
+        for level, ch in enumerate(chans):
+            encoder.append(Block(chans[max(level - 1, 0)], ch))
+            if level != len(chans) - 1:
+                encoder.append(Downsample(ch, True))
+        encoder += [normalization(chans[-1]), nn.SiLU(), conv_nd(2, chans[-1], latent_channels, 3, padding=1)]
+        self.encoder = nn.Sequential(*encoder)
+
+        decoder = [conv_nd(2, latent_channels, chans[-1], 3, padding=1)]
+        for level, ch in list(enumerate(chans))[::-1]:
+            decoder.append(Block(chans[min(level + 1, len(chans) - 1)], ch))
+            if level != 0:
+                decoder.append(Upsample(ch, True))
+        decoder += [normalization(chans[0]), nn.SiLU(), conv_nd(2, chans[0], in_channels, 3, padding=1)]
+        self.decoder = nn.Sequential(*decoder)
+
+    def latent_shape(self, image_size):
+        return (self.latent_channels, image_size // self.downsample_factor, image_size // self.downsample_factor)
+
+    def encode(self, x):
+        return self.encoder(x) * self.scale_factor
+
+    def decode(self, z):
+        return self.decoder(z / self.scale_factor)
+
+    def forward(self, x):
+        return self.decode(self.encode(x))
+
+    @th.no_grad()
+    def set_scale_factor(self, batches):
+        """Scale latents to unit standard deviation over `batches` of fields."""
+        self.scale_factor.fill_(1.0)
+        z = th.cat([self.encode(x).flatten() for x in batches])
+        self.scale_factor.fill_(1.0 / z.std().item())
+
+
+def load_autoencoder(path, in_channels=3, latent_channels=4, device="cpu"):
+    """Load a frozen FieldAutoencoder from a state dict saved by `main.py --train-autoencoder`."""
+    ae = FieldAutoencoder(in_channels, latent_channels).to(device)
+    ae.load_state_dict(th.load(path, map_location=device))
+    return ae.eval().requires_grad_(False)
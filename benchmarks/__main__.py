@@ -0,0 +1,73 @@
+"""
+CPU benchmark suite: UNet forward passes, samplers, the control loop, data
+loading (all with randomly initialized weights) and the cold start of the entry
+points.
+
+    python -m benchmarks --output results.json
+    python -m benchmarks --quick --baseline results.json --output new.json
+
+With --baseline, every result is compared with the record of the same name and
+the exit code is 1 if any of them regressed by more than --tolerance.
+"""
+import sys
+import argparse
+
+import torch
+
+from benchmarks.common import save_results, load_results, compare, print_comparison
+from benchmarks.unet import benchmark_unet
+from benchmarks.samplers import benchmark_samplers
+from benchmarks.control import benchmark_control
+from benchmarks.dataloader import benchmark_data
+from benchmarks.startup import benchmark_startup
+
+SUITES = ("unet", "samplers", "control", "data", "startup")
+
+
+def run_suite(suites=SUITES, quick=False, repeats=3, device="cpu"):
+    results = []
+    if "unet" in suites:
+        results += benchmark_unet(
+            archs=("UNetSmall",) if quick else ("UNetSmall", "UNet", "UNetBig"),
+            batch_sizes=(1,) if quick else (1, 8),
+            repeats=repeats,
+            device=device,
+        )
+    if "samplers" in suites:
+        results += benchmark_samplers(repeats=repeats, device=device)
+    if "control" in suites:
+        results += benchmark_control(systems=["pendulum"] if quick else None, repeats=repeats, device=device)
+    if "data" in suites:
+        results += benchmark_data(num_workers=(0,) if quick else (0, 2, 4), num_files=128 if quick else 512)
+    if "startup" in suites:
+        results += benchmark_startup(("control_cli",) if quick else ("control_cli", "restoration_control", "main"), repeats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("CPU benchmark suite")
+    parser.add_argument("--suites", nargs="+", default=list(SUITES), choices=SUITES)
+    parser.add_argument("--quick", action="store_true", default=False, help="Smallest configurations only")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    parser.add_argument("--baseline", type=str, default=None, help="Results json to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    results = run_suite(args.suites, args.quick, args.repeats, args.device)
+    if args.output:
+        save_results(results, args.output)
+    if args.baseline:
+        rows = compare(results, load_results(args.baseline), args.tolerance)
+        print_comparison(rows)
+        if any(row["regression"] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Latency, peak memory and accuracy of the attention backends at every attention
+resolution of a UNet variant. Run as `python -m benchmarks.attention --arch UNet --image-size 64`.
+
+Every backend is checked against einsum (the reference implementation) on the same
+queries, keys and values, and the benchmark fails if one is not allclose to it.
+"""
+import json
+import argparse
+import numpy as np
+from time import time
+
+import torch
+
+import unets
+
+
+def attention_shapes(arch, image_size, batch_size):
+    """Input shapes of all attention blocks of a model, one per (channels, resolution)."""
+    model = unets.__dict__[arch](image_size=image_size)
+    blocks = {}
+
+    def hook(module, inputs):
+        blocks[tuple(inputs[0].shape)] = (module.channels, module.num_heads)
+
+    handles = [
+        m.register_forward_pre_hook(hook)
+        for m in model.modules()
+        if isinstance(m, unets.AttentionBlock)
+    ]
+    with torch.no_grad():
+        model(
+            torch.zeros(batch_size, 3, image_size, image_size),
+            torch.zeros(batch_size, dtype=torch.int64),
+        )
+    for h in handles:
+        h.remove()
+    return blocks
+
+
+def measure(block, x, repeats, device):
+    with torch.no_grad():
+        block(x)  # warm-up
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats(device)
+        times = []
+        for _ in range(repeats):
+            start = time()
+            block(x)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            times.append(time() - start)
+    peak = (
+        torch.cuda.max_memory_allocated(device) / 2 ** 20
+        if device.type == "cuda"
+        else None
+    )
+    return float(np.median(times)) * 1000, peak
+
+
+def attention_errors(shape, num_heads, device, atol=1e-5, rtol=1e-4):
+    """
+    Max abs error of every backend against einsum, on random q, k, v with the head
+    shape of an attention block of input `shape`. Asserts that they are allclose.
+    """
+    b, c, h, w = shape
+    q, k, v = torch.randn(3, b * num_heads, c // num_heads, h * w, device=device)
+    with torch.no_grad():
+        reference = unets.qkv_attention(q, k, v, "einsum")
+        errors = {}
+        for backend in unets.ATTENTION_BACKENDS[1:]:
+            out = unets.qkv_attention(q, k, v, backend)
+            errors[backend] = (out - reference).abs().max().item()
+            assert torch.allclose(out, reference, atol=atol, rtol=rtol), (
+                f"{backend} attention at {h}x{w}: max abs error {errors[backend]:.3g} against einsum"
+            )
+    return errors
+
+
+def benchmark_attention(arch="UNet", image_size=64, batch_size=8, repeats=10, device="cpu", atol=1e-5):
+    """
+    Return: list of dicts with latency (ms), max abs error against einsum and, on GPU,
+        peak memory (MiB) for every attention resolution and backend.
+    """
+    device = torch.device(device)
+    results = []
+    for (b, c, h, w), (channels, num_heads) in sorted(attention_shapes(arch, image_size, batch_size).items()):
+        x = torch.randn(b, c, h, w, device=device)
+        errors = attention_errors((b, c, h, w), num_heads, device, atol)
+        for backend in unets.ATTENTION_BACKENDS[1:]:
+            block = unets.AttentionBlock(
+                channels,
+                num_head_channels=channels // num_heads,
+                use_new_attention_order=True,
+                attention_backend=backend,
+            ).to(device)
+            latency, peak = measure(block, x, repeats, device)
+            results.append(
+                {
+                    "arch": arch,
+                    "resolution": h,
+                    "tokens": h * w,
+                    "channels": channels,
+                    "heads": num_heads,
+                    "batch_size": b,
+                    "backend": backend,
+                    "latency_ms": latency,
+                    "peak_mem_mib": peak,
+                    "max_abs_err": errors[backend],
+                }
+            )
+            print(
+                f"{h}x{w} \t ch {channels} \t {backend:8s} \t {latency:8.3f} ms \t err {errors[backend]:.2e}"
+                + (f" \t {peak:8.1f} MiB" if peak is not None else "")
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Attention backend benchmark")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--atol", type=float, default=1e-5, help="Tolerance of the backends against einsum")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_attention(
+        args.arch, args.image_size, args.batch_size, args.repeats, args.device, args.atol
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
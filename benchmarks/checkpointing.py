@@ -0,0 +1,116 @@
+"""
+Memory / throughput table of the gradient checkpointing policies for a training
+step. Run as `python -m benchmarks.checkpointing --arch UNetBig --batch-size 32`.
+
+Activation memory is measured as the bytes saved for backward during the forward
+pass, which works on every device; on GPU the allocator peak is reported too.
+"""
+import json
+import argparse
+import numpy as np
+from time import time
+
+import torch
+
+import unets
+
+
+def saved_activation_bytes(fn):
+    """Run fn() and return (output, bytes of tensors saved for backward)."""
+    seen, total = set(), [0]
+
+    def pack(t):
+        key = (t.untyped_storage().data_ptr(), t.dtype)
+        if key not in seen:
+            seen.add(key)
+            total[0] += t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, total[0]
+
+
+def benchmark_policy(arch, image_size, batch_size, policy, resolutions, repeats, device):
+    model = unets.__dict__[arch](
+        image_size=image_size,
+        checkpoint_policy=policy,
+        checkpoint_resolutions=resolutions,
+    ).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    t = torch.randint(1000, (batch_size,), device=device)
+
+    def step():
+        loss, act_bytes = saved_activation_bytes(lambda: (model(x, t) ** 2).mean())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return act_bytes
+
+    step()  # warm-up
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    times = []
+    for _ in range(repeats):
+        start = time()
+        act_bytes = step()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time() - start)
+    return {
+        "arch": arch,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "policy": policy,
+        "resolutions": list(resolutions),
+        "step_s": float(np.median(times)),
+        "images_per_s": batch_size / float(np.median(times)),
+        "activation_mib": act_bytes / 2 ** 20,
+        "peak_mem_mib": torch.cuda.max_memory_allocated(device) / 2 ** 20
+        if device.type == "cuda"
+        else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser("Gradient checkpointing policy benchmark")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--checkpoint-resolutions",
+        type=int,
+        nargs="+",
+        default=[64, 32],
+        help="Resolutions checkpointed by the 'resolutions' policy",
+    )
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+
+    results = []
+    print("policy \t\t images/s \t activations (MiB) \t peak (MiB)")
+    for policy in unets.CHECKPOINT_POLICIES:
+        r = benchmark_policy(
+            args.arch,
+            args.image_size,
+            args.batch_size,
+            policy,
+            args.checkpoint_resolutions if policy == "resolutions" else (),
+            args.repeats,
+            torch.device(args.device),
+        )
+        results.append(r)
+        print(
+            f"{policy:12s} \t {r['images_per_s']:8.2f} \t {r['activation_mib']:10.1f} \t\t {r['peak_mem_mib']}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Shared helpers of the benchmark suite: timing, result files and the comparison
+against a stored baseline.
+
+Every benchmark returns a list of records. A record has a unique "name", the
+compared "metric" and its "value", "higher_is_better", and any other details.
+"""
+import sys
+import json
+import platform
+import numpy as np
+from time import perf_counter
+
+import torch
+
+
+def median_time(fn, repeats=5, device="cpu", warmup=1):
+    """Median wall time of fn() in seconds, synchronizing CUDA after every call."""
+    device = torch.device(device)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = perf_counter()
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            if i >= warmup:
+                times.append(perf_counter() - start)
+    return float(np.median(times))
+
+
+def record(name, metric, value, higher_is_better=False, **details):
+    return {"name": name, "metric": metric, "value": value, "higher_is_better": higher_is_better, **details}
+
+
+def environment():
+    return {
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "threads": torch.get_num_threads(),
+        "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+    }
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare results with a baseline, matching records by name.
+
+    :param tolerance: relative slowdown above which a record is a regression.
+    :return: list of dicts with the baseline and current values, the relative change
+             (positive is better) and whether it is a regression.
+    """
+    baseline = {r["name"]: r for r in baseline}
+    rows = []
+    for r in results:
+        if r["name"] not in baseline:
+            continue
+        base = baseline[r["name"]]["value"]
+        change = (r["value"] - base) / base if r["higher_is_better"] else (base - r["value"]) / r["value"]
+        rows.append(
+            {
+                "name": r["name"],
+                "metric": r["metric"],
+                "baseline": base,
+                "value": r["value"],
+                "change": change,
+                "regression": change < -tolerance,
+            }
+        )
+    return rows
+
+
+def print_comparison(rows):
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['name']:45s} {row['metric']:14s} {row['baseline']:12.4f} -> {row['value']:12.4f} "
+            + f"\t {row['change']:+7.1%} {flag}"
+        )
@@ -0,0 +1,66 @@
+"""
+End-to-end latency of the guided control loop (restoration_control.py) for every
+system in system_dict. Run as `python -m benchmarks.control --sampling-steps 20`.
+
+The loop needs at least ~20 sampling steps: with fewer, the last alpha_bar of the
+sub-sampled schedule underflows in float32.
+"""
+import argparse
+
+import torch
+
+import unets
+from benchmarks.common import median_time, record, save_results
+
+
+def benchmark_control(arch="UNetSmall", systems=None, sampling_steps=20, repeats=3, device="cpu"):
+    """
+    Return: one record per system with the median latency (s) of a full control
+        run (sampling plus the phi updates) with a randomly initialized model.
+    """
+    from restoration_control import GuassianDiffusion, system_dict
+
+    diffusion = GuassianDiffusion(1000, device)
+    model = unets.__dict__[arch](image_size=64).to(device).eval()
+    results = []
+    for name in systems or list(system_dict):
+
+        def run():
+            # the control loop needs autograd for the phi updates
+            with torch.enable_grad():
+                diffusion.sample_from_reverse_process(
+                    model, system_dict[name], sampling_steps, {"y": None}, True, verbose=False
+                )
+
+        seconds = median_time(run, repeats, device)
+        results.append(
+            record(
+                f"control/{name}/{arch}",
+                "latency_s",
+                seconds,
+                system=name,
+                arch=arch,
+                sampling_steps=sampling_steps,
+                steps_per_s=sampling_steps / seconds,
+            )
+        )
+        print(f"{name:16s} \t {seconds:7.3f} s \t {sampling_steps / seconds:7.2f} steps/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Guided control loop benchmark")
+    parser.add_argument("--arch", type=str, default="UNetSmall")
+    parser.add_argument("--systems", nargs="+", default=None, help="Defaults to all of system_dict")
+    parser.add_argument("--sampling-steps", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_control(args.arch, args.systems, args.sampling_steps, args.repeats, args.device)
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Convergence versus wall-clock time of training strategies. Every strategy trains
+the same randomly initialized model on the same data with main.train_one_epoch,
+and is evaluated after every epoch on a fixed validation loss (uniform timesteps,
+fixed noise). Run as
+
+    python -m benchmarks.convergence --strategies uniform loss-aware --epochs 20
+
+Without --folder, a synthetic dataset of smooth random fields is used. The first
+strategy is the baseline: the others report the epochs and seconds they need to
+reach its final validation loss.
+"""
+import copy
+import argparse
+from time import perf_counter
+from easydict import EasyDict
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+import unets
+import objectives
+from data import LyapunovDataset
+from metrics import TrainingMetrics
+from timestep_sampler import create_timestep_sampler
+from benchmarks.common import record, save_results
+
+# training options of every strategy, on top of the defaults of make_args
+STRATEGIES = {
+    "uniform": {"timestep_sampler": "uniform"},
+    "loss-aware": {"timestep_sampler": "loss-aware"},
+    "v": {"prediction": "v"},
+    "v-min-snr": {"prediction": "v", "min_snr_gamma": 5.0},
+    "eps-min-snr": {"min_snr_gamma": 5.0},
+    "antithetic": {"antithetic": True},
+    "stratified": {"stratified_timesteps": True},
+    "antithetic-stratified": {"antithetic": True, "stratified_timesteps": True},
+    "draws-4": {"draws_per_image": 4},
+    "dihedral": {"augment": "dihedral"},
+}
+
+
+def synthetic_fields(num_samples=256, image_size=32, seed=0):
+    """Smooth random (f1, f2, V) stacks in [-1, 1]."""
+    g = torch.Generator().manual_seed(seed)
+    x = F.interpolate(torch.randn(num_samples, 3, 6, 6, generator=g), size=image_size, mode="bicubic", align_corners=True)
+    return x / x.flatten(1).abs().max(dim=1).values[:, None, None, None]
+
+
+def make_args(overrides, image_size, device):
+    args = EasyDict(
+        {
+            "device": device,
+            "dataset": "lyapunov",
+            "class_cond": False,
+            "image_size": image_size,
+            "autoencoder": None,
+            "rank": 0,
+            "sharding": "none",
+            "ema_w": 0.9995,
+            "prediction": "eps",
+            "min_snr_gamma": None,
+            "timestep_sampler": "uniform",
+            "timestep_buckets": 50,
+            "loss_history": 10,
+            "antithetic": False,
+            "stratified_timesteps": False,
+            "draws_per_image": 1,
+            "augment": "none",
+        }
+    )
+    args.update(overrides)
+    return args
+
+
+def validation_loss(model, diffusion, images, seed=0):
+    """
+    Unweighted epsilon MSE at evenly spaced timesteps with fixed noise. Outputs of
+    v / x0 models are converted to eps, so all strategies share one scale.
+    """
+    g = torch.Generator().manual_seed(seed)
+    t = torch.linspace(0, diffusion.timesteps - 1, len(images)).long()
+    eps = torch.randn(images.shape, generator=g)
+    a = diffusion.scalars.alpha_bar.cpu()[t][:, None, None, None]
+    xt = a.sqrt() * images + (1 - a).sqrt() * eps
+    model.eval()
+    with torch.no_grad():
+        output = model(xt.to(diffusion.device), t.to(diffusion.device)).cpu()
+    pred_eps, _ = objectives.eps_x0_from_output(diffusion.prediction, a[:, 0, 0, 0], xt, output)
+    return ((pred_eps - eps) ** 2).mean().item()
+
+
+def train_strategy(name, overrides, train_set, val_images, arch, image_size, epochs, time_budget, batch_size, lr, seed, device):
+    from main import GuassianDiffusion, train_one_epoch
+
+    args = make_args(overrides, image_size, device)
+    torch.manual_seed(seed)
+    model = unets.__dict__[arch](image_size=image_size).to(device)
+    diffusion = GuassianDiffusion(1000, device, prediction=args.prediction)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    args.ema_dict = copy.deepcopy(model.state_dict())
+    args.schedule_sampler = create_timestep_sampler(
+        args.timestep_sampler,
+        diffusion.timesteps,
+        device,
+        **(
+            {"num_buckets": args.timestep_buckets, "history": args.loss_history}
+            if args.timestep_sampler == "loss-aware"
+            else {}
+        ),
+    )
+    metrics = TrainingMetrics(None, interval=10 ** 9, device=device)
+    loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, drop_last=True)
+    curve, wall = [], 0.0
+    for epoch in range(epochs):
+        start = perf_counter()
+        train_one_epoch(model, loader, diffusion, optimizer, metrics, None, args)
+        wall += perf_counter() - start
+        curve.append({"epoch": epoch + 1, "wall_s": wall, "val_loss": validation_loss(model, diffusion, val_images)})
+        print(f"{name:20s} epoch {epoch + 1:3d} \t {wall:8.1f} s \t val loss {curve[-1]['val_loss']:.4f}")
+        if time_budget and wall > time_budget:
+            break
+    return curve
+
+
+def benchmark_convergence(
+    strategies=("uniform", "loss-aware"),
+    folder=None,
+    arch="UNetSmall",
+    image_size=32,
+    epochs=10,
+    time_budget=None,
+    batch_size=32,
+    lr=1e-4,
+    seed=0,
+    device="cpu",
+):
+    """
+    Return: one record per strategy with its final validation loss, its curve and the
+        epochs / seconds it took to reach the final validation loss of the first strategy.
+    """
+    if folder is None:
+        fields = synthetic_fields(image_size=image_size, seed=seed)
+    else:
+        fields = torch.stack(list(LyapunovDataset(folder_path=folder)))
+        fields = F.interpolate(fields, size=image_size, mode="bilinear", align_corners=True)
+    val_images, train_set = fields[:32], fields[32:]
+
+    curves = {
+        name: train_strategy(
+            name, STRATEGIES[name], train_set, val_images, arch, image_size, epochs, time_budget, batch_size, lr, seed, device
+        )
+        for name in strategies
+    }
+    target = curves[strategies[0]][-1]["val_loss"]
+    results = []
+    for name, curve in curves.items():
+        reached = [c for c in curve if c["val_loss"] <= target]
+        results.append(
+            record(
+                f"convergence/{name}/{arch}/{image_size}px",
+                "val_loss",
+                curve[-1]["val_loss"],
+                strategy=name,
+                target_val_loss=target,
+                epochs_to_target=reached[0]["epoch"] if reached else None,
+                wall_s_to_target=reached[0]["wall_s"] if reached else None,
+                curve=curve,
+            )
+        )
+        print(
+            f"{name:20s} final val loss {curve[-1]['val_loss']:.4f} \t to reach {target:.4f}: "
+            + (f"{reached[0]['epoch']} epochs, {reached[0]['wall_s']:.1f} s" if reached else "not reached")
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Convergence vs wall-clock of training strategies")
+    parser.add_argument("--strategies", nargs="+", default=["uniform", "loss-aware"], choices=list(STRATEGIES))
+    parser.add_argument("--folder", type=str, default=None, help="Folder of LyapunovDataset (default: synthetic)")
+    parser.add_argument("--arch", type=str, default="UNetSmall")
+    parser.add_argument("--image-size", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--time-budget", type=float, default=None, help="Stop a strategy after this many seconds")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_convergence(
+        args.strategies,
+        args.folder,
+        args.arch,
+        args.image_size,
+        args.epochs,
+        args.time_budget,
+        args.batch_size,
+        args.lr,
+        args.seed,
+        args.device,
+    )
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
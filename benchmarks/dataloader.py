@@ -0,0 +1,85 @@
+"""
+DataLoader throughput for LyapunovDataset. Run as
+`python -m benchmarks.dataloader --num-workers 0 2 4`.
+
+Without --folder, a temporary folder of random (f1, f2, V) fields is used, so
+the benchmark runs without the generated dataset.
+"""
+import os
+import argparse
+import tempfile
+from time import perf_counter
+
+import torch
+from torch.utils.data import DataLoader
+
+from data import LyapunovDataset
+from benchmarks.common import record, save_results
+
+
+def synthetic_folder(path, num_files=512, image_size=64):
+    for i in range(num_files):
+        torch.save(torch.randn(3, image_size, image_size), os.path.join(path, f"sample_{i}.pt"))
+    return path
+
+
+def benchmark_data(folder=None, num_workers=(0, 2, 4), batch_size=128, epochs=2, num_files=512):
+    """
+    Return: one record per number of workers with the samples/s of full passes over
+        the dataset (after a warm-up pass that starts the workers and fills the page cache).
+    """
+    tmp = None
+    if folder is None:
+        tmp = tempfile.TemporaryDirectory()
+        folder = synthetic_folder(tmp.name, num_files)
+    dataset = LyapunovDataset(folder_path=folder)
+    results = []
+    for workers in num_workers:
+        loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=workers,
+            persistent_workers=workers > 0,
+        )
+        for _ in loader:
+            pass
+        start = perf_counter()
+        for _ in range(epochs):
+            for _ in loader:
+                pass
+        samples_per_s = epochs * len(dataset) / (perf_counter() - start)
+        results.append(
+            record(
+                f"data/lyapunov/workers{workers}/bs{batch_size}",
+                "samples_per_s",
+                samples_per_s,
+                higher_is_better=True,
+                num_workers=workers,
+                batch_size=batch_size,
+                num_samples=len(dataset),
+                synthetic=tmp is not None,
+            )
+        )
+        print(f"workers {workers} \t {samples_per_s:10.1f} samples/s")
+    if tmp is not None:
+        tmp.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("LyapunovDataset DataLoader benchmark")
+    parser.add_argument("--folder", type=str, default=None, help="Folder of the dataset (default: synthetic)")
+    parser.add_argument("--num-workers", nargs="+", type=int, default=[0, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--num-files", type=int, default=512, help="Size of the synthetic dataset")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_data(args.folder, args.num_workers, args.batch_size, args.epochs, args.num_files)
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Per-step latency of a stock UNet against its inference-frozen counterpart
+(unets.freeze_for_inference). Run as `python -m benchmarks.frozen --arch UNet`.
+"""
+import json
+import argparse
+import numpy as np
+from time import time
+
+import torch
+
+import unets
+
+
+def time_steps(fn, steps, repeats, device):
+    times = []
+    with torch.no_grad():
+        fn(0)  # warm-up
+        for _ in range(repeats):
+            start = time()
+            for i in range(steps):
+                fn(i)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            times.append((time() - start) / steps)
+    return float(np.median(times)) * 1000
+
+
+def benchmark_frozen(arch="UNet", image_size=64, batch_size=1, sampling_steps=50, repeats=3, device="cpu"):
+    """
+    Return: dict with the mean per-step latency (ms) of both modules and the
+        maximum absolute difference of their outputs.
+    """
+    device = torch.device(device)
+    model = unets.__dict__[arch](image_size=image_size).to(device).eval()
+    timesteps = np.linspace(0, 999, num=sampling_steps, endpoint=True, dtype=int)
+    start = time()
+    frozen = unets.freeze_for_inference(model, timesteps)
+    freeze_s = time() - start
+    x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    t = torch.as_tensor(timesteps, device=device)
+    with torch.no_grad():
+        max_diff = (model(x, t[[-1] * batch_size]) - frozen(x, sampling_steps - 1)).abs().max().item()
+    stock_ms = time_steps(lambda i: model(x, t[[i] * batch_size]), sampling_steps, repeats, device)
+    frozen_ms = time_steps(lambda i: frozen(x, i), sampling_steps, repeats, device)
+    return {
+        "arch": arch,
+        "image_size": image_size,
+        "batch_size": batch_size,
+        "sampling_steps": sampling_steps,
+        "freeze_s": freeze_s,
+        "stock_ms_per_step": stock_ms,
+        "frozen_ms_per_step": frozen_ms,
+        "saving_ms_per_step": stock_ms - frozen_ms,
+        "max_abs_diff": max_diff,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser("Stock vs inference-frozen UNet")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--sampling-steps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    result = benchmark_frozen(
+        args.arch, args.image_size, args.batch_size, args.sampling_steps, args.repeats, args.device
+    )
+    print(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
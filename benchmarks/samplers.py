@@ -0,0 +1,91 @@
+"""
+Reverse-process steps/sec of the samplers of main.py. Run as
+`python -m benchmarks.samplers --arch UNetSmall --sampling-steps 20`.
+"""
+import argparse
+
+import torch
+
+import unets
+from benchmarks.common import median_time, record, save_results
+
+SAMPLERS = ("ddpm", "ddim", "ddim_frozen")
+
+
+def benchmark_samplers(
+    arch="UNetSmall",
+    image_size=64,
+    batch_size=1,
+    sampling_steps=20,
+    samplers=SAMPLERS,
+    repeats=3,
+    device="cpu",
+):
+    """
+    Return: one record per sampler with the reverse-process steps/sec of a full
+        sample_from_reverse_process call.
+    """
+    from main import GuassianDiffusion
+
+    diffusion = GuassianDiffusion(1000, device)
+    model = unets.__dict__[arch](image_size=image_size).to(device).eval()
+    xT = torch.randn(batch_size, 3, image_size, image_size, device=device)
+    results = []
+    for sampler in samplers:
+        sampler_model = model
+        if sampler.endswith("_frozen"):
+            sampler_model = unets.freeze_for_inference(
+                model, diffusion.get_sampling_scalars(sampling_steps)[0]
+            )
+        ddim = sampler.startswith("ddim")
+        seconds = median_time(
+            lambda: diffusion.sample_from_reverse_process(
+                sampler_model, xT, sampling_steps, {"y": None}, ddim
+            ),
+            repeats,
+            device,
+        )
+        results.append(
+            record(
+                f"sampler/{sampler}/{arch}/{image_size}px/bs{batch_size}",
+                "steps_per_s",
+                sampling_steps / seconds,
+                higher_is_better=True,
+                sampler=sampler,
+                arch=arch,
+                image_size=image_size,
+                batch_size=batch_size,
+                sampling_steps=sampling_steps,
+                latency_s=seconds,
+            )
+        )
+        print(f"{sampler:12s} \t {sampling_steps / seconds:8.2f} steps/s \t {seconds:7.3f} s per sample call")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Reverse-process sampler benchmark")
+    parser.add_argument("--arch", type=str, default="UNetSmall")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--sampling-steps", type=int, default=20)
+    parser.add_argument("--samplers", nargs="+", default=list(SAMPLERS), choices=SAMPLERS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_samplers(
+        args.arch,
+        args.image_size,
+        args.batch_size,
+        args.sampling_steps,
+        args.samplers,
+        args.repeats,
+        args.device,
+    )
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
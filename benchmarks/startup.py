@@ -0,0 +1,78 @@
+"""
+Cold start of the entry points: the time to import a module in a fresh Python
+process, next to `import torch` alone. Also lists the heavy optional dependencies
+(plotting, datasets, distributed) that an import pulls in. Run as
+
+    python -m benchmarks.startup --modules control_cli restoration_control
+"""
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+from time import perf_counter
+
+from benchmarks.common import record, save_results
+
+# dependencies that the control path should not load
+HEAVY_MODULES = ("matplotlib", "cv2", "torchvision", "scipy", "PIL", "torch.distributed.fsdp")
+
+PROBE = """
+import sys, json
+import {module}
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+"""
+
+
+def import_time(module, repeats=3):
+    """Median wall time (s) of importing `module` in a fresh process, and the heavy modules it loads."""
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        out = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        times.append(perf_counter() - start)
+    return float(np.median(times)), json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def benchmark_startup(modules=("control_cli", "restoration_control", "main"), repeats=3):
+    """
+    Return: one record per module (and one for torch) with the median cold import time (s),
+        the time on top of `import torch` and the heavy modules it loads.
+    """
+    torch_s, _ = import_time("torch", repeats)
+    results = [record("startup/torch", "import_s", torch_s, module="torch")]
+    print(f"{'torch':20s} \t {torch_s:6.2f} s")
+    for module in modules:
+        seconds, heavy = import_time(module, repeats)
+        results.append(
+            record(
+                f"startup/{module}",
+                "import_s",
+                seconds,
+                module=module,
+                over_torch_s=seconds - torch_s,
+                heavy_modules=heavy,
+            )
+        )
+        print(f"{module:20s} \t {seconds:6.2f} s \t +{seconds - torch_s:5.2f} s over torch \t heavy: {heavy}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Cold import time of the entry points")
+    parser.add_argument("--modules", nargs="+", default=["control_cli", "restoration_control", "main"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_startup(args.modules, args.repeats)
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Forward latency and throughput of the UNet variants. Run as
+`python -m benchmarks.unet --archs UNetSmall UNet --image-sizes 32 64 --batch-sizes 1 8`.
+"""
+import argparse
+
+import torch
+
+import unets
+from benchmarks.common import median_time, record, save_results
+
+
+def benchmark_unet(
+    archs=("UNetSmall", "UNet", "UNetBig"),
+    image_sizes=(32, 64),
+    batch_sizes=(1, 8),
+    repeats=5,
+    device="cpu",
+):
+    """
+    Return: one record per (arch, image size, batch size) with the median forward
+        latency (ms) and throughput (samples/s) of a randomly initialized model.
+    """
+    results = []
+    for arch in archs:
+        for image_size in image_sizes:
+            model = unets.__dict__[arch](image_size=image_size).to(device).eval()
+            for batch_size in batch_sizes:
+                x = torch.randn(batch_size, 3, image_size, image_size, device=device)
+                t = torch.randint(1000, (batch_size,), device=device)
+                seconds = median_time(lambda: model(x, t), repeats, device)
+                results.append(
+                    record(
+                        f"unet/{arch}/{image_size}px/bs{batch_size}",
+                        "latency_ms",
+                        seconds * 1000,
+                        arch=arch,
+                        image_size=image_size,
+                        batch_size=batch_size,
+                        samples_per_s=batch_size / seconds,
+                        params_m=sum(p.numel() for p in model.parameters()) / 1e6,
+                    )
+                )
+                print(
+                    f"{arch:10s} {image_size}px \t bs {batch_size:3d} \t {seconds * 1000:9.2f} ms "
+                    + f"\t {batch_size / seconds:8.1f} samples/s"
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("UNet forward benchmark")
+    parser.add_argument("--archs", nargs="+", default=["UNetSmall", "UNet", "UNetBig"])
+    parser.add_argument("--image-sizes", nargs="+", type=int, default=[32, 64])
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--output", type=str, default=None, help="Write results as json")
+    args = parser.parse_args()
+    results = benchmark_unet(args.archs, args.image_sizes, args.batch_sizes, args.repeats, args.device)
+    if args.output:
+        save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
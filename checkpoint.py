@@ -0,0 +1,202 @@
+"""
+Asynchronous checkpointing with full training-state resume.
+
+The training state (model, EMA, optimizer, epoch and RNG states) is copied to
+CPU on the training thread, which only takes a device-to-host copy, and written
+by a background thread. Files are written to <name>.tmp and renamed, so a crash
+while writing never leaves a truncated checkpoint behind.
+"""
+import os
+import re
+import json
+import glob
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.distributed as dist
+
+
+def snapshot(obj):
+    """Recursively copy all tensors in `obj` (dicts, lists, tuples) to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def gather_rng_states():
+    """RNG states of all processes (a single one without a process group)."""
+    if not (dist.is_available() and dist.is_initialized()):
+        return [rng_state()]
+    states = [None] * dist.get_world_size()
+    dist.all_gather_object(states, rng_state())
+    return states
+
+
+def match_keys(d, reference):
+    """Add or strip the DDP "module." prefix of `d` to match the keys of `reference`."""
+    if set(d) == set(reference):
+        return d
+    d = {k[len("module."):] if k.startswith("module.") else k: v for k, v in d.items()}
+    if next(iter(reference)).startswith("module."):
+        d = {"module." + k: v for k, v in d.items()}
+    return d
+
+
+def atomic_save(obj, path):
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def write_metadata(path, metadata):
+    """Write the json sidecar (<path>.json) of a saved model, e.g. its prediction target."""
+    with open(path + ".json.tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def read_metadata(path):
+    """The json sidecar of a saved model, or {} for models saved without one."""
+    if path is None or not os.path.exists(path + ".json"):
+        return {}
+    with open(path + ".json") as f:
+        return json.load(f)
+
+
+class CheckpointManager:
+    """
+    Write checkpoints from a background thread and keep the last `keep` of them.
+
+    At most one write is in flight: saving waits for the previous write, so host
+    memory holds at most two snapshots.
+
+    :param ckpt_dir: directory of the checkpoints.
+    :param name: checkpoints are saved as <name>-epoch_<epoch>.pt.
+    :param keep: number of checkpoints to retain (0 keeps all).
+    """
+
+    def __init__(self, ckpt_dir, name, keep=3):
+        self.ckpt_dir = ckpt_dir
+        self.name = name
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(ckpt_dir, exist_ok=True)
+
+    def save(self, state, epoch, exports={}):
+        """
+        Snapshot the training state of a finished epoch to CPU now, and in the
+        background write it, drop old checkpoints and write the entries of `state`
+        listed in `exports` ({path: key}) as standalone files, with state["metadata"]
+        (if any) as their json sidecar.
+        """
+        state = snapshot(state)
+        self.wait()
+        path = os.path.join(self.ckpt_dir, f"{self.name}-epoch_{epoch:04d}.pt")
+        self.pending = self.executor.submit(self._write, state, path, exports)
+
+    def _write(self, state, path, exports):
+        atomic_save(state, path)
+        if self.keep:
+            self.prune()
+        for export_path, key in exports.items():
+            atomic_save(state[key], export_path)
+            if "metadata" in state:
+                write_metadata(export_path, state["metadata"])
+
+    def checkpoints(self):
+        """Complete checkpoints, oldest first."""
+        pattern = os.path.join(glob.escape(self.ckpt_dir), glob.escape(self.name) + "-epoch_*.pt")
+        epoch = lambda p: int(re.search(r"-epoch_(\d+)\.pt$", p).group(1))
+        return sorted(glob.glob(pattern), key=epoch)
+
+    def prune(self):
+        for path in self.checkpoints()[: -self.keep]:
+            os.remove(path)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def wait(self):
+        """Block until the pending write is on disk (re-raising its errors)."""
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def training_state(model_state, ema_dict, optimizer_state, epoch, **extra):
+    """
+    Everything needed to resume training after `epoch` (0-indexed) finished, from the
+    model, EMA and optimizer state dicts (consolidated ones for sharded training, see
+    sharding.py). The DistributedSampler is re-seeded with set_epoch(epoch) every
+    epoch, so the epoch counter also restores the data order. Collective call: RNG
+    states are gathered from every process. `extra` entries (e.g. state dicts of
+    other training components) are stored as is.
+    """
+    return {
+        **extra,
+        "epoch": epoch + 1,
+        "model": model_state,
+        "ema": ema_dict,
+        "optimizer": optimizer_state,
+        "rng": gather_rng_states(),
+    }
+
+
+def resume(path, model, optimizer, device, extra={}, load=None):
+    """
+    Restore model and optimizer from a checkpoint written by CheckpointManager.save,
+    the RNG state of this process and the state dicts of the objects in `extra`
+    ({key: object with load_state_dict}) saved under the same keys. `load(state, model,
+    optimizer)` replaces the restore of model, optimizer and EMA (e.g. for sharded
+    models) and returns the EMA.
+
+    Return: (epoch to start from, EMA state dict).
+    """
+    # RNG states must stay on CPU, load_state_dict moves the rest to the model's device
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    if load is None:
+        reference = model.state_dict()
+        model.load_state_dict(match_keys(state["model"], reference))
+        optimizer.load_state_dict(state["optimizer"])
+        ema_dict = {k: v.to(device) for k, v in match_keys(state["ema"], reference).items()}
+    else:
+        ema_dict = load(state, model, optimizer)
+    for key, obj in extra.items():
+        if key in state:
+            obj.load_state_dict(state[key])
+    rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    if rank < len(state["rng"]):
+        set_rng_state(state["rng"][rank])
+    else:
+        print(f"{path} has no RNG state for rank {rank}, keeping the seeded one")
+    return state["epoch"], ema_dict
@@ -0,0 +1,249 @@
+"""
+Bulk controller synthesis over a JSONL file of jobs, for sweeps over many plant
+configurations.
+
+Every line of --jobs is one job: {"id": ..., "system": ..., "params": {...},
+"sampling_steps": ...} (id defaults to the line number, params and sampling_steps are
+optional, see restoration_control.make_system). Jobs are streamed and grouped by
+(system, sampling steps); every full group runs as one batched reverse pass
+(GuassianDiffusion.control_batch) and its results are appended to --output, one line
+per job with phi, the final loss, the ROA and the slot of its V in the side file.
+Non-finite values are null, and "finite" is false for jobs whose phi or loss diverged.
+
+The side file (--output with a .v.f16 suffix by default) is a flat array of float16
+H x W slots, read back with load_v. An interrupted run resumes where it stopped:
+jobs whose id is in --output are skipped, and a partly written last line or V slot
+is discarded. Jobs which cannot run (malformed lines, unknown systems or parameters,
+or a failing reverse pass) get an {"id", "error"} line and are not retried either. The starting noise, initial phi and plant noise (noisy_pendulum) of a
+job only depend on (--seed, line number), so a resumed sweep gives the same
+controllers as an uninterrupted one, whatever the batches.
+
+    python control_bulk.py --jobs sweep.jsonl --output sweep_results.jsonl --pretrained-ckpt model.pt
+"""
+import os
+import json
+import argparse
+from time import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+import unets
+from checkpoint import read_metadata
+from control_common import load_model, result_record
+from sample_writer import sample_seed
+from roa import estimate_roa_from_stack
+from restoration_control import GuassianDiffusion, make_system, set_system_params
+
+V_DTYPE = np.float16
+
+
+def check_job(job):
+    """Raise ValueError (or TypeError) for a job which cannot run."""
+    if not isinstance(job.get("id"), (int, str)) or isinstance(job.get("id"), bool):
+        raise ValueError("id must be a string or an integer")
+    steps = job["sampling_steps"]
+    if not isinstance(steps, int) or isinstance(steps, bool) or steps < 1:
+        raise ValueError("sampling_steps must be a positive integer")
+    if not isinstance(job["params"], dict):
+        raise ValueError("params must be an object")
+    set_system_params(make_system(job["system"]), job["params"])
+
+
+def read_jobs(path, default_steps):
+    """
+    Yield (line number, job, error) of a JSONL job file, with id and sampling_steps
+    filled in. error is the reason a job cannot run (a malformed line, an unknown
+    system or parameter), None for valid jobs.
+    """
+    with open(path) as f:
+        for index, line in enumerate(f):
+            if not line.strip():
+                continue
+            job = None
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("a job must be an object")
+                job.setdefault("id", index)
+                job.setdefault("params", {})
+                job.setdefault("sampling_steps", default_steps)
+                check_job(job)
+            except (ValueError, TypeError, KeyError) as e:
+                job_id = job.get("id") if isinstance(job, dict) else None
+                job = {"id": job_id if isinstance(job_id, (int, str)) else index}
+                yield index, job, f"{type(e).__name__}: {e}"
+                continue
+            yield index, job, None
+
+
+def recover(output, v_file, grid_size):
+    """
+    Ids of the complete jobs of a previous run, and the number of V slots they use.
+    Truncates a partly written last line of `output` and the V slots past the last
+    complete job.
+    """
+    done, slots = set(), 0
+    if os.path.exists(output):
+        with open(output, "rb+") as f:
+            data = f.read()
+            f.truncate(data.rfind(b"\n") + 1)
+        for line in data[: data.rfind(b"\n") + 1].splitlines():
+            result = json.loads(line)
+            done.add(result["id"])
+            # failed jobs have an error and no V
+            slots = max(slots, result.get("v_slot", -1) + 1)
+    slot_bytes = grid_size * grid_size * np.dtype(V_DTYPE).itemsize
+    if os.path.exists(v_file):
+        with open(v_file, "rb+") as f:
+            f.truncate(slots * slot_bytes)
+    return done, slots
+
+
+def load_v(v_file, slot, grid_size=64):
+    """The V field stored in `slot` of a side file."""
+    v = np.memmap(v_file, dtype=V_DTYPE, mode="r").reshape(-1, grid_size, grid_size)
+    return np.asarray(v[slot], dtype=np.float32)
+
+
+class BulkRunner:
+    """Run batches of jobs and append their results to the output and side file."""
+
+    def __init__(self, model, diffusion, output, v_file, slots, seed, grid_size=64):
+        self.model = model
+        self.diffusion = diffusion
+        self.output = open(output, "a")
+        self.v_file = open(v_file, "ab")
+        self.slots = slots
+        self.seed = seed
+        self.grid_size = grid_size
+        self.num_done = 0
+        self.num_failed = 0
+        self.start = time()
+
+    def make(self, index, job):
+        """
+        The system and starting V of a job, seeded by its line number. The noise of
+        stochastic systems (noisy_pendulum) comes from their own generators, so it does
+        not depend on the other jobs of the batch or on the batches before.
+        """
+        seed = sample_seed(self.seed, index)
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            system = make_system(job["system"], self.grid_size, **job["params"])
+            vT = torch.randn((self.grid_size, self.grid_size))
+        system.seed(seed)
+        return system, vT
+
+    def run(self, batch):
+        """
+        Run a batch of jobs. If the batched pass fails, the jobs run one by one and the
+        failing ones get an error line, so that a resumed sweep skips them too.
+        """
+        try:
+            self.solve(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self.write_error(batch[0][1], f"{type(e).__name__}: {e}")
+            else:
+                for job in batch:
+                    self.run([job])
+
+    def write_error(self, job, error):
+        self.output.write(json.dumps({"id": job["id"], "error": error}) + "\n")
+        self.output.flush()
+        self.num_failed += 1
+
+    def solve(self, batch):
+        systems, vT = zip(*(self.make(index, job) for index, job in batch))
+        # the control loop needs autograd for the phi updates
+        with torch.enable_grad():
+            final, losses = self.diffusion.control_batch(
+                self.model, list(systems), batch[0][1]["sampling_steps"], vT=torch.stack(vT)
+            )
+        roa = estimate_roa_from_stack(final)
+        # V slots first: a result line only ever points to a complete slot
+        self.v_file.write(final[:, 2].cpu().numpy().astype(V_DTYPE).tobytes())
+        self.v_file.flush()
+        for k, ((_, job), system) in enumerate(zip(batch, systems)):
+            result = {
+                "id": job["id"],
+                "system": job["system"],
+                "params": job["params"],
+                "sampling_steps": job["sampling_steps"],
+                **result_record(system, losses[k], roa, k),
+                "v_slot": self.slots + k,
+            }
+            self.output.write(json.dumps(result, allow_nan=False) + "\n")
+        self.output.flush()
+        self.slots += len(batch)
+        self.num_done += len(batch)
+
+    @property
+    def per_hour(self):
+        return 3600 * self.num_done / max(time() - self.start, 1e-9)
+
+    def close(self):
+        self.output.close()
+        self.v_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser("Bulk controller synthesis over a JSONL job file")
+    parser.add_argument("--jobs", type=str, required=True, help="Input JSONL, one job per line")
+    parser.add_argument("--output", type=str, required=True, help="Output JSONL, appended to when resuming")
+    parser.add_argument("--v-file", type=str, default=None, help="Side file of the V fields (default: <output>.v.f16)")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--pretrained-ckpt", type=str, default=None)
+    parser.add_argument("--attention-backend", type=str, default="auto", choices=unets.ATTENTION_BACKENDS)
+    parser.add_argument("--diffusion-steps", type=int, default=1000)
+    parser.add_argument("--sampling-steps", type=int, default=250, help="Steps of jobs which do not set them")
+    parser.add_argument("--batch-size", type=int, default=64, help="Systems per reverse pass")
+    parser.add_argument("--device", type=str, default=None, help="Default: cuda if available")
+    parser.add_argument("--seed", type=int, default=112233)
+    args = parser.parse_args()
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    v_file = args.v_file or os.path.splitext(args.output)[0] + ".v.f16"
+    done, slots = recover(args.output, v_file, 64)
+    if done:
+        print(f"Resuming: {len(done)} jobs already in {args.output}")
+
+    prediction = (read_metadata(args.pretrained_ckpt).get("prediction") if args.pretrained_ckpt else None) or "eps"
+    model = load_model(args.arch, args.pretrained_ckpt, device, args.attention_backend)
+    diffusion = GuassianDiffusion(args.diffusion_steps, device, prediction=prediction)
+    runner = BulkRunner(model, diffusion, args.output, v_file, slots, args.seed)
+
+    def run(batch):
+        runner.run(batch)
+        print(
+            f"{runner.num_done} jobs \t batch of {len(batch)} {batch[0][1]['system']} "
+            f"({batch[0][1]['sampling_steps']} steps) \t {runner.per_hour:.0f} controllers/hour"
+        )
+
+    groups, skipped = defaultdict(list), 0
+    for index, job, error in read_jobs(args.jobs, args.sampling_steps):
+        if job["id"] in done:
+            skipped += 1
+            continue
+        if error is not None:
+            print(f"Job {job['id']} (line {index + 1}) failed: {error}")
+            runner.write_error(job, error)
+            continue
+        key = (job["system"], job["sampling_steps"])
+        groups[key].append((index, job))
+        if len(groups[key]) == args.batch_size:
+            run(groups.pop(key))
+    for batch in groups.values():
+        run(batch)
+    runner.close()
+    print(
+        f"Done: {runner.num_done} controllers in {time() - runner.start:.1f} s "
+        f"({runner.per_hour:.0f} controllers/hour), {runner.num_failed} failed, {skipped} skipped as complete. "
+        f"Results in {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Minimal entry point of the guided control loop, for short-lived control jobs.
+
+Loads a denoiser, runs the reverse process of restoration_control.py for one system
+and saves the final (f1, f2, V) stack with the controller parameters phi. It imports
+only torch, the UNets and the system map: no plotting, dataset or distributed
+modules, so the cold start is dominated by `import torch`.
+
+    python control_cli.py --system pendulum --pretrained-ckpt model.pt --output pendulum.pt
+
+`python -m benchmarks.startup` measures the cold import time of this module against
+restoration_control and main.
+"""
+import argparse
+import numpy as np
+
+import torch
+
+import unets
+import objectives
+from control_common import load_model
+from checkpoint import read_metadata
+from roa import estimate_roa_from_stack
+from restoration_control import GuassianDiffusion, system_dict
+from trajectory import TrajectoryBuffer
+
+
+def run_control(model, diffusion, system, sampling_steps=250, ddim=True, verbose=False, trajectory=None):
+    """
+    trajectory: Optional trajectory.TrajectoryBuffer capturing the intermediate steps.
+
+    Return: the final (f1, f2, V) stack, the controller parameters {name: value} and
+        the certified ROA (roa.estimate_roa_from_stack) of the controlled system.
+    """
+    # the control loop needs autograd for the phi updates
+    with torch.enable_grad():
+        final, p = diffusion.sample_from_reverse_process(
+            model, system_dict[system], sampling_steps, {"y": None}, ddim, verbose=verbose, trajectory=trajectory
+        )
+    phi = {name: param.item() for name, param in p.named_parameters()}
+    return final, phi, estimate_roa_from_stack(final)
+
+
+def main():
+    parser = argparse.ArgumentParser("Guided control loop")
+    parser.add_argument("--system", type=str, default="noisy_pendulum", choices=list(system_dict))
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--pretrained-ckpt", type=str, default=None)
+    parser.add_argument("--attention-backend", type=str, default="auto", choices=unets.ATTENTION_BACKENDS)
+    parser.add_argument("--diffusion-steps", type=int, default=1000)
+    parser.add_argument("--sampling-steps", type=int, default=250)
+    parser.add_argument("--no-ddim", action="store_true", default=False, help="DDPM instead of DDIM steps")
+    parser.add_argument(
+        "--prediction",
+        type=str,
+        default=None,
+        choices=objectives.PREDICTIONS,
+        help="Prediction target of the model (default: from the metadata of --pretrained-ckpt, else eps)",
+    )
+    parser.add_argument("--device", type=str, default=None, help="Default: cuda if available")
+    parser.add_argument("--seed", type=int, default=112233)
+    parser.add_argument("--output", type=str, default=None, help="Save {stack, phi, roa_c, roa_area} (.pt)")
+    parser.add_argument("--verbose", action="store_true", default=False, help="Print every step, plot the result")
+    parser.add_argument(
+        "--trajectory-dir",
+        type=str,
+        default=None,
+        help="Capture x_t, pred_x0, V, loss and phi to memory-mapped arrays (render with trajectory.py)",
+    )
+    parser.add_argument("--trajectory-stride", type=int, default=1, help="Capture every n-th sampling step")
+    args = parser.parse_args()
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.seed)
+    # NoisyPendulum draws its parameter noise from numpy
+    np.random.seed(args.seed)
+    prediction = args.prediction or read_metadata(args.pretrained_ckpt).get("prediction") or "eps"
+    model = load_model(args.arch, args.pretrained_ckpt, device, args.attention_backend)
+    diffusion = GuassianDiffusion(args.diffusion_steps, device, prediction=prediction)
+    trajectory = None
+    if args.trajectory_dir:
+        trajectory = TrajectoryBuffer(args.trajectory_dir, args.sampling_steps, args.trajectory_stride)
+    final, phi, roa = run_control(
+        model, diffusion, args.system, args.sampling_steps, not args.no_ddim, args.verbose, trajectory
+    )
+    if trajectory is not None:
+        trajectory.close()
+    print(f"{args.system}: phi {phi} \t ROA level c: {roa.c.item():.4f} \t ROA area: {roa.area.item():.4f}")
+    if args.output:
+        torch.save(
+            {"stack": final.cpu(), "phi": phi, "roa_c": roa.c.item(), "roa_area": roa.area.item()},
+            args.output,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""
+Helpers shared by the control entry points (control_cli, control_service and
+control_bulk): loading a denoiser and turning the outcome of a control run into a
+JSON record.
+"""
+import math
+
+import torch
+
+import unets
+from data import fix_legacy_dict
+
+
+def load_model(arch, ckpt, device, attention_backend="auto"):
+    model = unets.__dict__[arch](image_size=64, attention_backend=attention_backend).to(device)
+    if ckpt:
+        model.load_state_dict(fix_legacy_dict(torch.load(ckpt, map_location=device)))
+    return model.eval()
+
+
+def json_float(x):
+    """x as a float, or None if it is not finite (NaN and inf are not valid JSON)."""
+    x = float(x)
+    return x if math.isfinite(x) else None
+
+
+def result_record(system, loss, roa, k):
+    """
+    phi, final loss and ROA of a controlled system, the k-th of the batch of `roa`
+    (roa.estimate_roa_from_stack).
+    """
+    phi = {name: p.item() for name, p in system.named_parameters()}
+    # a diverged run (NaN phi / loss) and no certified level (-inf) are null in JSON
+    return {
+        "phi": {name: json_float(p) for name, p in phi.items()},
+        "loss": json_float(loss),
+        "finite": all(math.isfinite(p) for p in phi.values()) and math.isfinite(loss),
+        "roa_c": json_float(roa.c[k]),
+        "roa_area": json_float(roa.area[k]),
+    }
@@ -0,0 +1,329 @@
+"""
+Resident controller synthesis service: keeps denoisers loaded and answers control
+requests over HTTP on localhost (or a Unix socket), instead of one process per job.
+
+Concurrent requests arriving within --batch-window-ms of each other are coalesced into
+one batched reverse pass (GuassianDiffusion.control_batch), one per (model, sampling
+steps) group, with any mix of system types. Connections are served by an asyncio
+front end, the model work runs on a single dedicated executor thread.
+
+    python control_service.py --model pendulum=./trained_models/model.pt --port 8765
+
+    POST /control  {"system": "pendulum", "params": {"m": 0.2}, "sampling_steps": 250}
+                   -> {"phi": {...}, "loss": ..., "finite": ..., "roa_c": ..., "roa_area": ..., "v": [[...]]}
+                   Non-finite values (diverged runs, no certified ROA) are null, and
+                   finite is false if phi or the loss diverged.
+                   A list of requests streams back one JSON line per result, as they finish.
+    GET  /stats    queue depth, batch sizes and latency percentiles (ms).
+
+Request fields: system (a system_dict entry), params (physical constants or initial
+phi, see restoration_control.make_system), and optionally model, sampling_steps and
+return_v (default true).
+"""
+import copy
+import json
+import asyncio
+import argparse
+from time import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from easydict import EasyDict
+
+import unets
+from checkpoint import read_metadata
+from control_common import json_float, load_model, result_record
+from roa import estimate_roa_from_stack
+from restoration_control import GuassianDiffusion, make_system, set_system_params
+
+STATUS = {200: "200 OK", 400: "400 Bad Request", 404: "404 Not Found", 500: "500 Internal Server Error"}
+
+
+class ControlService:
+    """
+    :param models: {name: (model, diffusion)} of the resident denoisers.
+    :param sampling_steps: default number of steps of a request.
+    :param window: seconds to wait for more requests after the first one of a batch.
+    :param max_batch: largest number of systems in one reverse pass.
+    """
+
+    def __init__(self, models, sampling_steps=250, window=0.01, max_batch=32, history=10000):
+        self.models = models
+        self.sampling_steps = sampling_steps
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="control")
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.in_flight = 0
+        self.served = 0
+        self.failed = 0
+
+    def parse(self, request):
+        """Validate a request and build its system, raise ValueError (or TypeError) for bad requests."""
+        if not isinstance(request, dict) or not isinstance(request.get("system"), str):
+            raise ValueError("a request needs a system name")
+        model = request.get("model", next(iter(self.models)))
+        if not isinstance(model, str) or model not in self.models:
+            raise ValueError(f"unknown model: {model}")
+        params = request.get("params", {})
+        if not isinstance(params, dict) or not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in params.values()
+        ):
+            raise ValueError("params must be an object of numbers")
+        steps = request.get("sampling_steps", self.sampling_steps)
+        if not isinstance(steps, int) or isinstance(steps, bool) or steps < 1:
+            raise ValueError("sampling_steps must be a positive integer")
+        return EasyDict(
+            system_name=request["system"],
+            params=params,
+            # only the phi and float constants of the system, not e.g. its grid
+            system=set_system_params(make_system(request["system"]), params),
+            model=model,
+            steps=steps,
+            return_v=bool(request.get("return_v", True)),
+        )
+
+    async def submit(self, job):
+        job.future = asyncio.get_running_loop().create_future()
+        job.start = time()
+        self.queue.put_nowait(job)
+        return await job.future
+
+    async def collect(self):
+        """The next batch: the first queued job and the ones arriving within the window."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            groups = defaultdict(list)
+            for job in await self.collect():
+                groups[(job.model, job.steps)].append(job)
+            for jobs in groups.values():
+                self.in_flight = len(jobs)
+                for job, result in zip(jobs, await self.solve_all(jobs)):
+                    if isinstance(result, Exception):
+                        self.failed += 1
+                        if not job.future.done():
+                            job.future.set_exception(result)
+                    else:
+                        self.latencies.append(time() - job.start)
+                        self.served += 1
+                        if not job.future.done():
+                            job.future.set_result(result)
+                self.in_flight = 0
+
+    async def solve_all(self, jobs):
+        """
+        Results of a batch. If the batched pass fails, the jobs are solved one by one,
+        so that only the failing ones get their exception (in place of a result).
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, self.solve, jobs)
+        except Exception as e:
+            if len(jobs) == 1:
+                return [e]
+        results = []
+        for job in jobs:
+            results += await self.solve_all([job])
+        return results
+
+    def solve(self, jobs):
+        """One batched reverse pass, on the executor thread."""
+        model, diffusion = self.models[jobs[0].model]
+        # a failed pass leaves the systems of the jobs untouched for a retry
+        systems = [copy.deepcopy(job.system) for job in jobs]
+        # the control loop needs autograd for the phi updates
+        with torch.enable_grad():
+            final, losses = diffusion.control_batch(model, systems, jobs[0].steps)
+        roa = estimate_roa_from_stack(final)
+        self.batch_sizes.append(len(jobs))
+        results = []
+        for k, (job, system) in enumerate(zip(jobs, systems)):
+            result = {
+                "system": job.system_name,
+                "params": job.params,
+                **result_record(system, losses[k], roa, k),
+                "batch_size": len(jobs),
+            }
+            if job.return_v:
+                result["v"] = [[json_float(x) for x in row] for row in final[k, 2].cpu().tolist()]
+            results.append(result)
+        return results
+
+    def stats(self):
+        latencies = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        return {
+            "queue_depth": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "served": self.served,
+            "failed": self.failed,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "latency_ms": {"p50": p50, "p90": p90, "p99": p99, "max": latencies.max()},
+            "models": list(self.models),
+        }
+
+
+async def read_request(reader):
+    """(method, path, body) of an HTTP/1.1 request, None on a closed connection."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, path, _ = line.decode().split(" ", 2)
+    headers = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, value = header.decode().split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, body
+
+
+def write_head(writer, status, content_type, length=None):
+    head = f"HTTP/1.1 {STATUS[status]}\r\nContent-Type: {content_type}\r\nConnection: close\r\n"
+    head += f"Content-Length: {length}\r\n" if length is not None else "Transfer-Encoding: chunked\r\n"
+    writer.write((head + "\r\n").encode())
+
+
+def write_json(writer, status, payload):
+    body = json.dumps(payload, allow_nan=False).encode()
+    write_head(writer, status, "application/json", len(body))
+    writer.write(body)
+
+
+async def stream_results(writer, service, jobs):
+    """Stream one JSON line per job of a list request, in completion order (chunked encoding)."""
+
+    async def indexed(k, job):
+        try:
+            return {"index": k, **(await service.submit(job))}
+        except Exception as e:
+            return {"index": k, "error": str(e)}
+
+    write_head(writer, 200, "application/x-ndjson")
+    for result in asyncio.as_completed([indexed(k, job) for k, job in enumerate(jobs)]):
+        line = (json.dumps(await result, allow_nan=False) + "\n").encode()
+        writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+
+
+def make_handler(service):
+    async def handle(reader, writer):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+            if method == "GET" and path == "/stats":
+                write_json(writer, 200, service.stats())
+            elif method == "POST" and path == "/control":
+                try:
+                    payload = json.loads(body)
+                    many = isinstance(payload, list)
+                    jobs = [service.parse(r) for r in (payload if many else [payload])]
+                except (ValueError, TypeError) as e:
+                    write_json(writer, 400, {"error": str(e)})
+                else:
+                    if many:
+                        await stream_results(writer, service, jobs)
+                    else:
+                        try:
+                            write_json(writer, 200, await service.submit(jobs[0]))
+                        except Exception as e:
+                            write_json(writer, 500, {"error": str(e)})
+            else:
+                write_json(writer, 404, {"error": f"no route {method} {path}"})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+def load_models(specs, arch, diffusion_steps, device, attention_backend="auto"):
+    """{name: (model, diffusion)} from NAME=CKPT specs, with the prediction target of each checkpoint."""
+    models = {}
+    for spec in specs:
+        name, _, ckpt = spec.rpartition("=")
+        prediction = (read_metadata(ckpt).get("prediction") if ckpt else None) or "eps"
+        model = load_model(arch, ckpt or None, device, attention_backend)
+        models[name or "default"] = (model, GuassianDiffusion(diffusion_steps, device, prediction=prediction))
+    return models
+
+
+async def serve(service, args):
+    handler = make_handler(service)
+    if args.socket:
+        server = await asyncio.start_unix_server(handler, path=args.socket)
+        where = args.socket
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        where = f"http://{args.host}:{args.port}"
+    print(f"Serving {list(service.models)} on {where}")
+    worker = asyncio.create_task(service.run())
+    async with server:
+        await server.serve_forever()
+    worker.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser("Resident controller synthesis service")
+    parser.add_argument(
+        "--model",
+        action="append",
+        default=None,
+        help="NAME=CKPT of a resident model, repeat for several (default: one untrained model)",
+    )
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--attention-backend", type=str, default="auto", choices=unets.ATTENTION_BACKENDS)
+    parser.add_argument("--diffusion-steps", type=int, default=1000)
+    parser.add_argument("--sampling-steps", type=int, default=250, help="Default steps of a request")
+    parser.add_argument(
+        "--batch-window-ms", type=float, default=10, help="Wait for more requests to batch with the first one"
+    )
+    parser.add_argument("--max-batch", type=int, default=32, help="Largest number of systems per reverse pass")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", type=str, default=None, help="Serve on this Unix socket instead")
+    parser.add_argument("--device", type=str, default=None, help="Default: cuda if available")
+    parser.add_argument("--seed", type=int, default=112233)
+    args = parser.parse_args()
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.seed)
+    # NoisyPendulum draws its parameter noise from numpy
+    np.random.seed(args.seed)
+    models = load_models(args.model or ["default="], args.arch, args.diffusion_steps, device, args.attention_backend)
+    service = ControlService(models, args.sampling_steps, args.batch_window_ms / 1000, args.max_batch)
+    try:
+        asyncio.run(serve(service, args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
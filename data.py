@@ -1,12 +1,12 @@
 import os
 import numpy as np
 import torch
-from PIL import Image
-import scipy, scipy.io
 from easydict import EasyDict
 from collections import OrderedDict
 from torch.utils.data import Dataset
-from torchvision import datasets, transforms
+
+# torchvision, scipy and PIL are imported where the image datasets need them, so
+# that get_metadata / fix_legacy_dict stay cheap to import (e.g. for control jobs)
 
 
 def get_metadata(name):
@@ -145,6 +145,8 @@ class oxford_flowers_dataset(Dataset):
         return len(self.images)
 
     def __getitem__(self, idx):
+        from PIL import Image
+
         image = Image.open(self.images[idx]).convert("RGB")
         target = self.targets[idx]
         if self.transform is not None:
@@ -175,8 +177,8 @@ class PoissonDataset(Dataset):
         return data
 
 class LyapunovDataset(Dataset):
-    def __init__(self, transform=None):
-        self.folder_path = "dataset/Lyapunov"
+    def __init__(self, transform=None, folder_path="dataset/Lyapunov"):
+        self.folder_path = folder_path
         self.file_list = [file for file in os.listdir(self.folder_path) if file.endswith('.pt') and "test" not in file]
         self.transform = transform
 
@@ -206,6 +208,9 @@ def get_dataset(name, data_dir, metadata):
     Note: To avoid learning the distribution of transformed data, don't use heavy
         data augmentation with diffusion models.
     """
+    import scipy.io
+    from torchvision import datasets, transforms
+
     if name == "mnist":
         transform_train = transforms.Compose(
             [
@@ -328,12 +333,8 @@ def get_dataset(name, data_dir, metadata):
             transform=transform_train,
         )
     elif name == "lyapunov":
-        transform_train = transforms.Compose(
-            [
-                transforms.RandomVerticalFlip(),
-                transforms.RandomHorizontalFlip(),
-            ]
-        )
+        # image flips would not turn the vectors of (f1, f2), the symmetries are
+        # applied to whole batches on the device instead (augmentation.py, --augment)
         train_set = LyapunovDataset(
             transform=None,
         )
@@ -0,0 +1,111 @@
+"""
+Process group setup and DDP wrapping for single-process, torchrun and elastic runs.
+
+Launch multi-process training with torchrun, e.g. on one node
+
+    torchrun --nproc_per_node 4 main.py ...
+
+or elastically (restarted workers resume from the latest training checkpoint)
+
+    torchrun --nnodes 1:4 --max-restarts 3 --rdzv-backend c10d --rdzv-endpoint host:29400 main.py ...
+
+The rank and world size come from the environment set by the launcher (RANK,
+LOCAL_RANK, WORLD_SIZE), with a fallback to --local-rank for the deprecated
+torch.distributed.launch. Processes use cuda:LOCAL_RANK and nccl when CUDA is
+available and the CPU with gloo otherwise, so the same command runs data-parallel
+on a GPU node, a CPU build farm or a laptop.
+"""
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+COMM_HOOKS = {
+    "none": None,
+    "fp16": default_hooks.fp16_compress_hook,
+    "bf16": default_hooks.bf16_compress_hook,
+}
+
+
+def add_distributed_args(parser):
+    parser.add_argument(
+        "--local-rank",
+        "--local_rank",
+        default=None,
+        type=int,
+        help="Set by torch.distributed.launch (torchrun sets LOCAL_RANK instead)",
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="cuda or cpu (default: cuda if available)"
+    )
+    parser.add_argument(
+        "--dist-backend",
+        type=str,
+        default=None,
+        choices=["nccl", "gloo"],
+        help="Process group backend (default: nccl on cuda, gloo on cpu)",
+    )
+    parser.add_argument(
+        "--ddp-bucket-mb", type=float, default=25, help="Size of the DDP gradient buckets in MB"
+    )
+    parser.add_argument(
+        "--ddp-static-graph",
+        action="store_true",
+        default=False,
+        help="Tell DDP that the set of used parameters never changes between steps",
+    )
+    parser.add_argument(
+        "--ddp-comm-hook",
+        type=str,
+        default="none",
+        choices=list(COMM_HOOKS),
+        help="Compress gradients to fp16 / bf16 for the all-reduce",
+    )
+
+
+def setup_distributed(args):
+    """
+    Set args.rank, args.local_rank, args.world_size and args.device, and initialize
+    the process group when started by a launcher (torchrun sets MASTER_ADDR), also
+    for a single process.
+    """
+    args.local_rank = int(os.environ.get("LOCAL_RANK", args.local_rank or 0))
+    args.rank = int(os.environ.get("RANK", args.local_rank))
+    args.world_size = int(os.environ.get("WORLD_SIZE", 1))
+    device_type = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    if device_type == "cuda":
+        args.device = f"cuda:{args.local_rank}"
+        torch.cuda.set_device(args.device)
+    else:
+        args.device = device_type
+    args.dist_backend = args.dist_backend or ("nccl" if device_type == "cuda" else "gloo")
+    if (args.world_size > 1 or "MASTER_ADDR" in os.environ) and not dist.is_initialized():
+        dist.init_process_group(backend=args.dist_backend, init_method="env://")
+        if args.rank == 0:
+            print(
+                f"Using distributed training on {args.world_size} processes ({args.dist_backend}, {device_type})."
+            )
+    # torchrun restarts every worker of an elastic job after a failure
+    args.restart_count = int(os.environ.get("TORCHELASTIC_RESTART_COUNT", 0))
+
+
+def wrap_ddp(model, args):
+    """Wrap `model` in DDP with the bucket size, static graph and gradient compression of args."""
+    cuda = torch.device(args.device).type == "cuda"
+    model = DDP(
+        model,
+        device_ids=[args.local_rank] if cuda else None,
+        output_device=args.local_rank if cuda else None,
+        bucket_cap_mb=args.ddp_bucket_mb,
+        static_graph=args.ddp_static_graph,
+    )
+    if COMM_HOOKS[args.ddp_comm_hook] is not None:
+        model.register_comm_hook(None, COMM_HOOKS[args.ddp_comm_hook])
+    return model
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
@@ -0,0 +1,161 @@
+"""
+Background evaluation of EMA snapshots during training.
+
+The training loop submits a copy of the EMA weights every `--eval-every` epochs
+and carries on. A worker thread loads the snapshot into its own copy of the
+model, samples from it on a separate CUDA stream and writes the samples and
+their metrics. Only the latest pending snapshot is kept, so a slow evaluation
+skips epochs instead of stalling training.
+"""
+import os
+import copy
+import json
+import queue
+import threading
+import numpy as np
+from time import time
+
+import cv2
+import torch
+
+from data import fix_legacy_dict
+from roa import lie_derivative, estimate_roa_from_stack
+from sample_writer import sample_noise
+
+
+def lyapunov_metrics(img, extent=(-1.0, 1.0), origin_radius=2):
+    """
+    Metrics of a batch of sampled (f1, f2, V) stacks, averaged over the batch.
+
+    decrease_rate: fraction of grid points (away from the origin) where V dot < 0.
+    positive_rate: fraction of grid points (away from the origin) where V > V(origin).
+    roa_area: area of the region of attraction certified by the samples (roa.py).
+    """
+    img = img.float()
+    n, _, h, w = img.shape
+    V, f = img[:, 2], img[:, :2]
+    ys, xs = torch.meshgrid(
+        torch.arange(h, device=img.device) - (h - 1) / 2,
+        torch.arange(w, device=img.device) - (w - 1) / 2,
+        indexing="ij",
+    )
+    away = (xs ** 2 + ys ** 2) > origin_radius ** 2
+    V0 = V[:, (h - 1) // 2, (w - 1) // 2][:, None, None]
+    return {
+        "decrease_rate": (lie_derivative(V, f, extent) < 0)[:, away].float().mean().item(),
+        "positive_rate": (V > V0)[:, away].float().mean().item(),
+        "roa_area": estimate_roa_from_stack(img).area.mean().item(),
+    }
+
+
+class EvalWorker:
+    """
+    Sample from EMA snapshots on a background thread.
+
+    :param model: the model being trained. Its architecture is copied, not its weights.
+    :param diffusion: GuassianDiffusion of the training run.
+    :param args: all args from the argparser. Uses the sampling, dataset and save settings.
+    :param shape: (C, H, W) of the samples seen by the model (latents in latent mode).
+    :param num_samples: number of samples per evaluation (with fixed noise across evaluations).
+    """
+
+    def __init__(self, model, diffusion, args, shape, num_samples=64, device=None):
+        self.args = args
+        self.shape = shape
+        self.num_samples = num_samples
+        self.device = device or args.device
+        self.model = copy.deepcopy(getattr(model, "module", model)).to(self.device).eval()
+        self.model.requires_grad_(False)
+        self.diffusion = type(diffusion)(
+            diffusion.timesteps, self.device, prediction=diffusion.prediction
+        )
+        self.diffusion.clamp_x0 = diffusion.clamp_x0
+        self.stream = (
+            torch.cuda.Stream(self.device) if torch.device(self.device).type == "cuda" else None
+        )
+        self.log_path = os.path.join(
+            args.save_dir, f"{args.arch}_{args.run_name}-class_condn_{args.class_cond}-eval.jsonl"
+        )
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, epoch, ema_dict):
+        """Queue a copy of `ema_dict`, replacing a pending one. Never blocks on sampling."""
+        self.check()
+        snapshot = {k: v.detach().clone() for k, v in ema_dict.items()}
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.queue.put_nowait((epoch, snapshot, event))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                if self.stream is None:
+                    self.evaluate(*item)
+                else:
+                    with torch.cuda.stream(self.stream):
+                        self.evaluate(*item)
+            except Exception as e:
+                self.error = e
+                return
+
+    def evaluate(self, epoch, snapshot, event):
+        args = self.args
+        if event is not None:
+            self.stream.wait_event(event)
+        start = time()
+        self.model.load_state_dict(fix_legacy_dict(snapshot))
+        xT, y = sample_noise(
+            range(self.num_samples),
+            self.shape,
+            args.seed,
+            self.model.num_classes if args.class_cond else None,
+            self.device,
+        )
+        # own generator, the global RNG belongs to the training thread
+        generator = torch.Generator(self.device).manual_seed(args.seed + epoch)
+        samples = self.diffusion.sample_from_reverse_process(
+            self.model, xT, args.sampling_steps, {"y": y}, args.ddim, generator=generator
+        )
+        if getattr(args, "autoencoder", None) is not None:
+            with torch.no_grad():
+                samples = args.autoencoder.decode(samples.to(args.device))
+        metrics = {"epoch": epoch}
+        prefix = os.path.join(
+            args.save_dir,
+            f"{args.arch}_{args.run_name}-{args.diffusion_steps}_steps-{args.sampling_steps}-sampling_steps-class_condn_{args.class_cond}",
+        )
+        if args.dataset == "lyapunov":
+            metrics.update(lyapunov_metrics(samples))
+        if args.dataset in ["poisson", "lyapunov"]:
+            torch.save(samples.cpu(), prefix + ".pt")
+        else:
+            images = samples.cpu().numpy().transpose(0, 2, 3, 1)
+            images = (127.5 * (images + 1)).clip(0, 255).astype(np.uint8)
+            cv2.imwrite(prefix + ".png", np.concatenate(images, axis=1)[:, :, ::-1])
+        metrics["eval_s"] = time() - start
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(metrics) + "\n")
+        print(f"Eval (epoch {epoch}): {metrics}")
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("evaluation worker failed") from self.error
+
+    def close(self):
+        """Wait for the pending evaluation and stop the worker."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
@@ -0,0 +1,234 @@
+"""
+Export UNetModel, or a fused denoise step, to TorchScript and ONNX, and load the
+exported graphs back as denoisers for the sampling and control loops.
+
+Every exported file gets a json sidecar (<path>.json) describing what it holds:
+    kind: "model" (x, t) -> model output (see prediction), or "step" (x_t, step) -> (pred_eps, pred_x0).
+    prediction: what a "model" graph predicts (eps, v or x0, see objectives.py).
+    format: "torchscript" or "onnx".
+    batch_size: the static batch size, or null if the batch dimension is dynamic.
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+import torch
+from torch import nn
+
+import unets
+import sampling
+from data import get_metadata, fix_legacy_dict
+from checkpoint import read_metadata
+
+EXPORT_FORMATS = ("torchscript", "onnx")
+
+
+def example_inputs(kind, batch_size, num_channels, image_size, device="cpu"):
+    x = torch.randn(batch_size, num_channels, image_size, image_size, device=device)
+    if kind == "step":
+        return x, torch.zeros(batch_size, dtype=torch.int64, device=device)
+    return x, torch.randint(1000, (batch_size,), device=device)
+
+
+def export(module, path, fmt, kind, batch_size, num_channels, image_size, dynamic_batch=True, extra={}):
+    """
+    Export `module` (a UNetModel or a sampling.DenoiseStep) and write its sidecar.
+
+    :param dynamic_batch: if False, the graph is specialized to `batch_size`.
+    """
+    module = getattr(module, "module", module).eval()
+    # the exporters specialize size-1 dimensions, so a dynamic batch is traced with 2
+    inputs = example_inputs(kind, max(batch_size, 2) if dynamic_batch else batch_size, num_channels, image_size)
+    input_names = ["x", "t"] if kind == "model" else ["x_t", "step"]
+    output_names = ["pred_eps"] if kind == "model" else ["pred_eps", "pred_x0"]
+    with torch.no_grad():
+        if fmt == "torchscript":
+            graph = torch.jit.trace(module, inputs)
+            if not dynamic_batch:
+                graph = torch.jit.freeze(graph)
+            torch.jit.save(graph, path)
+        elif fmt == "onnx":
+            torch.onnx.export(
+                module,
+                inputs,
+                path,
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes={n: {0: "batch"} for n in input_names + output_names}
+                if dynamic_batch
+                else None,
+                opset_version=18,
+            )
+        else:
+            raise ValueError(f"unsupported export format: {fmt}")
+    meta = {
+        "kind": kind,
+        "format": fmt,
+        "batch_size": None if dynamic_batch else batch_size,
+        "num_channels": num_channels,
+        "image_size": image_size,
+        **extra,
+    }
+    with open(path + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class ExportedDenoiser(nn.Module):
+    """
+    An exported model or denoise step, called like UNetModel. Exported steps are
+    called with the step index of their schedule (like unets.FrozenUNet) and only
+    return pred_eps here, so the samplers can keep deriving x0 themselves.
+    """
+
+    def __init__(self, path, device="cpu"):
+        super().__init__()
+        with open(path + ".json") as f:
+            self.meta = json.load(f)
+        self.device = device
+        self.takes_step_index = self.meta["kind"] == "step"
+        if self.meta["format"] == "torchscript":
+            self.graph = torch.jit.load(path, map_location=device)
+        else:
+            import onnxruntime as ort
+
+            providers = (
+                ["CUDAExecutionProvider", "CPUExecutionProvider"]
+                if torch.device(device).type == "cuda"
+                else ["CPUExecutionProvider"]
+            )
+            self.session = ort.InferenceSession(path, providers=providers)
+
+    def run(self, x, t):
+        """Return all outputs of the graph as a tuple of tensors."""
+        if self.meta["format"] == "torchscript":
+            out = self.graph(x, t)
+            return out if isinstance(out, tuple) else (out,)
+        names = [i.name for i in self.session.get_inputs()]
+        out = self.session.run(
+            None,
+            {
+                names[0]: x.detach().cpu().numpy().astype(np.float32),
+                names[1]: t.detach().cpu().numpy().astype(np.int64),
+            },
+        )
+        return tuple(torch.from_numpy(o).to(x.device) for o in out)
+
+    def forward(self, x, t, y=None):
+        assert y is None, "exported models are not class-conditional"
+        return self.run(x, t)[0]
+
+
+def load_denoiser(backend, path, device="cpu"):
+    """Return an ExportedDenoiser, checking that `path` holds the requested format."""
+    denoiser = ExportedDenoiser(path, device)
+    assert (
+        denoiser.meta["format"] == backend
+    ), f"{path} holds a {denoiser.meta['format']} graph, not {backend}"
+    return denoiser
+
+
+def randomize_zero_modules(model):
+    """
+    Re-initialize the modules built by unets.zero_module (output convs of the ResBlocks,
+    attention and the UNet), so that an untrained model has a non-zero output to check.
+    """
+    for module in model.modules():
+        weight = getattr(module, "weight", None)
+        if isinstance(module, nn.modules.conv._ConvNd) and not weight.detach().any():
+            module.reset_parameters()
+    return model
+
+
+def check_parity(exported, reference, kind, batch_sizes, num_channels, image_size, atol=1e-4):
+    """
+    Compare the outputs of an exported graph with the eager module.
+
+    Return: dict of max absolute error per batch size.
+    """
+    errors = {}
+    with torch.no_grad():
+        for b in batch_sizes:
+            inputs = example_inputs(kind, b, num_channels, image_size)
+            ref = reference(*inputs)
+            ref = ref if isinstance(ref, tuple) else (ref,)
+            assert any(r.any() for r in ref), "the reference output is all zero, the check would pass for any graph"
+            out = exported.run(*inputs)
+            errors[b] = max((r - o).abs().max().item() for r, o in zip(ref, out))
+            assert errors[b] <= atol, f"batch {b}: max abs error {errors[b]} > {atol}"
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser("Export the denoiser to TorchScript / ONNX")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--dataset", type=str, default="lyapunov")
+    parser.add_argument("--pretrained-ckpt", type=str, help="Pretrained model ckpt")
+    parser.add_argument("--format", type=str, default="onnx", choices=EXPORT_FORMATS)
+    parser.add_argument("--kind", type=str, default="model", choices=["model", "step"])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument(
+        "--static-batch",
+        action="store_true",
+        default=False,
+        help="Specialize the graph to --batch-size instead of a dynamic batch dimension",
+    )
+    parser.add_argument("--diffusion-steps", type=int, default=1000)
+    parser.add_argument("--sampling-steps", type=int, default=250, help="Schedule of an exported step")
+    parser.add_argument("--save-path", type=str, required=True)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    metadata = get_metadata(args.dataset)
+    model = unets.__dict__[args.arch](
+        image_size=metadata.image_size,
+        in_channels=metadata.num_channels,
+        out_channels=metadata.num_channels,
+        attention_backend="einsum",
+    )
+    if args.pretrained_ckpt:
+        model.load_state_dict(fix_legacy_dict(torch.load(args.pretrained_ckpt, map_location="cpu")))
+    else:
+        # a fresh UNet ends in a zero conv, its output would be zero for any input
+        randomize_zero_modules(model)
+    model.eval()
+    prediction = read_metadata(args.pretrained_ckpt).get("prediction", "eps")
+
+    module, extra = model, {"arch": args.arch, "prediction": prediction}
+    if args.kind == "step":
+        from main import GuassianDiffusion
+
+        # the step converts the model output, so exported steps always return eps
+        diffusion = GuassianDiffusion(args.diffusion_steps, "cpu", prediction=prediction)
+        module = sampling.DenoiseStep(model, diffusion, args.sampling_steps)
+        extra["sampling_steps"] = args.sampling_steps
+        extra["diffusion_steps"] = args.diffusion_steps
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.save_path)), exist_ok=True)
+    export(
+        module,
+        args.save_path,
+        args.format,
+        args.kind,
+        args.batch_size,
+        metadata.num_channels,
+        metadata.image_size,
+        not args.static_batch,
+        extra,
+    )
+    batch_sizes = [args.batch_size] if args.static_batch else [1, args.batch_size + 1]
+    errors = check_parity(
+        ExportedDenoiser(args.save_path),
+        module,
+        args.kind,
+        batch_sizes,
+        metadata.num_channels,
+        metadata.image_size,
+        args.atol,
+    )
+    print(f"Exported {args.arch} ({args.kind}) to {args.save_path}, max abs error vs eager: {errors}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,29 @@ import torch
 import torch.distributed as dist
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
-from torch.nn.parallel import DistributedDataParallel as DDP
 
+from distributed import add_distributed_args, setup_distributed, cleanup_distributed
+from sharding import (
+    SHARDING,
+    wrap_model,
+    create_optimizer,
+    init_ema,
+    update_ema,
+    gradient_sync,
+    consolidated_state,
+    load_state,
+)
 from data import get_metadata, get_dataset, fix_legacy_dict
+from autoencoder import FieldAutoencoder, load_autoencoder
+from evaluation import EvalWorker
+from metrics import TrainingMetrics
+from augmentation import AUGMENTATIONS, augment_fields
+from autobatch import probe_max_batch, training_step, sampling_step, accumulation
+from timestep_sampler import TIMESTEP_SAMPLERS, create_timestep_sampler
+from checkpoint import CheckpointManager, training_state, resume, read_metadata
+from sample_writer import ShardWriter, all_gather, sample_noise, world_info
+import objectives
+import sampling
 import unets
 
 unsqueeze3x = lambda x: x[..., None, None, None]
@@ -22,12 +42,16 @@ unsqueeze3x = lambda x: x[..., None, None, None]
 
 class GuassianDiffusion:
     """Gaussian diffusion process with 1) Cosine schedule for beta values (https://arxiv.org/abs/2102.09672)
-    2) L_simple training objective from https://arxiv.org/abs/2006.11239.
+    2) L_simple training objective from https://arxiv.org/abs/2006.11239, on an eps, v or x0
+    prediction target (objectives.py).
     """
 
-    def __init__(self, timesteps=1000, device="cuda:0"):
+    def __init__(self, timesteps=1000, device="cuda:0", compile_cache_dir=None, prediction="eps"):
         self.timesteps = timesteps
+        self.prediction = prediction
         self.device = device
+        self.compile_cache_dir = compile_cache_dir
+        self.reverse_steps = {}
         self.alpha_bar_scheduler = (
             lambda t: math.cos((t / self.timesteps + 0.008) / 1.008 * math.pi / 2) ** 2
         )
@@ -91,19 +115,73 @@ class GuassianDiffusion:
         all_scalars["beta_tilde_log"] = torch.log(all_scalars["beta_tilde"])
         return EasyDict(dict([(k, v.float()) for (k, v) in all_scalars.items()]))
 
-    def sample_from_forward_process(self, x0, t):
+    def sample_from_forward_process(self, x0, t, eps=None):
         """Single step of the forward process, where we add noise in the image.
         Note that we will use this paritcular realization of noise vector (eps) in training.
+        A given eps (e.g. antithetic pairs) is used instead of a fresh draw.
         """
-        eps = torch.randn_like(x0)
+        eps = torch.randn_like(x0) if eps is None else eps
         xt = (
             unsqueeze3x(self.scalars.alpha_bar[t].sqrt()) * x0
             + unsqueeze3x((1 - self.scalars.alpha_bar[t]).sqrt()) * eps
         )
         return xt.float(), eps
 
+    def get_target(self, x0, eps, t):
+        """Training target of the model for its prediction type (see objectives.py)."""
+        return objectives.training_target(self.prediction, self.scalars.alpha_bar[t], x0, eps)
+
+    def get_eps_x0(self, xt, output, t, scalars):
+        """Convert a model output at step t of `scalars` to (pred_eps, clamped pred_x0)."""
+        return objectives.eps_x0_from_output(
+            self.prediction, scalars.alpha_bar[t], xt, output, self.clamp_x0
+        )
+
+    def get_loss_weights(self, t, min_snr_gamma=None):
+        return objectives.min_snr_weights(self.prediction, self.scalars.alpha_bar[t], min_snr_gamma)
+
+    def get_sampling_scalars(self, timesteps=None):
+        """Scalars of the sub-sampled schedule used by the reverse process.
+
+        Return: the sub-sampled timesteps (of the full process) and their scalars.
+        """
+        timesteps = timesteps or self.timesteps
+        new_timesteps = np.linspace(
+            0, self.timesteps - 1, num=timesteps, endpoint=True, dtype=int
+        )
+        alpha_bar = self.scalars["alpha_bar"][new_timesteps]
+        new_betas = 1 - (
+            alpha_bar / torch.nn.functional.pad(alpha_bar, [1, 0], value=1.0)[:-1]
+        )
+        scalars = self.get_all_scalars(
+            self.alpha_bar_scheduler, timesteps, self.device, new_betas
+        )
+        return new_timesteps, scalars
+
+    def get_reverse_step(self, model, timesteps=None, ddim=False, compiled=False):
+        """Return the (optionally compiled) reverse step for a model and schedule.
+
+        Compiled steps are cached, so that graphs are only built once per model,
+        schedule and update rule.
+        """
+        new_timesteps, scalars = self.get_sampling_scalars(timesteps)
+        key = (id(model), len(new_timesteps), ddim, compiled)
+        if key not in self.reverse_steps:
+            step = sampling.ReverseStep(model, self, scalars, ddim)
+            if compiled:
+                step = sampling.compile_module(step, self.device, self.compile_cache_dir)
+            self.reverse_steps[key] = step
+        return self.reverse_steps[key], new_timesteps
+
     def sample_from_reverse_process(
-        self, model, xT, timesteps=None, model_kwargs={}, ddim=False
+        self,
+        model,
+        xT,
+        timesteps=None,
+        model_kwargs={},
+        ddim=False,
+        compiled=False,
+        generator=None,
     ):
         """Sampling images by iterating over all timesteps.
 
@@ -114,6 +192,10 @@ class GuassianDiffusion:
         model_kwargs: Additional kwargs for model (using it to feed class label for conditioning)
         ddim: Use ddim sampling (https://arxiv.org/abs/2010.02502). With very small number of
             sampling steps, use ddim sampling for better image quality.
+        compiled: Run every step (UNet + update) through a torch.compile'd graph. Input shapes
+            must stay fixed across calls to reuse the compiled graph.
+        generator: Optional torch.Generator (on the device of xT) for the noise of the
+            non-DDIM update, instead of the global RNG.
 
         Return: An image tensor with identical shape as XT.
         """
@@ -122,45 +204,27 @@ class GuassianDiffusion:
 
         # sub-sampling timesteps for faster sampling
         timesteps = timesteps or self.timesteps
-        new_timesteps = np.linspace(
-            0, self.timesteps - 1, num=timesteps, endpoint=True, dtype=int
-        )
-        alpha_bar = self.scalars["alpha_bar"][new_timesteps]
-        new_betas = 1 - (
-            alpha_bar / torch.nn.functional.pad(alpha_bar, [1, 0], value=1.0)[:-1]
-        )
-        scalars = self.get_all_scalars(
-            self.alpha_bar_scheduler, timesteps, self.device, new_betas
-        )
+        step, new_timesteps = self.get_reverse_step(model, timesteps, ddim, compiled)
 
         for i, t in zip(np.arange(timesteps)[::-1], new_timesteps[::-1]):
             with torch.no_grad():
                 current_t = torch.tensor([t] * len(final), device=final.device)
                 current_sub_t = torch.tensor([i] * len(final), device=final.device)
-                pred_epsilon = model(final, current_t, **model_kwargs)
-                # using xt+x0 to derive mu_t, instead of using xt+eps (former is more stable)
-                pred_x0 = self.get_x0_from_xt_eps(
-                    final, pred_epsilon, current_sub_t, scalars
+                noise = (
+                    torch.zeros_like(final)
+                    if ddim or i == 0
+                    else torch.randn(
+                        final.shape, generator=generator, device=final.device, dtype=final.dtype
+                    )
                 )
-                pred_mean = self.get_pred_mean_from_x0_xt(
-                    final, pred_x0, current_sub_t, scalars
+                if compiled:
+                    sampling.mark_step(self.device)
+                pred_mean, prev = step(
+                    final, current_t, current_sub_t, noise, **model_kwargs
                 )
-                if i == 0:
-                    final = pred_mean
-                else:
-                    if ddim:
-                        final = (
-                            unsqueeze3x(scalars["alpha_bar"][current_sub_t - 1]).sqrt()
-                            * pred_x0
-                            + (
-                                1 - unsqueeze3x(scalars["alpha_bar"][current_sub_t - 1])
-                            ).sqrt()
-                            * pred_epsilon
-                        )
-                    else:
-                        final = pred_mean + unsqueeze3x(
-                            scalars.beta_tilde[current_sub_t].sqrt()
-                        ) * torch.randn_like(final)
+                final = pred_mean if i == 0 else prev
+                if compiled and sampling.uses_cudagraphs(self.device):
+                    final = final.clone()
                 final = final.detach()
         return final
 
@@ -187,51 +251,146 @@ class loss_logger:
             )
 
 
+def warmup_cosine(optimizer, warmup_steps, total_steps, min_lr_ratio=0.0, cosine=True):
+    """LR scheduler (stepped once per optimizer step): linear warmup, then cosine decay to min_lr_ratio * lr."""
+
+    def factor(step):
+        if step < warmup_steps:
+            return (step + 1) / warmup_steps
+        if not cosine:
+            return 1.0
+        progress = min(1.0, (step - warmup_steps) / max(1, total_steps - warmup_steps))
+        return min_lr_ratio + (1 - min_lr_ratio) * 0.5 * (1 + math.cos(math.pi * progress))
+
+    return torch.optim.lr_scheduler.LambdaLR(optimizer, factor)
+
+
 def train_one_epoch(
     model,
     dataloader,
     diffusion,
     optimizer,
-    logger,
+    metrics,
     lrs,
     args,
 ):
+    """One pass over the dataloader, with an optimizer step every args.grad_accum batches."""
     model.train()
+    accum = getattr(args, "grad_accum", 1)
     for step, images in enumerate(dataloader):
-        # must use [-1, 1] pixel range for images
-        if args.dataset in ["poisson","lyapunov"]:
-            images, labels = (
-                images.to(args.device),
-                labels.to(args.device) if args.class_cond else None,
-            )
-        else:
-            images, labels = images
-            assert (images.max().item() <= 1) and (0 <= images.min().item())
-            images, labels = (
-                2 * images.to(args.device) - 1,
-                labels.to(args.device) if args.class_cond else None,
+        # the last group of an epoch may hold fewer batches
+        group = min(accum, len(dataloader) - step // accum * accum)
+        last = (step + 1) % accum == 0 or step + 1 == len(dataloader)
+        metrics.data_loaded()
+        with metrics.phase("preprocess"):
+            # must use [-1, 1] pixel range for images
+            if args.dataset in ["poisson","lyapunov"]:
+                images, labels = (
+                    images.to(args.device),
+                    labels.to(args.device) if args.class_cond else None,
+                )
+            else:
+                images, labels = images
+                assert (images.max().item() <= 1) and (0 <= images.min().item())
+                images, labels = (
+                    2 * images.to(args.device) - 1,
+                    labels.to(args.device) if args.class_cond else None,
+                )
+            if images.shape[-1] != args.image_size:
+                # fields are sampled on a meshgrid of [-1, 1]^2, align_corners keeps the grid end points
+                images = torch.nn.functional.interpolate(
+                    images, size=args.image_size, mode="bilinear", align_corners=True
+                )
+            # symmetries of the phase plane, with the matching transform of (f1, f2, V)
+            images = augment_fields(images, args.augment)
+            if args.autoencoder is not None:
+                with torch.no_grad():
+                    images = args.autoencoder.encode(images)
+            # variance reduction: several (t, eps) draws per image, optionally as +-eps pairs
+            num_images = len(images)
+            draws = args.draws_per_image * (2 if args.antithetic else 1)
+            if draws > 1:
+                images = images.repeat_interleave(draws, dim=0)
+                labels = labels.repeat_interleave(draws, dim=0) if labels is not None else None
+            t, weights = args.schedule_sampler.sample(
+                num_images * args.draws_per_image, args.device, args.stratified_timesteps
             )
-        t = torch.randint(diffusion.timesteps, (len(images),), dtype=torch.int64).to(
-            args.device
-        )
-        xt, eps = diffusion.sample_from_forward_process(images, t)
-        pred_eps = model(xt, t, y=labels)
+            eps = None
+            if args.antithetic:
+                t, weights = t.repeat_interleave(2), weights.repeat_interleave(2)
+                eps = torch.randn_like(images[::2])
+                eps = torch.stack([eps, -eps], dim=1).flatten(0, 1)
+            xt, eps = diffusion.sample_from_forward_process(images, t, eps)
 
-        loss = ((pred_eps - eps) ** 2).mean()
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        if lrs is not None:
-            lrs.step()
+        with metrics.phase("forward"):
+            output = model(xt, t, y=labels)
+            target = diffusion.get_target(images, eps, t)
+            losses = ((output - target) ** 2).mean(dim=(1, 2, 3))
+            losses = losses * diffusion.get_loss_weights(t, args.min_snr_gamma)
+            # importance weights keep the loss unbiased under non-uniform timesteps
+            loss = (losses * weights).mean()
+            args.schedule_sampler.update(t, losses)
+        with metrics.phase("backward"):
+            # gradients are only all-reduced on the last batch of a group
+            with gradient_sync(model, last):
+                (loss / group).backward()
+        if not last:
+            metrics.end_step(num_images, loss)
+            continue
+        with metrics.phase("optimizer"):
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            if lrs is not None:
+                lrs.step()
 
         # update ema_dict
-        if args.local_rank == 0:
-            new_dict = model.state_dict()
-            for (k, v) in args.ema_dict.items():
-                args.ema_dict[k] = (
-                    args.ema_w * args.ema_dict[k] + (1 - args.ema_w) * new_dict[k]
-                )
+        with metrics.phase("ema"):
+            update_ema(args.ema_dict, model, args)
+        metrics.end_step(num_images, loss)
+
+
+def train_autoencoder(args, metadata):
+    """Train a FieldAutoencoder on the dataset, for latent diffusion (--autoencoder-ckpt)."""
+    train_set = get_dataset(args.dataset, args.data_dir, metadata)
+    train_loader = DataLoader(
+        train_set,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=4,
+        pin_memory=True,
+    )
+    ae = FieldAutoencoder(metadata.num_channels, args.latent_channels).to(args.device)
+    optimizer = torch.optim.AdamW(ae.parameters(), lr=args.lr)
+    logger = loss_logger(len(train_loader) * args.epochs)
+
+    def prepare(images):
+        # same [-1, 1] range and resolution as in train_one_epoch
+        if args.dataset not in ["poisson", "lyapunov"]:
+            images = 2 * images[0] - 1
+        return torch.nn.functional.interpolate(
+            images.to(args.device), size=args.image_size, mode="bilinear", align_corners=True
+        )
+
+    for epoch in range(args.epochs):
+        ae.train()
+        for step, images in enumerate(train_loader):
+            images = prepare(images)
+            loss = ((ae(images) - images) ** 2).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
             logger.log(loss.item(), display=not step % 100)
+        ae.eval()
+        ae.set_scale_factor(
+            prepare(images) for _, images in zip(range(16), train_loader)
+        )
+        torch.save(
+            ae.state_dict(),
+            os.path.join(
+                args.save_dir,
+                f"autoencoder_{args.run_name}-latent_{args.latent_channels}-epoch_{args.epochs}.pt",
+            ),
+        )
 
 
 def sample_N_images(
@@ -245,61 +404,80 @@ def sample_N_images(
     image_size=32,
     num_classes=None,
     args=None,
+    writer=None,
 ):
     """use this function to sample any number of images from a given
         diffusion model and diffusion process.
 
+    The starting noise (and class label) of every sample is drawn from a seed derived
+    from (args.seed, sample index), so the samples do not depend on the batch size or
+    the number of processes. Runs with or without a process group.
+
     Args:
         N : Number of images
         model : Diffusion model
         diffusion : Diffusion process
-        xT : Starting instantiation of noise vector.
+        xT : Starting noise of the first batch (default: drawn from the per-sample seeds).
         sampling_steps : Number of sampling steps.
         batch_size : Batch-size for sampling.
-        num_channels : Number of channels in the image.
-        image_size : Image size (assuming square images).
+        num_channels : Number of channels in the image (of the latent, in latent mode).
+        image_size : Image size (assuming square images), of the latent in latent mode.
         num_classes : Number of classes in the dataset (needed for class-conditioned models)
         args : All args from the argparser.
+        writer : Optional sample_writer.ShardWriter. Gathered batches are streamed to it
+            (from rank 0) instead of being kept in memory, starting after the samples it
+            already holds.
 
-    Returns: Numpy array with N images and corresponding labels.
+    Returns: Numpy array with N images and corresponding labels, (None, None) with a writer.
     """
-    samples, labels, num_samples = [], [], 0
-    num_processes, group = dist.get_world_size(), dist.group.WORLD
-    with tqdm(total=math.ceil(N / (args.batch_size * num_processes))) as pbar:
+    samples, labels = [], []
+    rank, num_processes, group = world_info()
+    num_samples = writer.num_written if writer is not None else 0
+    with tqdm(
+        total=math.ceil(N / (batch_size * num_processes)),
+        initial=num_samples // (batch_size * num_processes),
+    ) as pbar:
         while num_samples < N:
+            indices = num_samples + rank * batch_size + np.arange(batch_size)
+            noise, y = sample_noise(
+                indices,
+                (num_channels, image_size, image_size),
+                args.seed,
+                num_classes if args.class_cond else None,
+                args.device,
+            )
             if xT is None:
-                xT = (
-                    torch.randn(batch_size, num_channels, image_size, image_size)
-                    .float()
-                    .to(args.device)
-                )
-            if args.class_cond:
-                y = torch.randint(num_classes, (len(xT),), dtype=torch.int64).to(
-                    args.device
-                )
-            else:
-                y = None
+                xT = noise
             gen_images = diffusion.sample_from_reverse_process(
-                model, xT, sampling_steps, {"y": y}, args.ddim
+                model, xT, sampling_steps, {"y": y}, args.ddim, args.compile
             )
-            samples_list = [torch.zeros_like(gen_images) for _ in range(num_processes)]
+            xT = None
+            if getattr(args, "autoencoder", None) is not None:
+                with torch.no_grad():
+                    gen_images = args.autoencoder.decode(gen_images)
+            gen_images = all_gather(gen_images, num_processes, group).detach().cpu()
             if args.class_cond:
-                labels_list = [torch.zeros_like(y) for _ in range(num_processes)]
-                dist.all_gather(labels_list, y, group)
-                labels.append(torch.cat(labels_list).detach().cpu().numpy())
-
-            dist.all_gather(samples_list, gen_images, group)
-            if args.dataset in ["poisson","lyapunov"]:
-                samples.append(torch.cat(samples_list).detach().cpu())
-            else:
-                samples.append(torch.cat(samples_list).detach().cpu().numpy())
-            num_samples += len(xT) * num_processes
+                y = all_gather(y, num_processes, group).cpu().numpy()
+            batch = gen_images[: N - num_samples]
+            if args.dataset not in ["poisson", "lyapunov"]:
+                batch = batch.numpy().transpose(0, 2, 3, 1)
+                batch = (127.5 * (batch + 1)).astype(np.uint8)
+            y = y[: N - num_samples] if args.class_cond else None
+            if writer is None:
+                samples.append(batch)
+                labels.append(y)
+            elif rank == 0:
+                writer.add(batch, y)
+            num_samples += len(gen_images)
             pbar.update(1)
+    if writer is not None:
+        if rank == 0:
+            writer.close()
+        return None, None
     if args.dataset in ["poisson","lyapunov"]:
         samples = torch.cat(samples)
     else:
-        samples = np.concatenate(samples).transpose(0, 2, 3, 1)[:N]
-        samples = (127.5 * (samples + 1)).astype(np.uint8)
+        samples = np.concatenate(samples)
     return (samples, np.concatenate(labels) if args.class_cond else None)
 
 
@@ -307,6 +485,27 @@ def main():
     parser = argparse.ArgumentParser("Minimal implementation of diffusion models")
     # diffusion model
     parser.add_argument("--arch", type=str, help="Neural network architecture", default="UNet")
+    parser.add_argument(
+        "--attention-backend",
+        type=str,
+        default="auto",
+        choices=unets.ATTENTION_BACKENDS,
+        help="Attention implementation (auto picks sdpa when available)",
+    )
+    parser.add_argument(
+        "--checkpoint-policy",
+        type=str,
+        default="attention",
+        choices=unets.CHECKPOINT_POLICIES,
+        help="Blocks that use gradient checkpointing during training",
+    )
+    parser.add_argument(
+        "--checkpoint-resolutions",
+        type=int,
+        nargs="+",
+        default=[],
+        help="Feature-map resolutions to checkpoint with --checkpoint-policy resolutions",
+    )
     parser.add_argument(
         "--class-cond",
         action="store_true",
@@ -331,14 +530,87 @@ def main():
         default=False,
         help="Sampling using DDIM update step",
     )
+    parser.add_argument(
+        "--freeze",
+        action="store_true",
+        default=False,
+        help="Sample with an inference-frozen UNet (precomputed timestep embeddings)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Run the reverse process through a compiled (and on GPU, CUDA graph) step",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=str,
+        default="./compile_cache/",
+        help="On-disk cache for compiled graphs, reused across runs",
+    )
     # dataset
     parser.add_argument("--dataset", type=str)
     parser.add_argument("--data-dir", type=str, default="./dataset/")
+    parser.add_argument(
+        "--augment",
+        type=str,
+        default="none",
+        choices=AUGMENTATIONS,
+        help="On-device symmetry augmentation of vector field stacks (lyapunov dataset)",
+    )
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        default=None,
+        help="Train at this resolution (fields are resampled), defaults to the dataset's",
+    )
+    # latent diffusion
+    parser.add_argument(
+        "--train-autoencoder",
+        action="store_true",
+        default=False,
+        help="Train the field autoencoder (for --autoencoder-ckpt) instead of the diffusion model",
+    )
+    parser.add_argument(
+        "--autoencoder-ckpt",
+        type=str,
+        default=None,
+        help="Train / sample the diffusion model in the latent space of this autoencoder",
+    )
+    parser.add_argument("--latent-channels", type=int, default=4)
     # optimizer
     parser.add_argument(
-        "--batch-size", type=int, default=128, help="batch-size per gpu"
+        "--batch-size",
+        type=int,
+        default=128,
+        help="batch-size over all gpus, split between them (per process limit of --effective-batch-size)",
+    )
+    parser.add_argument(
+        "--effective-batch-size",
+        type=int,
+        default=None,
+        help="Samples per optimizer step over all gpus, reached by gradient accumulation (default: --batch-size)",
+    )
+    parser.add_argument(
+        "--auto-batch-size",
+        action="store_true",
+        default=False,
+        help="Use the largest batch per process that fits on the device (training or sampling)",
     )
     parser.add_argument("--lr", type=float, default=0.0001)
+    parser.add_argument(
+        "--sharding",
+        type=str,
+        default="none",
+        choices=SHARDING,
+        help="Shard the optimizer state (zero) or model, optimizer and EMA (fsdp) over the processes",
+    )
+    parser.add_argument(
+        "--ema-device", type=str, default=None, help="Device of the EMA, cpu offloads it (default: training device)"
+    )
+    parser.add_argument("--lr-warmup", type=int, default=0, help="Linear LR warmup in optimizer steps")
+    parser.add_argument("--lr-schedule", type=str, default="constant", choices=["constant", "cosine"])
+    parser.add_argument("--min-lr", type=float, default=0.0, help="Final LR of the cosine schedule")
     parser.add_argument("--epochs", type=int, default=500)
     parser.add_argument("--ema_w", type=float, default=0.9995)
     # sampling/finetuning
@@ -356,37 +628,164 @@ def main():
         default=50000,
         help="Number of images required to sample from the model",
     )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1000,
+        help="Samples are streamed to shards of this size in --save-dir",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        default=False,
+        help="Overwrite the shards of a previous run instead of resuming after them",
+    )
 
+    parser.add_argument(
+        "--prediction",
+        type=str,
+        default=None,
+        choices=objectives.PREDICTIONS,
+        help="Training target of the model (default: from the metadata of --pretrained-ckpt, else eps)",
+    )
+    parser.add_argument(
+        "--min-snr-gamma",
+        type=float,
+        default=None,
+        help="Min-SNR-gamma loss weighting (e.g. 5), disabled by default",
+    )
+    parser.add_argument(
+        "--timestep-sampler",
+        type=str,
+        default="uniform",
+        choices=TIMESTEP_SAMPLERS,
+        help="Distribution of training timesteps (loss-aware: proportional to the RMS loss)",
+    )
+    parser.add_argument("--timestep-buckets", type=int, default=50, help="Buckets of the loss-aware sampler")
+    parser.add_argument("--loss-history", type=int, default=10, help="Losses kept per bucket")
+    parser.add_argument(
+        "--antithetic",
+        action="store_true",
+        default=False,
+        help="Train on +-eps pairs with a shared timestep for every draw",
+    )
+    parser.add_argument(
+        "--stratified-timesteps",
+        action="store_true",
+        default=False,
+        help="Draw the timesteps of a batch from one stratum each",
+    )
+    parser.add_argument(
+        "--draws-per-image",
+        type=int,
+        default=1,
+        help="(t, eps) draws per loaded image, each adds a loss term",
+    )
+    # training metrics
+    parser.add_argument(
+        "--metrics-interval",
+        type=int,
+        default=100,
+        help="Steps aggregated into one row of the metrics file",
+    )
+    parser.add_argument(
+        "--metrics-buffer",
+        type=int,
+        default=1024,
+        help="Capacity (in steps) of the ring buffer of step records",
+    )
+    parser.add_argument("--metrics-format", type=str, default="jsonl", choices=["jsonl", "csv"])
+    # evaluation
+    parser.add_argument(
+        "--eval-every",
+        type=int,
+        default=1,
+        help="Sample from the EMA model in the background every this many epochs (0 disables)",
+    )
+    parser.add_argument("--eval-samples", type=int, default=64)
+    parser.add_argument(
+        "--eval-device",
+        type=str,
+        default=None,
+        help="Device of the evaluation worker (defaults to the training device)",
+    )
     # misc
     parser.add_argument("--save-dir", type=str, default="./trained_models/")
-    parser.add_argument("--local-rank", default=2, type=int)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Resume training from the latest checkpoint in --save-dir/checkpoints",
+    )
+    parser.add_argument(
+        "--keep-checkpoints",
+        type=int,
+        default=3,
+        help="Number of training checkpoints to keep (0 keeps all)",
+    )
     parser.add_argument("--seed", default=112233, type=int)
+    add_distributed_args(parser)
 
     # setup
     args = parser.parse_args()
     metadata = get_metadata(args.dataset)
+    assert args.augment == "none" or args.dataset == "lyapunov", "--augment transforms (f1, f2, V) stacks"
+    args.image_size = args.image_size or metadata.image_size
+    # models trained below the native resolution (e.g. the coarse model of a cascade)
+    args.run_name = (
+        args.dataset
+        if args.image_size == metadata.image_size
+        else f"{args.dataset}_{args.image_size}px"
+    )
     os.makedirs(args.save_dir, exist_ok=True)
     torch.backends.cudnn.benchmark = True
-    args.device = "cuda:{}".format(args.local_rank)
-    torch.cuda.set_device(args.device)
-    torch.manual_seed(args.seed + args.local_rank)
-    np.random.seed(args.seed + args.local_rank)
-    if args.local_rank == 0:
+    setup_distributed(args)
+    torch.manual_seed(args.seed + args.rank)
+    np.random.seed(args.seed + args.rank)
+    if args.rank == 0:
         print(args)
 
+    if args.train_autoencoder:
+        train_autoencoder(args, metadata)
+        return
+
+    # in latent mode the diffusion model works on autoencoder latents instead of fields
+    args.autoencoder = None
+    model_channels, model_size = metadata.num_channels, args.image_size
+    if args.autoencoder_ckpt:
+        args.autoencoder = load_autoencoder(
+            args.autoencoder_ckpt, metadata.num_channels, args.latent_channels, args.device
+        )
+        model_channels, model_size, _ = args.autoencoder.latent_shape(args.image_size)
+        args.run_name += f"_latent{args.latent_channels}"
+
     # Creat model and diffusion process
     model = unets.__dict__[args.arch](
-        image_size=metadata.image_size,
-        in_channels=metadata.num_channels,
-        out_channels=metadata.num_channels,
+        image_size=model_size,
+        in_channels=model_channels,
+        out_channels=model_channels,
         num_classes=metadata.num_classes if args.class_cond else None,
+        attention_backend=args.attention_backend,
+        checkpoint_policy=args.checkpoint_policy,
+        checkpoint_resolutions=args.checkpoint_resolutions,
     ).to(args.device)
-    if args.local_rank == 0:
+    if args.rank == 0:
         print(
             "We are assuming that model input/ouput pixel range is [-1, 1]. Please adhere to it."
         )
-    diffusion = GuassianDiffusion(args.diffusion_steps, args.device)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
+    # the prediction target of a pretrained model is recorded in its metadata
+    args.prediction = (
+        args.prediction or read_metadata(args.pretrained_ckpt).get("prediction") or "eps"
+    )
+    diffusion = GuassianDiffusion(
+        args.diffusion_steps,
+        args.device,
+        args.compile_cache_dir if args.compile else None,
+        args.prediction,
+    )
+    if args.autoencoder is not None:
+        # latents are not bounded to [-1, 1]
+        diffusion.clamp_x0 = lambda x: x
 
     # load pre-trained model
     if args.pretrained_ckpt:
@@ -407,107 +806,224 @@ def main():
         )
         print(f"Loaded pretrained model from {args.pretrained_ckpt}")
 
-    # distributed training
-    ngpus = torch.cuda.device_count()
-    if ngpus > 1:
-        if args.local_rank == 0:
-            print(f"Using distributed training on {ngpus} gpus.")
-        args.batch_size = args.batch_size // ngpus
-        torch.distributed.init_process_group(backend="nccl", init_method="env://")
-        model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank)
+    # batch size per process, probed on the plain model before it is wrapped in DDP
+    world_size = args.world_size
+    num_classes = metadata.num_classes if args.class_cond else None
+    shape = (model_channels, model_size, model_size)
+    if args.sampling_only:
+        max_batch_size = args.batch_size // world_size
+        if args.auto_batch_size:
+            max_batch_size = probe_max_batch(
+                sampling_step(model, diffusion, shape, num_classes, args.device),
+                args.device,
+                limit=math.ceil(args.num_sampled_images / world_size),
+            )
+        args.batch_size, args.grad_accum = max_batch_size, 1
+    else:
+        args.effective_batch_size = args.effective_batch_size or args.batch_size
+        max_batch_size = args.batch_size // world_size
+        if args.auto_batch_size:
+            max_batch_size = probe_max_batch(
+                training_step(
+                    model,
+                    diffusion,
+                    shape,
+                    num_classes,
+                    args.device,
+                    args.draws_per_image * (2 if args.antithetic else 1),
+                ),
+                args.device,
+                limit=math.ceil(args.effective_batch_size / world_size),
+            )
+        args.batch_size, args.grad_accum = accumulation(
+            args.effective_batch_size, max_batch_size, world_size
+        )
+    if args.rank == 0:
+        print(
+            f"Batch size: {args.batch_size} per process x {args.grad_accum} accumulation steps "
+            + f"x {world_size} processes (max {max_batch_size} per process)"
+        )
+    # distributed training, the optimizer is created on the wrapped (possibly sharded) model
+    assert not (args.sampling_only and args.sharding == "fsdp"), "fsdp is for training"
+    # FSDP changes the model in place, the evaluation worker needs the plain architecture
+    plain_model = copy.deepcopy(model).cpu() if args.sharding == "fsdp" else model
+    model = wrap_model(model, args)
+    optimizer = create_optimizer(model, args)
 
     # sampling
     if args.sampling_only:
-        sampled_images, labels = sample_N_images(
+        if args.freeze:
+            model = unets.freeze_for_inference(
+                model, diffusion.get_sampling_scalars(args.sampling_steps)[0]
+            )
+        sample_dir = os.path.join(
+            args.save_dir,
+            f"{args.arch}_{args.run_name}-{args.sampling_steps}-sampling_steps-class_condn_{args.class_cond}",
+        )
+        writer = ShardWriter(
+            sample_dir,
+            args.shard_size,
+            {
+                "arch": args.arch,
+                "dataset": args.run_name,
+                "pretrained_ckpt": args.pretrained_ckpt,
+                "sampling_steps": args.sampling_steps,
+                "ddim": args.ddim,
+                "class_cond": args.class_cond,
+                "seed": args.seed,
+            },
+            resume=not args.no_resume,
+        )
+        if writer.num_written:
+            print(f"Resuming after {writer.num_written} samples in {sample_dir}")
+        sample_N_images(
             args.num_sampled_images,
             model,
             diffusion,
             None,
             args.sampling_steps,
             args.batch_size,
-            metadata.num_channels,
-            metadata.image_size,
+            model_channels,
+            model_size,
             metadata.num_classes,
             args,
+            writer,
         )
-        np.savez(
-            os.path.join(
-                args.save_dir,
-                f"{args.arch}_{args.dataset}-{args.sampling_steps}-sampling_steps-{len(sampled_images)}_images-class_condn_{args.class_cond}.npz",
-            ),
-            sampled_images,
-            labels,
-        )
+        print(f"Samples saved in {sample_dir}")
         return
 
     # Load dataset
     train_set = get_dataset(args.dataset, args.data_dir, metadata)
-    sampler = DistributedSampler(train_set) if ngpus > 1 else None
+    sampler = DistributedSampler(train_set) if world_size > 1 else None
     train_loader = DataLoader(
         train_set,
         batch_size=args.batch_size,
         shuffle=sampler is None,
         sampler=sampler,
         num_workers=4,
-        pin_memory=True,
+        pin_memory=torch.device(args.device).type == "cuda",
     )
-    if args.local_rank == 0:
+    if args.rank == 0:
         print(
             f"Training dataset loaded: Number of batches: {len(train_loader)}, Number of images: {len(train_set)}"
         )
-    logger = loss_logger(len(train_loader) * args.epochs)
+    metrics = TrainingMetrics(
+        os.path.join(
+            args.save_dir,
+            f"{args.arch}_{args.run_name}-class_condn_{args.class_cond}-metrics.{args.metrics_format}",
+        )
+        if args.rank == 0
+        else None,
+        args.metrics_interval,
+        args.metrics_buffer,
+        args.device,
+        len(train_loader) * args.epochs,
+    )
+
+    # LR schedule, stepped once per optimizer step
+    lrs = None
+    if args.lr_warmup or args.lr_schedule != "constant":
+        lrs = warmup_cosine(
+            optimizer,
+            args.lr_warmup,
+            args.epochs * math.ceil(len(train_loader) / args.grad_accum),
+            args.min_lr / args.lr,
+            args.lr_schedule == "cosine",
+        )
 
-    # ema model
-    args.ema_dict = copy.deepcopy(model.state_dict())
+    # ema model (sharded under fsdp, see sharding.py)
+    args.ema_dict = init_ema(model, args)
+    args.schedule_sampler = create_timestep_sampler(
+        args.timestep_sampler,
+        args.diffusion_steps,
+        args.device,
+        **(
+            {"num_buckets": args.timestep_buckets, "history": args.loss_history}
+            if args.timestep_sampler == "loss-aware"
+            else {}
+        ),
+    )
+
+    # full training state, written in the background
+    name = f"{args.arch}_{args.run_name}-timesteps_{args.diffusion_steps}-class_condn_{args.class_cond}"
+    checkpoints = CheckpointManager(
+        os.path.join(args.save_dir, "checkpoints"), name, args.keep_checkpoints
+    )
+    start_epoch = 0
+    # workers restarted by an elastic launch always resume
+    if (args.resume or args.restart_count) and checkpoints.latest():
+        extra = {"timestep_sampler": args.schedule_sampler}
+        if lrs is not None:
+            extra["lr_scheduler"] = lrs
+        start_epoch, args.ema_dict = resume(
+            checkpoints.latest(),
+            model,
+            optimizer,
+            args.device,
+            extra,
+            lambda state, model, optimizer: load_state(state, model, optimizer, args),
+        )
+        print(f"Resumed from {checkpoints.latest()} at epoch {start_epoch}")
+
+    # samples and metrics of EMA snapshots, computed in the background
+    evaluator = None
+    if args.rank == 0 and args.eval_every:
+        evaluator = EvalWorker(
+            plain_model,
+            diffusion,
+            args,
+            (model_channels, model_size, model_size),
+            args.eval_samples,
+            args.eval_device,
+        )
 
     # lets start training the model
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
         if sampler is not None:
             sampler.set_epoch(epoch)
-        train_one_epoch(model, train_loader, diffusion, optimizer, logger, None, args)
-        if args.local_rank == 0:
-            torch.save(
-                model.state_dict(),
-                os.path.join(
-                    args.save_dir,
-                    f"{args.arch}_{args.dataset}-epoch_{args.epochs}-timesteps_{args.diffusion_steps}-class_condn_{args.class_cond}.pt",
-                ),
-            )
-            torch.save(
-                args.ema_dict,
-                os.path.join(
-                    args.save_dir,
-                    f"{args.arch}_{args.dataset}-epoch_{args.epochs}-timesteps_{args.diffusion_steps}-class_condn_{args.class_cond}_ema_{args.ema_w}.pt",
-                ),
-            )
-        if not epoch % 1:
-            sampled_images, _ = sample_N_images(
-                64,
-                model,
-                diffusion,
-                None,
-                args.sampling_steps,
-                args.batch_size,
-                metadata.num_channels,
-                metadata.image_size,
-                metadata.num_classes,
-                args,
+        train_one_epoch(model, train_loader, diffusion, optimizer, metrics, lrs, args)
+        model_state, ema_state, optimizer_state = consolidated_state(
+            model, args.ema_dict, optimizer, args
+        )
+        if evaluator is not None and not (epoch + 1) % args.eval_every:
+            evaluator.submit(epoch, ema_state)
+        state = training_state(
+            model_state,
+            ema_state,
+            optimizer_state,
+            epoch,
+            timestep_sampler=args.schedule_sampler.state_dict(),
+            **({"lr_scheduler": lrs.state_dict()} if lrs is not None else {}),
+            metadata={
+                "arch": args.arch,
+                "prediction": args.prediction,
+                "min_snr_gamma": args.min_snr_gamma,
+                "diffusion_steps": args.diffusion_steps,
+                "image_size": args.image_size,
+                "autoencoder_ckpt": args.autoencoder_ckpt,
+            },
+        )
+        if args.rank == 0:
+            # also export the plain model and EMA state dicts, as loaded by --pretrained-ckpt
+            checkpoints.save(
+                state,
+                epoch,
+                {
+                    os.path.join(
+                        args.save_dir,
+                        f"{args.arch}_{args.run_name}-epoch_{args.epochs}-timesteps_{args.diffusion_steps}-class_condn_{args.class_cond}.pt",
+                    ): "model",
+                    os.path.join(
+                        args.save_dir,
+                        f"{args.arch}_{args.run_name}-epoch_{args.epochs}-timesteps_{args.diffusion_steps}-class_condn_{args.class_cond}_ema_{args.ema_w}.pt",
+                    ): "ema",
+                },
             )
-            if args.local_rank == 0:
-                if args.dataset in ["poisson","lyapunov"]:
-                    torch.save(sampled_images,
-                               os.path.join(
-                                    args.save_dir,
-                                    f"{args.arch}_{args.dataset}-{args.diffusion_steps}_steps-{args.sampling_steps}-sampling_steps-class_condn_{args.class_cond}.pt",
-                                ))
-                else:
-                    cv2.imwrite(
-                        os.path.join(
-                            args.save_dir,
-                            f"{args.arch}_{args.dataset}-{args.diffusion_steps}_steps-{args.sampling_steps}-sampling_steps-class_condn_{args.class_cond}.png",
-                        ),
-                        np.concatenate(sampled_images, axis=1)[:, :, ::-1],
-                    )
+    metrics.flush()
+    checkpoints.close()
+    if evaluator is not None:
+        evaluator.close()
+    cleanup_distributed()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+"""
+Per-step instrumentation of the training loop.
+
+Every step records the wall time spent waiting for the data loader and the
+device time of each phase (preprocess, forward, backward, optimizer, ema). On
+GPU the phases are timed with CUDA events and the loss is summed on the device,
+so recording a step never synchronizes with the host. Step records are kept in a
+bounded ring buffer and aggregated every `interval` steps, the only point where
+the host waits for the device, into one row of a JSONL or CSV file.
+"""
+import os
+import csv
+import json
+import resource
+from time import time, perf_counter
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+
+PHASES = ("data", "preprocess", "forward", "backward", "optimizer", "ema")
+
+
+class TrainingMetrics:
+    """
+    :param path: output file, CSV if it ends with .csv and JSONL otherwise. None
+                 disables writing (e.g. on ranks other than 0).
+    :param interval: number of steps aggregated per row.
+    :param capacity: size of the ring buffer of step records. If it is smaller than
+                     interval, the oldest steps of an interval are dropped.
+    :param max_steps: total number of steps, for the progress print.
+    """
+
+    def __init__(self, path=None, interval=100, capacity=1024, device="cpu", max_steps=None):
+        self.path = path
+        self.interval = interval
+        self.records = deque(maxlen=capacity)
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        self.max_steps = max_steps
+        self.step = 0
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.loss_count = 0
+        self.start_time = time()
+        self.reset_interval()
+
+    def reset_interval(self):
+        self.interval_start = perf_counter()
+        self.interval_samples = 0
+        self.last_step_end = perf_counter()
+        self.current = {}
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def data_loaded(self):
+        """Call right after the data loader returned a batch."""
+        self.current = {"data": perf_counter() - self.last_step_end}
+
+    @contextmanager
+    def phase(self, name):
+        """Time the device work queued inside the block."""
+        if self.cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.current[name] = (start, end)
+        else:
+            start = perf_counter()
+            yield
+            self.current[name] = perf_counter() - start
+
+    def end_step(self, batch_size, loss):
+        """Record the step. `loss` is accumulated on the device."""
+        self.loss_sum += loss.detach()
+        self.loss_count += 1
+        self.records.append(self.current)
+        self.interval_samples += batch_size
+        self.step += 1
+        self.last_step_end = perf_counter()
+        if not self.step % self.interval:
+            return self.flush()
+
+    def flush(self):
+        """Aggregate the buffered steps and append a row to the output file."""
+        if not self.records:
+            return None
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        wall = perf_counter() - self.interval_start
+        seconds = lambda v: v[0].elapsed_time(v[1]) / 1000 if isinstance(v, tuple) else v
+        totals = {name: 0.0 for name in PHASES}
+        for record in self.records:
+            for name, v in record.items():
+                totals[name] = totals.get(name, 0.0) + seconds(v)
+        steps = len(self.records)
+        row = {
+            "step": self.step,
+            "time": time() - self.start_time,
+            "loss": (self.loss_sum / max(self.loss_count, 1)).item(),
+            "samples_per_s": self.interval_samples / wall,
+            "step_s": wall / max(self.loss_count, 1),
+            **{f"{name}_s": totals[name] / steps for name in totals},
+            "peak_mem_mb": (
+                torch.cuda.max_memory_allocated(self.device)
+                if self.cuda
+                # ru_maxrss is in KB on linux
+                else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            )
+            / 2 ** 20,
+        }
+        self.write(row)
+        self.records.clear()
+        self.loss_sum.zero_()
+        self.loss_count = 0
+        self.reset_interval()
+        return row
+
+    def write(self, row):
+        if self.path is None:
+            return
+        if self.path.endswith(".csv"):
+            new = not os.path.exists(self.path)
+            with open(self.path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(row))
+                if new:
+                    writer.writeheader()
+                writer.writerow(row)
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(row) + "\n")
+        print(
+            f"Steps: {row['step']}/{self.max_steps} \t loss: {row['loss']:.3f} \t "
+            + f"samples/s: {row['samples_per_s']:.1f} \t data wait: {row['data_s'] / row['step_s']:.0%} "
+            + f"\t Time elapsed: {row['time'] / 3600:.3f} hr"
+        )
@@ -0,0 +1,65 @@
+"""
+Prediction targets of the diffusion model and their conversions, shared by the
+GuassianDiffusion classes of main.py and restoration_control.py.
+
+    eps: the model predicts the noise (L_simple, https://arxiv.org/abs/2006.11239).
+    v:   the model predicts v = sqrt(alpha_bar) * eps - sqrt(1 - alpha_bar) * x0
+         (https://arxiv.org/abs/2202.00512), which stays well conditioned at both
+         ends of the schedule and holds up better with few sampling steps.
+    x0:  the model predicts the clean sample.
+
+Min-SNR-gamma weighting (https://arxiv.org/abs/2303.09556) clips the SNR-based
+weight of every timestep at gamma, expressed for each target.
+"""
+import torch
+
+PREDICTIONS = ("eps", "v", "x0")
+
+unsqueeze3x = lambda x: x[..., None, None, None]
+
+
+def training_target(prediction, alpha_bar, x0, eps):
+    """Regression target of the model, alpha_bar is the [N] alpha_bar of the samples."""
+    if prediction == "eps":
+        return eps
+    if prediction == "x0":
+        return x0
+    if prediction == "v":
+        a = unsqueeze3x(alpha_bar)
+        return a.sqrt() * eps - (1 - a).sqrt() * x0
+    raise ValueError(f"unknown prediction target: {prediction}")
+
+
+def eps_x0_from_output(prediction, alpha_bar, xt, output, clamp_x0=lambda x: x):
+    """
+    Convert a model output to (pred_eps, pred_x0), with pred_x0 clamped. For the v
+    and x0 targets, eps is derived from the clamped x0 so that both stay consistent.
+    """
+    a = unsqueeze3x(alpha_bar)
+    if prediction == "eps":
+        return output, clamp_x0((xt - (1 - a).sqrt() * output) / a.sqrt())
+    if prediction == "x0":
+        x0 = clamp_x0(output)
+    elif prediction == "v":
+        x0 = clamp_x0(a.sqrt() * xt - (1 - a).sqrt() * output)
+    else:
+        raise ValueError(f"unknown prediction target: {prediction}")
+    return (xt - a.sqrt() * x0) / (1 - a).sqrt(), x0
+
+
+def min_snr_weights(prediction, alpha_bar, gamma=None):
+    """
+    Per-sample loss weights that turn the MSE on `prediction` into the min-SNR-gamma
+    weighted loss. All ones without gamma.
+    """
+    if gamma is None:
+        return torch.ones_like(alpha_bar)
+    snr = alpha_bar / (1 - alpha_bar)
+    clipped = snr.clamp(max=gamma)
+    if prediction == "eps":
+        return clipped / snr
+    if prediction == "x0":
+        return clipped
+    if prediction == "v":
+        return clipped / (snr + 1)
+    raise ValueError(f"unknown prediction target: {prediction}")
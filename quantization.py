@@ -0,0 +1,193 @@
+"""
+Post-training int8 quantization of UNetModel for CPU inference.
+
+Convolutions and linear layers are quantized, GroupNorm and the attention
+softmax stay in float32. Two modes are supported:
+    dynamic: int8 weights with dynamically quantized activations. PyTorch only
+        supports dynamic quantization for linear layers, convolutions stay fp32.
+    static: int8 weights and activations for every convolution and linear layer,
+        with activation ranges calibrated on noised samples of LyapunovDataset.
+"""
+import copy
+import argparse
+import platform
+import numpy as np
+from time import time
+from easydict import EasyDict
+
+import torch
+from torch import nn
+import torch.ao.quantization as tq
+from torch.utils.data import DataLoader
+
+import unets
+from data import get_metadata, get_dataset, fix_legacy_dict
+
+QUANTIZED_LAYERS = (nn.Conv1d, nn.Conv2d, nn.Linear)
+
+
+def default_engine():
+    return "qnnpack" if platform.machine().lower() in ("arm64", "aarch64") else "x86"
+
+
+def quantize_dynamic(model):
+    """Return an int8 copy of `model` with dynamically quantized linear layers."""
+    model = copy.deepcopy(model).cpu().eval()
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def prepare_static(model, engine=None):
+    """
+    Return a copy of `model` where every convolution and linear layer is wrapped in
+    quantize / dequantize stubs with observers, ready for calibration. Layers without
+    a qconfig (GroupNorm, SiLU, attention) keep running in float32 between them.
+    """
+    engine = engine or default_engine()
+    torch.backends.quantized.engine = engine
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = tq.get_default_qconfig(engine)
+
+    def wrap(module):
+        for name, child in module.named_children():
+            if isinstance(child, QUANTIZED_LAYERS):
+                wrapped = tq.QuantWrapper(child)
+                wrapped.qconfig = qconfig
+                setattr(module, name, wrapped)
+            else:
+                wrap(child)
+
+    wrap(model)
+    return tq.prepare(model)
+
+
+def calibration_batches(data_dir="./dataset/", batch_size=16, num_batches=8, diffusion=None):
+    """
+    Yield (x_t, t) pairs from LyapunovDataset at random noise levels. The stacks are
+    used as loaded, like in training (main.py does not rescale lyapunov data).
+    """
+    if diffusion is None:
+        from main import GuassianDiffusion
+
+        diffusion = GuassianDiffusion(1000, "cpu")
+    train_set = get_dataset("lyapunov", data_dir, get_metadata("lyapunov"))
+    loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
+    for step, images in enumerate(loader):
+        if step == num_batches:
+            break
+        t = torch.randint(diffusion.timesteps, (len(images),), dtype=torch.int64)
+        xt, _ = diffusion.sample_from_forward_process(images, t)
+        yield xt, t
+
+
+def quantize_static(model, batches, engine=None):
+    """
+    Calibrate activation ranges on `batches` (an iterable of (x_t, t) pairs) and
+    return the int8 model.
+    """
+    prepared = prepare_static(model, engine)
+    with torch.no_grad():
+        for xt, t in batches:
+            prepared(xt, t)
+    return tq.convert(prepared)
+
+
+def latency(model, shape, repeats=10):
+    """Median seconds per forward pass on CPU."""
+    x = torch.randn(shape)
+    t = torch.randint(1000, (shape[0],))
+    times = []
+    with torch.no_grad():
+        model(x, t)
+        for _ in range(repeats):
+            start = time()
+            model(x, t)
+            times.append(time() - start)
+    return float(np.median(times))
+
+
+def compare_controllers(model, qmodel, systems, sampling_steps=250, ddim=True, seed=0):
+    """
+    Run the guided control loop with the fp32 and the quantized model from the
+    same random state, and compare the controller parameters and V fields.
+
+    Return: dict with one EasyDict of errors and timings per system.
+    """
+    from restoration_control import GuassianDiffusion, system_dict
+
+    diffusion = GuassianDiffusion(1000, "cpu")
+    results = {}
+    for name in systems:
+        runs = []
+        for m in (model, qmodel):
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            start = time()
+            final, p = diffusion.sample_from_reverse_process(
+                m, system_dict[name], sampling_steps, {"y": None}, ddim, verbose=False
+            )
+            runs.append((final, p, time() - start))
+        (final, p, fp32_s), (qfinal, qp, int8_s) = runs
+        phi = torch.stack([p.coeffs[k].detach() for k in sorted(p.coeffs)])
+        qphi = torch.stack([qp.coeffs[k].detach() for k in sorted(qp.coeffs)])
+        results[name] = EasyDict(
+            {
+                "phi_fp32": phi.tolist(),
+                "phi_int8": qphi.tolist(),
+                "phi_max_abs_err": (phi - qphi).abs().max().item(),
+                "V_rel_err": ((final[2] - qfinal[2]).norm() / final[2].norm()).item(),
+                "fp32_s": fp32_s,
+                "int8_s": int8_s,
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("Post-training int8 quantization of the denoiser")
+    parser.add_argument("--arch", type=str, default="UNet")
+    parser.add_argument("--pretrained-ckpt", type=str, help="Pretrained model ckpt")
+    parser.add_argument("--mode", type=str, default="static", choices=["dynamic", "static"])
+    parser.add_argument("--engine", type=str, default=None, help="Quantized backend (x86, qnnpack, ...)")
+    parser.add_argument("--data-dir", type=str, default="./dataset/")
+    parser.add_argument("--calibration-batches", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--systems", nargs="+", default=["pendulum", "duffing", "van_der_pol"])
+    parser.add_argument("--sampling-steps", type=int, default=250)
+    parser.add_argument("--save-path", type=str, default=None, help="Save the quantized model (torch.save)")
+    parser.add_argument("--seed", default=112233, type=int)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    metadata = get_metadata("lyapunov")
+    model = unets.__dict__[args.arch](
+        image_size=metadata.image_size,
+        in_channels=metadata.num_channels,
+        out_channels=metadata.num_channels,
+    )
+    if args.pretrained_ckpt:
+        model.load_state_dict(fix_legacy_dict(torch.load(args.pretrained_ckpt, map_location="cpu")))
+    model.eval()
+
+    if args.mode == "dynamic":
+        qmodel = quantize_dynamic(model)
+    else:
+        qmodel = quantize_static(
+            model,
+            calibration_batches(args.data_dir, args.batch_size, args.calibration_batches),
+            args.engine,
+        )
+    if args.save_path:
+        torch.save(qmodel, args.save_path)
+
+    shape = (1, metadata.num_channels, metadata.image_size, metadata.image_size)
+    fp32_s, int8_s = latency(model, shape), latency(qmodel, shape)
+    print(f"Forward latency (batch 1): fp32 {fp32_s * 1000:.2f} ms \t int8 {int8_s * 1000:.2f} ms \t speedup {fp32_s / int8_s:.2f}x")
+    for name, r in compare_controllers(model, qmodel, args.systems, args.sampling_steps, seed=args.seed).items():
+        print(
+            f"{name}: phi fp32 {r.phi_fp32} int8 {r.phi_int8} \t max |dphi| {r.phi_max_abs_err:.4f} "
+            + f"\t V rel. err {r.V_rel_err:.4f} \t control run {r.fp32_s:.1f}s -> {r.int8_s:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
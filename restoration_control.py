@@ -1,25 +1,26 @@
 import os
-import cv2
 import copy
 import math
 import argparse
-from matplotlib import pyplot as plt
 import numpy as np
 from time import time
-from tqdm import tqdm
 from easydict import EasyDict
-from PIL import Image
 
 import torch
-import torch.distributed as dist
 from torch import nn
 import torch.nn.functional as F
 from torch.optim import Adam
-from torch.utils.data import DataLoader
-from torch.utils.data.distributed import DistributedSampler
-from torch.nn.parallel import DistributedDataParallel as DDP
 
-from data import get_metadata, get_dataset, fix_legacy_dict
+# plotting (matplotlib, cv2), dataset (torchvision, scipy) and distributed modules
+# are imported where they are used, the control path only needs torch and the UNets
+from sample_writer import all_gather, world_info
+from data import get_metadata, fix_legacy_dict
+from autoencoder import load_autoencoder
+from checkpoint import read_metadata
+from roa import estimate_roa_from_stack
+from trajectory import TrajectoryBuffer, render_async, render_fields
+import objectives
+import sampling
 import unets
 
 unsqueeze3x = lambda x: x[..., None, None, None]
@@ -29,13 +30,33 @@ xx,yy = np.meshgrid(x,y)
 xx_t,yy_t = torch.Tensor(xx),torch.Tensor(yy)
 coords = torch.stack((xx_t,yy_t)).view(2,-1)
 
-class Pendulum(nn.Module):
-    def __init__(self):
+class GridSystem(nn.Module):
+    """Closed-loop 2D system evaluated on a grid_size x grid_size meshgrid of [-1, 1]^2."""
+
+    def __init__(self, grid_size=64):
         super().__init__()
-        x = y = np.linspace(-1,1,64)
+        self.set_grid(grid_size)
+        # random number generators of stochastic systems, the global ones unless seeded
+        self.rng = None
+        self.generator = None
+
+    def seed(self, seed):
+        """Draw the randomness of the system from its own generators, seeded with `seed`."""
+        self.rng = np.random.default_rng(seed)
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def set_grid(self, grid_size):
+        """Re-evaluate the system on a different grid, keeping the controller parameters."""
+        device = self.xx.device if hasattr(self, "xx") else None
+        x = y = np.linspace(-1,1,grid_size)
         xx,yy = np.meshgrid(x,y)
-        self.xx = torch.Tensor(xx).to("cuda:0")
-        self.yy = torch.Tensor(yy).to("cuda:0")
+        self.grid_size = grid_size
+        self.register_buffer("xx", torch.Tensor(xx).to(device))
+        self.register_buffer("yy", torch.Tensor(yy).to(device))
+
+class Pendulum(GridSystem):
+    def __init__(self, grid_size=64):
+        super().__init__(grid_size)
         self.m = 0.15
         self.g = 9.81
         self.l = 0.5
@@ -51,15 +72,11 @@ class Pendulum(nn.Module):
         f1 = self.yy
         f2 = self.g*torch.sin(self.xx)/self.l + (control - 0.1*self.yy) / (self.m*self.l*self.l)
         # f3 = torch.zeros_like(self.xx)
-        return torch.stack((f1,f2,V.to("cuda:0")))
+        return torch.stack((f1,f2,V.to(self.xx.device)))
     
-class NoisyPendulum(nn.Module):
-    def __init__(self):
-        super().__init__()
-        x = y = np.linspace(-1,1,64)
-        xx,yy = np.meshgrid(x,y)
-        self.xx = torch.Tensor(xx).to("cuda:0")
-        self.yy = torch.Tensor(yy).to("cuda:0")
+class NoisyPendulum(GridSystem):
+    def __init__(self, grid_size=64):
+        super().__init__(grid_size)
         self.m = 0.15
         self.g = 9.81
         self.l = 0.5
@@ -71,24 +88,21 @@ class NoisyPendulum(nn.Module):
         self.coeffs = {name: param for name, param in self.named_parameters()}
     
     def forward(self,V):
-        m = self.m + np.random.uniform(low=-0.05, high=0.05)
-        g = self.g + np.random.uniform(low=-0.05, high=0.05)
-        l = self.l + np.random.uniform(low=-0.05, high=0.05)
+        rng = self.rng or np.random
+        m = self.m + rng.uniform(low=-0.05, high=0.05)
+        g = self.g + rng.uniform(low=-0.05, high=0.05)
+        l = self.l + rng.uniform(low=-0.05, high=0.05)
         control = 5 * F.tanh(self.coeffs["phi1"]*self.xx) + 5 * F.tanh(self.coeffs["phi2"]*self.yy)
-        noise = torch.rand(())*0.1-0.05
+        noise = torch.rand((), generator=self.generator)*0.1-0.05
         control *= 1+noise
         f1 = self.yy
         f2 = g*torch.sin(self.xx)/l + (control - 0.1*self.yy) / (m*l*l)
         # f3 = torch.zeros_like(self.xx)
-        return torch.stack((f1,f2,V.to("cuda:0")))
+        return torch.stack((f1,f2,V.to(self.xx.device)))
     
-class Duffing(nn.Module):
-    def __init__(self):
-        super().__init__()
-        x = y = np.linspace(-1,1,64)
-        xx,yy = np.meshgrid(x,y)
-        self.xx = torch.Tensor(xx).to("cuda:0")
-        self.yy = torch.Tensor(yy).to("cuda:0")
+class Duffing(GridSystem):
+    def __init__(self, grid_size=64):
+        super().__init__(grid_size)
 
         self.register_parameter("phi1", nn.Parameter(torch.randn(())))
         self.register_parameter("phi2", nn.Parameter(torch.randn(())))
@@ -101,15 +115,11 @@ class Duffing(nn.Module):
         f1 = self.yy
         f2 = -0.5*self.yy - self.xx * (4*self.xx*self.xx - 1) + 0.5 * control
         # f3 = torch.zeros_like(self.xx)
-        return torch.stack((f1,f2,V.to("cuda:0")))
+        return torch.stack((f1,f2,V.to(self.xx.device)))
 
-class VanDerPol(nn.Module):
-    def __init__(self):
-        super().__init__()
-        x = y = np.linspace(-1,1,64)
-        xx,yy = np.meshgrid(x,y)
-        self.xx = torch.Tensor(xx).to("cuda:0")
-        self.yy = torch.Tensor(yy).to("cuda:0")
+class VanDerPol(GridSystem):
+    def __init__(self, grid_size=64):
+        super().__init__(grid_size)
 
         self.register_parameter("phi1", nn.Parameter(torch.randn(())))
         self.register_parameter("phi2", nn.Parameter(torch.randn(())))
@@ -122,7 +132,7 @@ class VanDerPol(nn.Module):
         f1 = 2*self.yy
         f2 = -0.8*self.xx + 2*self.yy - 10*self.xx*self.xx*self.yy + control
         # f3 = torch.zeros_like(self.xx)
-        return torch.stack((f1,f2,V.to("cuda:0")))
+        return torch.stack((f1,f2,V.to(self.xx.device)))
 
 system_dict = {
     "noisy_pendulum": NoisyPendulum,
@@ -131,66 +141,48 @@ system_dict = {
     "van_der_pol": VanDerPol
 }
 
+def system_params(system):
+    """Names a system can be given values for: its controller parameters and float constants."""
+    return list(system.coeffs) + [k for k, v in vars(system).items() if isinstance(v, float)]
+
+def set_system_params(system, params):
+    """Set physical constants (e.g. m, g, l of the pendulums) or initial phi of a system."""
+    allowed = system_params(system)
+    for k, v in params.items():
+        if k not in allowed:
+            raise ValueError(f"{type(system).__name__} has no parameter {k} (one of {', '.join(allowed)})")
+        if k in system.coeffs:
+            with torch.no_grad():
+                system.coeffs[k].fill_(float(v))
+        else:
+            setattr(system, k, float(v))
+    return system
+
+def make_system(name, grid_size=64, **params):
+    """
+    Instantiate system_dict[name] with some of its physical constants (e.g. m, g, l of
+    the pendulums) or initial controller parameters (phi1, phi2) set from params.
+    """
+    if name not in system_dict:
+        raise ValueError(f"unknown system: {name}")
+    return set_system_params(system_dict[name](grid_size), params)
+
 def plot_fn_lyap(img,fig_title,v=None):
-    if v is None:
-        fig, ax = plt.subplots(1,3,figsize=(12, 4))
-    else:
-        fig, ax = plt.subplots(1,4,figsize=(16, 4))
-        v = v / v.abs().max()
-        v = v.detach().cpu().numpy()
-
-    img = img.detach().cpu().numpy()
-    f1 = img[0]
-    f2 = img[1]
-    V = img[2]
-
-    ax[0].imshow(f1)
-    ax[0].set(title="f1")
-    ax[1].imshow(f2)
-    ax[1].set(title="f2")
-    ax[2].imshow(V)
-    ax[2].set(title="DDIM V")
-    if v is not None:
-        ax[3].imshow(v)
-        ax[3].set(title="True V")
-        cbar3 = fig.colorbar(ax[3].imshow(v), ax=ax[3])
-
-
-    cbar0 = fig.colorbar(ax[0].imshow(f1), ax=ax[0])
-    cbar1 = fig.colorbar(ax[1].imshow(f2), ax=ax[1])
-    cbar2 = fig.colorbar(ax[2].imshow(V), ax=ax[2])
-
-    plt.savefig(fig_title)
-
-def plot_fn_step(final,pred_x0,t):
-    f1 = final[0,0,:,:].detach().cpu().numpy()
-    f2 = final[0,1,:,:].detach().cpu().numpy()
-
-    f0_1 = pred_x0[0,0,:,:].detach().cpu().numpy()
-    f0_2 = pred_x0[0,1,:,:].detach().cpu().numpy()
-
-    V = pred_x0[0,2,:,:].detach().cpu().numpy()
-
-    img_dict = {
-        "f1":f1,
-        "f2":f2,
-        "f0_1":f0_1,
-        "f0_2":f0_2,
-        "V":V,
-    }
-
-    for k,v in img_dict.items():
-        plt.imshow(v)
-        plt.savefig("paper_figs/"+k+"_"+str(t)+".png")
+    v = None if v is None else v.detach().cpu().numpy()
+    render_fields(img.detach().cpu().numpy(), fig_title, v)
 
 class GuassianDiffusion:
     """Gaussian diffusion process with 1) Cosine schedule for beta values (https://arxiv.org/abs/2102.09672)
-    2) L_simple training objective from https://arxiv.org/abs/2006.11239.
+    2) L_simple training objective from https://arxiv.org/abs/2006.11239, on an eps, v or x0
+    prediction target (objectives.py).
     """
 
-    def __init__(self, timesteps=1000, device="cuda:0"):
+    def __init__(self, timesteps=1000, device="cuda:0", compile_cache_dir=None, prediction="eps"):
         self.timesteps = timesteps
+        self.prediction = prediction
         self.device = device
+        self.compile_cache_dir = compile_cache_dir
+        self.denoisers = {}
         self.alpha_bar_scheduler = (
             lambda t: math.cos((t / self.timesteps + 0.008) / 1.008 * math.pi / 2) ** 2
         )
@@ -254,19 +246,93 @@ class GuassianDiffusion:
         all_scalars["beta_tilde_log"] = torch.log(all_scalars["beta_tilde"])
         return EasyDict(dict([(k, v.float()) for (k, v) in all_scalars.items()]))
 
-    def sample_from_forward_process(self, x0, t):
+    def sample_from_forward_process(self, x0, t, eps=None):
         """Single step of the forward process, where we add noise in the image.
         Note that we will use this paritcular realization of noise vector (eps) in training.
+        A given eps (e.g. antithetic pairs) is used instead of a fresh draw.
         """
-        eps = torch.randn_like(x0)
+        eps = torch.randn_like(x0) if eps is None else eps
         xt = (
             unsqueeze3x(self.scalars.alpha_bar[t].sqrt()) * x0
             + unsqueeze3x((1 - self.scalars.alpha_bar[t]).sqrt()) * eps
         )
         return xt.float(), eps
 
+    def get_target(self, x0, eps, t):
+        """Training target of the model for its prediction type (see objectives.py)."""
+        return objectives.training_target(self.prediction, self.scalars.alpha_bar[t], x0, eps)
+
+    def get_eps_x0(self, xt, output, t, scalars):
+        """Convert a model output at step t of `scalars` to (pred_eps, clamped pred_x0)."""
+        return objectives.eps_x0_from_output(
+            self.prediction, scalars.alpha_bar[t], xt, output, self.clamp_x0
+        )
+
+    def predict_x0(self, denoiser, final, t, sub_t, scalars, model_kwargs={}, autoencoder=None):
+        """pred_x0 of the control state `final` (in field space) at step sub_t of `scalars`.
+
+        In field space pred_x0 depends on final through the x_t term of get_eps_x0, so the
+        guidance loss also reaches phi through it (the model itself is gradient-free). In
+        latent space the whole encode, denoise and decode runs without autograd and
+        pred_x0 is a fixed target: a differentiable autoencoder would chain the backward
+        pass of every step through the autoencoder passes of all the earlier ones.
+        """
+        if autoencoder is None:
+            output = denoiser(final, t, sub_t, **model_kwargs).clone()
+            # using xt+x0 to derive mu_t, instead of using xt+eps (former is more stable)
+            return self.get_eps_x0(final, output, sub_t, scalars)[1]
+        with torch.no_grad():
+            xt = autoencoder.encode(final)
+            output = denoiser(xt, t, sub_t, **model_kwargs).clone()
+            return autoencoder.decode(self.get_eps_x0(xt, output, sub_t, scalars)[1])
+
+    def get_loss_weights(self, t, min_snr_gamma=None):
+        return objectives.min_snr_weights(self.prediction, self.scalars.alpha_bar[t], min_snr_gamma)
+
+    def get_sampling_scalars(self, timesteps=None):
+        """Scalars of the sub-sampled schedule used by the reverse process.
+
+        Return: the sub-sampled timesteps (of the full process) and their scalars.
+        """
+        timesteps = timesteps or self.timesteps
+        new_timesteps = np.linspace(
+            0, self.timesteps - 1, num=timesteps, endpoint=True, dtype=int
+        )
+        alpha_bar = self.scalars["alpha_bar"][new_timesteps]
+        new_betas = 1 - (
+            alpha_bar / torch.nn.functional.pad(alpha_bar, [1, 0], value=1.0)[:-1]
+        )
+        scalars = self.get_all_scalars(
+            self.alpha_bar_scheduler, timesteps, self.device, new_betas
+        )
+        return new_timesteps, scalars
+
+    def get_denoiser(self, model, compiled=False):
+        """Return the (optionally compiled) gradient-free denoiser for a model."""
+        key = (id(model), compiled)
+        if key not in self.denoisers:
+            denoiser = sampling.Denoiser(model)
+            if compiled:
+                denoiser = sampling.compile_module(
+                    denoiser, self.device, self.compile_cache_dir
+                )
+            self.denoisers[key] = denoiser
+        return self.denoisers[key]
+
     def sample_from_reverse_process(
-        self, model, system, timesteps=None, model_kwargs={}, ddim=False
+        self,
+        model,
+        system,
+        timesteps=None,
+        model_kwargs={},
+        ddim=False,
+        compiled=False,
+        verbose=True,
+        coarse_model=None,
+        coarse_grid_size=32,
+        coarse_fraction=0.5,
+        autoencoder=None,
+        trajectory=None,
     ):
         """Sampling images by iterating over all timesteps.
 
@@ -277,42 +343,56 @@ class GuassianDiffusion:
         model_kwargs: Additional kwargs for model (using it to feed class label for conditioning)
         ddim: Use ddim sampling (https://arxiv.org/abs/2010.02502). With very small number of
             sampling steps, use ddim sampling for better image quality.
-
-        Return: An image tensor with identical shape as XT.
+        compiled: Run the denoiser through a torch.compile'd (and on GPU, CUDA graph) module.
+        verbose: Print the loss at every step and plot the final fields.
+        coarse_model: Optional model trained at coarse_grid_size. If given, the first (high
+            noise) coarse_fraction of the steps run on a coarse_grid_size grid, then V is
+            upsampled and the remaining steps run with `model` on the full grid.
+        autoencoder: Optional FieldAutoencoder of a latent diffusion model. The denoiser then
+            runs on the encoded fields and pred_x0 is decoded for the guidance loss and V.
+            The latent steps run without autograd, so unlike in field space pred_x0 is a
+            fixed target of the loss (see predict_x0).
+        trajectory: Optional trajectory.TrajectoryBuffer capturing x_t, pred_x0, V, the loss
+            and phi of every trajectory.stride-th step.
+
+        Return: The final (f1, f2, V) stack and the controlled system (holding phi).
         """
         model.eval()
+        denoiser = self.get_denoiser(model, compiled)
         # final = xT
 
-        p = system().to("cuda:0")
+        # sub-sampling timesteps for faster sampling
+        timesteps = timesteps or self.timesteps
+        new_timesteps, scalars = self.get_sampling_scalars(timesteps)
+
+        # steps i >= switch run at the coarse resolution
+        grid_size = 64
+        switch = timesteps
+        if coarse_model is not None:
+            switch = timesteps - int(round(coarse_fraction * timesteps))
+        fine_denoiser = denoiser
+        assert autoencoder is None or switch == timesteps, "cascades run in field space"
+        if switch < timesteps:
+            coarse_model.eval()
+            denoiser = self.get_denoiser(coarse_model, compiled)
+
+        p = system(coarse_grid_size if switch < timesteps else grid_size).to(self.device)
         opt = Adam(p.parameters(), lr=0.1)
-        vT = torch.randn((64,64))
+        vT = torch.randn((p.grid_size,p.grid_size), device=self.device)
 
         final = p(vT).unsqueeze(0)
         norm = final[0,:2,:,:].abs().max().detach()
         final = final / norm
 
-        # sub-sampling timesteps for faster sampling
-        timesteps = timesteps or self.timesteps
-        new_timesteps = np.linspace(
-            0, self.timesteps - 1, num=timesteps, endpoint=True, dtype=int
-        )
-        alpha_bar = self.scalars["alpha_bar"][new_timesteps]
-        new_betas = 1 - (
-            alpha_bar / torch.nn.functional.pad(alpha_bar, [1, 0], value=1.0)[:-1]
-        )
-        scalars = self.get_all_scalars(
-            self.alpha_bar_scheduler, timesteps, self.device, new_betas
-        )
-
         for i, t in zip(np.arange(timesteps)[::-1], new_timesteps[::-1]):
             # print(t)
             # with torch.no_grad():
             current_t = torch.tensor([t] * len(final), device=final.device)
             current_sub_t = torch.tensor([i] * len(final), device=final.device)
-            pred_epsilon = model(final, current_t, **model_kwargs).detach()
-            # using xt+x0 to derive mu_t, instead of using xt+eps (former is more stable)
-            pred_x0 = self.get_x0_from_xt_eps(
-                final, pred_epsilon, current_sub_t, scalars
+            if compiled:
+                sampling.mark_step(self.device)
+            pred_x0 = self.predict_x0(
+                denoiser, final, current_t, current_sub_t, scalars, model_kwargs, autoencoder
             )
             pred_x0_f = pred_x0[:,0:2,:,:]
             # print(final[0,1,:,:])
@@ -323,20 +403,89 @@ class GuassianDiffusion:
             opt.zero_grad()
             loss.backward(retain_graph=True)
             opt.step()
-            print("LOSS: ", loss.item(), "PARAMS: ", {"phi1": p.coeffs["phi1"].item(), "phi2": p.coeffs["phi2"].item()})
+            if verbose:
+                print("LOSS: ", loss.item(), "PARAMS: ", {"phi1": p.coeffs["phi1"].item(), "phi2": p.coeffs["phi2"].item()})
+
+            if trajectory is not None and trajectory.should_capture():
+                trajectory.capture(
+                    t,
+                    x_t=final[0],
+                    pred_x0=pred_x0[0],
+                    V=pred_x0_V,
+                    loss=loss,
+                    phi=torch.stack([v.detach().reshape(()) for v in p.parameters()]),
+                )
 
-            # if t in [970,942,898]:
-            #     plot_fn_step(final,pred_x0,t)
+            if i == switch:
+                # finish the low-noise steps on the full grid
+                p.set_grid(grid_size)
+                denoiser = fine_denoiser
+                pred_x0_V = F.interpolate(
+                    pred_x0_V[None, None], size=grid_size, mode="bilinear", align_corners=True
+                )[0, 0]
 
             final = p(pred_x0_V).unsqueeze(0)
             norm = final[0,:2,:,:].abs().max().detach()
             final[0,:2,:,:] = final[0,:2,:,:] / norm
 
         final = p(pred_x0_V).detach()
-        plot_fn_lyap(final, "lyap_results.png")
-        # plot_fn_lyap(final, "lyap_results2.png", p.true_lyap_fn().detach())
-        print("img saved in lyap_results.png")
-        return final
+        if verbose:
+            # rendered on a background thread, off the sampling path
+            render_async(render_fields, final.cpu().numpy(), "lyap_results.png")
+            # plot_fn_lyap(final, "lyap_results2.png", p.true_lyap_fn().detach())
+            print("img rendering to lyap_results.png")
+            roa = estimate_roa_from_stack(final)
+            print("ROA level c: ", roa.c.item(), "ROA area: ", roa.area.item())
+        return final, p
+
+    def control_batch(
+        self, model, systems, timesteps=None, model_kwargs={}, compiled=False, autoencoder=None, vT=None
+    ):
+        """Run the control loop of sample_from_reverse_process for a batch of systems at once.
+
+        systems: GridSystem instances of any of the system_dict types, on the same grid.
+            Each keeps its own phi: the loss is the sum of the per-system losses, so every
+            parameter gets the gradient (and Adam update) it gets in a loop of its own.
+        vT: Optional [N x H x W] starting V of the systems (default: standard normal).
+
+        Return: The final [N x 3 x H x W] stacks and the last loss of every system.
+        """
+        model.eval()
+        denoiser = self.get_denoiser(model, compiled)
+        timesteps = timesteps or self.timesteps
+        new_timesteps, scalars = self.get_sampling_scalars(timesteps)
+
+        systems = [p.to(self.device) for p in systems]
+        grid_size = systems[0].grid_size
+        opt = Adam([w for p in systems for w in p.parameters()], lr=0.1)
+        if vT is None:
+            vT = torch.randn((len(systems), grid_size, grid_size), device=self.device)
+        V = vT.to(self.device)
+
+        final = torch.stack([p(v) for p, v in zip(systems, V)])
+        final = final / final[:, :2].abs().amax(dim=(1, 2, 3), keepdim=True).detach()
+
+        for i, t in zip(np.arange(timesteps)[::-1], new_timesteps[::-1]):
+            current_t = torch.tensor([t] * len(final), device=final.device)
+            current_sub_t = torch.tensor([i] * len(final), device=final.device)
+            if compiled:
+                sampling.mark_step(self.device)
+            pred_x0 = self.predict_x0(
+                denoiser, final, current_t, current_sub_t, scalars, model_kwargs, autoencoder
+            )
+
+            losses = (final[:, :2] - pred_x0[:, :2]).pow(2).mean(dim=(1, 2, 3))
+            opt.zero_grad()
+            losses.sum().backward(retain_graph=True)
+            opt.step()
+
+            V = pred_x0[:, 2]
+            final = torch.stack([p(v) for p, v in zip(systems, V)])
+            norm = final[:, :2].abs().amax(dim=(1, 2, 3), keepdim=True).detach()
+            final = torch.cat([final[:, :2] / norm, final[:, 2:]], dim=1)
+
+        final = torch.stack([p(v) for p, v in zip(systems, V)]).detach()
+        return final, losses.detach()
 
 
 class loss_logger:
@@ -393,9 +542,9 @@ def train_one_epoch(
             args.device
         )
         xt, eps = diffusion.sample_from_forward_process(images, t)
-        pred_eps = model(xt, t, y=labels)
+        output = model(xt, t, y=labels)
 
-        loss = ((pred_eps - eps) ** 2).mean()
+        loss = ((output - diffusion.get_target(images, eps, t)) ** 2).mean()
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
@@ -403,7 +552,7 @@ def train_one_epoch(
             lrs.step()
 
         # update ema_dict
-        if args.local_rank == 0:
+        if args.rank == 0:
             new_dict = model.state_dict()
             for (k, v) in args.ema_dict.items():
                 args.ema_dict[k] = (
@@ -440,27 +589,36 @@ def sample_N_images(
 
     Returns: Numpy array with N images and corresponding labels.
     """
+    from tqdm import tqdm
+
     N = 1
     samples, labels, num_samples = [], [], 0
-    num_processes, group = dist.get_world_size(), dist.group.WORLD
+    _, num_processes, group = world_info()
     with tqdm(total=math.ceil(N / (args.batch_size * num_processes))) as pbar:
         while num_samples < N:
             assert system in system_dict.keys()
             system = system_dict[system]
-            gen_images = diffusion.sample_from_reverse_process(
-                model, system, sampling_steps, {"y": y}, args.ddim
+            gen_images, _ = diffusion.sample_from_reverse_process(
+                model,
+                system,
+                sampling_steps,
+                {"y": None},
+                args.ddim,
+                args.compile,
+                coarse_model=args.coarse_model,
+                coarse_grid_size=args.coarse_image_size,
+                coarse_fraction=args.coarse_fraction,
+                autoencoder=args.autoencoder,
+                trajectory=getattr(args, "trajectory", None),
             )
-            samples_list = [torch.zeros_like(gen_images) for _ in range(num_processes)]
             if args.class_cond:
-                labels_list = [torch.zeros_like(y) for _ in range(num_processes)]
-                dist.all_gather(labels_list, y, group)
-                labels.append(torch.cat(labels_list).detach().cpu().numpy())
+                labels.append(all_gather(y, num_processes, group).detach().cpu().numpy())
 
-            dist.all_gather(samples_list, gen_images, group)
+            gen_images = all_gather(gen_images, num_processes, group)
             if args.dataset in ["poisson","darcy","lyapunov"]:
-                samples.append(torch.cat(samples_list).detach().cpu())
+                samples.append(gen_images.detach().cpu())
             else:
-                samples.append(torch.cat(samples_list).detach().cpu().numpy())
+                samples.append(gen_images.detach().cpu().numpy())
             num_samples += num_processes
             pbar.update(1)
     if args.dataset in ["poisson","darcy","lyapunov"]:
@@ -472,9 +630,18 @@ def sample_N_images(
 
 
 def main():
+    from distributed import add_distributed_args, setup_distributed, wrap_ddp
+
     parser = argparse.ArgumentParser("Minimal implementation of diffusion models")
     # diffusion model
     parser.add_argument("--arch", default="UNet", type=str, help="Neural network architecture")
+    parser.add_argument(
+        "--attention-backend",
+        type=str,
+        default="auto",
+        choices=unets.ATTENTION_BACKENDS,
+        help="Attention implementation (auto picks sdpa when available)",
+    )
     parser.add_argument(
         "--class-cond",
         action="store_true",
@@ -499,6 +666,59 @@ def main():
         default=True,
         help="Sampling using DDIM update step",
     )
+    parser.add_argument(
+        "--prediction",
+        type=str,
+        default=None,
+        choices=objectives.PREDICTIONS,
+        help="Prediction target of the model (default: from the metadata of --pretrained-ckpt, else eps)",
+    )
+    parser.add_argument(
+        "--freeze",
+        action="store_true",
+        default=False,
+        help="Sample with an inference-frozen UNet (precomputed timestep embeddings)",
+    )
+    parser.add_argument(
+        "--denoiser-backend",
+        type=str,
+        default="eager",
+        choices=["eager", "torchscript", "onnx"],
+        help="Run the denoiser from an exported graph (see export.py)",
+    )
+    parser.add_argument("--exported-model", type=str, help="Exported denoiser (with its .json sidecar)")
+    parser.add_argument(
+        "--coarse-ckpt",
+        type=str,
+        default=None,
+        help="Model trained at --coarse-image-size, used for the high-noise steps",
+    )
+    parser.add_argument("--coarse-image-size", type=int, default=32)
+    parser.add_argument(
+        "--coarse-fraction",
+        type=float,
+        default=0.5,
+        help="Fraction of the sampling steps run at the coarse resolution",
+    )
+    parser.add_argument(
+        "--autoencoder-ckpt",
+        type=str,
+        default=None,
+        help="Autoencoder of a latent diffusion model (see main.py --train-autoencoder)",
+    )
+    parser.add_argument("--latent-channels", type=int, default=4)
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        default=False,
+        help="Run the denoiser through a compiled (and on GPU, CUDA graph) module",
+    )
+    parser.add_argument(
+        "--compile-cache-dir",
+        type=str,
+        default="./compile_cache/",
+        help="On-disk cache for compiled graphs, reused across runs",
+    )
     # dataset
     parser.add_argument("--dataset", type=str, default="lyapunov")
     parser.add_argument("--data-dir", type=str, default="./dataset/")
@@ -528,36 +748,67 @@ def main():
         default=50000,
         help="Number of images required to sample from the model",
     )
+    parser.add_argument(
+        "--trajectory-dir",
+        type=str,
+        default=None,
+        help="Capture the control trajectory to memory-mapped arrays in this directory (render with trajectory.py)",
+    )
+    parser.add_argument(
+        "--trajectory-stride", type=int, default=1, help="Capture every n-th sampling step"
+    )
 
     # misc
     parser.add_argument("--save-dir", type=str, default="./trained_models/")
-    parser.add_argument("--local-rank", default=2, type=int)
     parser.add_argument("--seed", default=112233, type=int)
+    add_distributed_args(parser)
 
     # setup
     args = parser.parse_args()
     metadata = get_metadata(args.dataset)
     os.makedirs(args.save_dir, exist_ok=True)
     torch.backends.cudnn.benchmark = True
-    args.device = "cuda:{}".format(args.local_rank)
-    torch.cuda.set_device(args.device)
-    torch.manual_seed(args.seed + args.local_rank)
-    np.random.seed(args.seed + args.local_rank)
-    if args.local_rank == 0:
+    setup_distributed(args)
+    torch.manual_seed(args.seed + args.rank)
+    np.random.seed(args.seed + args.rank)
+    if args.rank == 0:
         print(args)
 
+    # in latent mode the diffusion model works on autoencoder latents instead of fields
+    args.autoencoder = None
+    model_channels, model_size = metadata.num_channels, metadata.image_size
+    if args.autoencoder_ckpt:
+        args.autoencoder = load_autoencoder(
+            args.autoencoder_ckpt, metadata.num_channels, args.latent_channels, args.device
+        )
+        model_channels, model_size, _ = args.autoencoder.latent_shape(metadata.image_size)
+        assert args.sampling_only, "latent diffusion models are trained with main.py"
+
     # Creat model and diffusion process
     model = unets.__dict__[args.arch](
-        image_size=metadata.image_size,
-        in_channels=metadata.num_channels,
-        out_channels=metadata.num_channels,
+        image_size=model_size,
+        in_channels=model_channels,
+        out_channels=model_channels,
         num_classes=metadata.num_classes if args.class_cond else None,
+        attention_backend=args.attention_backend,
     ).to(args.device)
-    if args.local_rank == 0:
+    if args.rank == 0:
         print(
             "We are assuming that model input/ouput pixel range is [-1, 1]. Please adhere to it."
         )
-    diffusion = GuassianDiffusion(args.diffusion_steps, args.device)
+    # the prediction target of a pretrained model is recorded in its metadata
+    args.prediction = (
+        args.prediction or read_metadata(args.pretrained_ckpt).get("prediction") or "eps"
+    )
+    diffusion = GuassianDiffusion(
+        args.diffusion_steps,
+        args.device,
+        args.compile_cache_dir if args.compile else None,
+        args.prediction,
+    )
+    if args.autoencoder is not None:
+        # latents are not bounded to [-1, 1]
+        diffusion.clamp_x0 = lambda x: x
     optimizer = torch.optim.AdamW(model.parameters(), lr=args.lr)
 
     # load pre-trained model
@@ -579,18 +830,50 @@ def main():
         )
         print(f"Loaded pretrained model from {args.pretrained_ckpt}")
 
+    # coarse model for the high-noise steps of a cascaded reverse process
+    args.coarse_model = None
+    if args.coarse_ckpt:
+        args.coarse_model = unets.__dict__[args.arch](
+            image_size=args.coarse_image_size,
+            in_channels=metadata.num_channels,
+            out_channels=metadata.num_channels,
+            attention_backend=args.attention_backend,
+        ).to(args.device)
+        args.coarse_model.load_state_dict(
+            fix_legacy_dict(torch.load(args.coarse_ckpt, map_location=args.device))
+        )
+        print(f"Loaded coarse model from {args.coarse_ckpt}")
+
     # distributed training
-    ngpus = torch.cuda.device_count()
-    if ngpus > 1:
-        if args.local_rank == 0:
-            print(f"Using distributed training on {ngpus} gpus.")
-        args.batch_size = args.batch_size // ngpus
-        torch.distributed.init_process_group(backend="nccl", init_method="env://")
-        model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank)
+    if args.world_size > 1:
+        args.batch_size = args.batch_size // args.world_size
+        model = wrap_ddp(model, args)
 
     # sampling
     if args.sampling_only:
+        if args.freeze:
+            model = unets.freeze_for_inference(
+                model, diffusion.get_sampling_scalars(args.sampling_steps)[0]
+            )
+        if args.denoiser_backend != "eager":
+            import export
+
+            model = export.load_denoiser(
+                args.denoiser_backend, args.exported_model, args.device
+            )
+            if model.takes_step_index:
+                assert (
+                    model.meta["sampling_steps"] == args.sampling_steps
+                ), "exported step was built for a different number of sampling steps"
+            # exported steps already convert the model output to eps
+            diffusion.prediction = (
+                "eps" if model.takes_step_index else model.meta.get("prediction", "eps")
+            )
         print(f"Sampling only")
+        if args.trajectory_dir and args.rank == 0:
+            args.trajectory = TrajectoryBuffer(
+                args.trajectory_dir, args.sampling_steps, args.trajectory_stride
+            )
         sampled_images, labels = sample_N_images(
             args.num_sampled_images,
             model,
@@ -603,6 +886,9 @@ def main():
             metadata.num_classes,
             args,
         )
+        if getattr(args, "trajectory", None) is not None:
+            args.trajectory.close()
+            print(f"Trajectory of {args.trajectory.count} steps saved in {args.trajectory_dir}")
         np.savez(
             os.path.join(
                 args.save_dir,
@@ -614,17 +900,22 @@ def main():
         return
 
     # Load dataset
+    import cv2
+    from torch.utils.data import DataLoader
+    from torch.utils.data.distributed import DistributedSampler
+    from data import get_dataset
+
     train_set = get_dataset(args.dataset, args.data_dir, metadata)
-    sampler = DistributedSampler(train_set) if ngpus > 1 else None
+    sampler = DistributedSampler(train_set) if args.world_size > 1 else None
     train_loader = DataLoader(
         train_set,
         batch_size=args.batch_size,
         shuffle=sampler is None,
         sampler=sampler,
         num_workers=4,
-        pin_memory=True,
+        pin_memory=torch.device(args.device).type == "cuda",
     )
-    if args.local_rank == 0:
+    if args.rank == 0:
         print(
             f"Training dataset loaded: Number of batches: {len(train_loader)}, Number of images: {len(train_set)}"
         )
@@ -638,7 +929,7 @@ def main():
         if sampler is not None:
             sampler.set_epoch(epoch)
         train_one_epoch(model, train_loader, diffusion, optimizer, logger, None, args)
-        if args.local_rank == 0:
+        if args.rank == 0:
             torch.save(
                 model.state_dict(),
                 os.path.join(
@@ -666,7 +957,7 @@ def main():
                 metadata.num_classes,
                 args,
             )
-            if args.local_rank == 0:
+            if args.rank == 0:
                 if args.dataset in ["poisson","darcy","lyapunov"]:
                     torch.save(sampled_images,
                                os.path.join(
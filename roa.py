@@ -0,0 +1,127 @@
+import math
+import torch
+import torch.nn.functional as F
+from easydict import EasyDict
+
+
+def lie_derivative(V, f, extent=(-1.0, 1.0)):
+    """
+    Compute the orbital derivative dV/dt = grad(V) . f on a uniform meshgrid.
+
+    :param V: a [N x H x W] Tensor of Lyapunov values.
+    :param f: a [N x 2 x H x W] Tensor with the closed-loop field (f1, f2).
+              f1 is the velocity along the x1 axis (columns, as produced by
+              np.meshgrid) and f2 the velocity along the x2 axis (rows).
+    :param extent: (low, high) of the square grid in state coordinates.
+    :return: a [N x H x W] Tensor with the value of V dot.
+    """
+    h, w = V.shape[-2:]
+    dx1 = (extent[1] - extent[0]) / (w - 1)
+    dx2 = (extent[1] - extent[0]) / (h - 1)
+    dV_dx2, dV_dx1 = torch.gradient(V, spacing=(dx2, dx1), dim=(-2, -1))
+    return dV_dx1 * f[:, 0] + dV_dx2 * f[:, 1]
+
+
+def minimax_distance(V, seed, max_iters=None, check_every=16):
+    """
+    Connected-component labelling of every sublevel set of V at once.
+
+    Returns D, where D[p] is the smallest level c such that p lies in the same
+    8-connected component of {V <= c} as the seed. The component of the seed in
+    {V <= c} is then simply {D <= c}. D is computed for the whole batch by
+    repeated min-pooling, which converges after (at most) as many sweeps as the
+    longest path inside the grid.
+
+    :param V: a [N x H x W] Tensor.
+    :param seed: a [N x H x W] bool Tensor marking the seed pixels.
+    :param max_iters: upper bound on the number of sweeps (default H * W).
+    :param check_every: number of sweeps between convergence checks.
+    :return: a [N x H x W] Tensor.
+    """
+    max_iters = max_iters or V.shape[-2] * V.shape[-1]
+    D = torch.where(seed, V, torch.full_like(V, math.inf))[:, None]
+    V = V[:, None]
+    for it in range(max_iters):
+        # max_pool2d pads with -inf, i.e. D is padded with +inf outside the grid
+        D_new = torch.maximum(V, torch.minimum(D, -F.max_pool2d(-D, 3, 1, 1)))
+        if not (it + 1) % check_every and torch.equal(D_new, D):
+            break
+        D = D_new
+    return D[:, 0]
+
+
+def estimate_roa(
+    V,
+    f,
+    extent=(-1.0, 1.0),
+    origin=(0.0, 0.0),
+    origin_radius=2,
+    exclude_boundary=True,
+    tol=0.0,
+):
+    """
+    Estimate the region of attraction certified by a batch of Lyapunov fields.
+
+    For every sample we find the largest level c such that V dot < 0 on the
+    connected component of the sublevel set {V <= c} that contains the origin.
+    Levels are swept in sorted order of the grid values of V, so c is always one
+    of the values of V on the grid.
+
+    :param V: a [N x H x W] (or [H x W]) Tensor of Lyapunov values.
+    :param f: a [N x 2 x H x W] (or [2 x H x W]) Tensor with the closed-loop field.
+    :param extent: (low, high) of the square grid in state coordinates.
+    :param origin: the equilibrium in state coordinates.
+    :param origin_radius: pixels within this (grid) distance of the origin are
+                          not required to satisfy V dot < 0, since V dot vanishes
+                          at the equilibrium.
+    :param exclude_boundary: if True, a sublevel set touching the edge of the
+                             grid is not certified, as it may leave the domain.
+    :param tol: V dot must be below -tol to count as decreasing.
+    :return: EasyDict with "c" [N], "area" [N] (in state units) and "mask"
+             [N x H x W] of the certified region.
+    """
+    if V.dim() == 2:
+        V, f = V[None], f[None]
+    V, f = V.float(), f.float()
+    n, h, w = V.shape
+
+    xs = torch.linspace(extent[0], extent[1], w, device=V.device)
+    ys = torch.linspace(extent[0], extent[1], h, device=V.device)
+    r2 = ((xs[None, :] - origin[0]) / (xs[1] - xs[0])) ** 2 + (
+        (ys[:, None] - origin[1]) / (ys[1] - ys[0])
+    ) ** 2
+    seed = (r2 == r2.min()).expand(n, h, w)
+    near_origin = r2 <= origin_radius ** 2
+
+    bad = (lie_derivative(V, f, extent) >= -tol) & ~near_origin
+    if exclude_boundary:
+        edge = torch.zeros(h, w, dtype=torch.bool, device=V.device)
+        edge[0, :] = edge[-1, :] = edge[:, 0] = edge[:, -1] = True
+        bad = bad | edge
+
+    D = minimax_distance(V, seed)
+    # the component of {V <= c} around the origin is bad-free iff c < min D over bad pixels
+    c_bad = torch.where(bad, D, torch.full_like(D, math.inf)).flatten(1).min(dim=1).values
+
+    # sorted sweep: the largest grid value of V strictly below c_bad
+    levels = V.flatten(1).sort(dim=1).values
+    idx = torch.searchsorted(levels, c_bad[:, None].contiguous(), right=False) - 1
+    valid = idx[:, 0] >= 0
+    c = levels.gather(1, idx.clamp(min=0))[:, 0]
+    c = torch.where(valid, c, torch.full_like(c, -math.inf))
+
+    mask = D <= c[:, None, None]
+    cell_area = (extent[1] - extent[0]) ** 2 / ((h - 1) * (w - 1))
+    area = mask.flatten(1).sum(dim=1) * cell_area
+    return EasyDict({"c": c, "area": area, "mask": mask})
+
+
+def estimate_roa_from_stack(img, **kwargs):
+    """
+    Convenience wrapper for the (f1, f2, V) stacks produced by the control loop.
+
+    :param img: a [N x 3 x H x W] (or [3 x H x W]) Tensor.
+    """
+    if img.dim() == 3:
+        img = img[None]
+    return estimate_roa(img[:, 2], img[:, :2], **kwargs)
@@ -0,0 +1,159 @@
+"""
+Streaming, sharded storage of sampled images / fields.
+
+Samples are written in fixed-size shards (shard_00000.npz, ...) next to a
+manifest.json, which is rewritten after every shard. Shards are written to a
+temporary file and renamed, so the manifest only ever lists complete shards and
+an interrupted run resumes after the last of them. Since the noise (and label)
+of every sample is derived from (seed, sample index), a resumed run produces the
+same samples as an uninterrupted one, independently of the batch size and of
+the number of processes.
+"""
+import os
+import json
+from itertools import takewhile
+import numpy as np
+
+import torch
+import torch.distributed as dist
+
+MANIFEST = "manifest.json"
+
+
+def world_info():
+    """Return (rank, world_size, group), also when no process group is initialized."""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size(), dist.group.WORLD
+    return 0, 1, None
+
+
+def all_gather(x, num_processes, group):
+    """Concatenate `x` of every process along the batch dimension."""
+    if num_processes == 1:
+        return x
+    gathered = [torch.zeros_like(x) for _ in range(num_processes)]
+    dist.all_gather(gathered, x, group)
+    return torch.cat(gathered)
+
+
+def sample_seed(seed, index):
+    return (seed << 32) + index
+
+
+def sample_noise(indices, shape, seed, num_classes=None, device="cpu"):
+    """
+    Counter-based noise: sample `index` always gets the same starting noise (and
+    label) for a given seed, whichever batch or process draws it.
+
+    :param indices: iterable of global sample indices.
+    :param shape: (C, H, W) of a single sample.
+    :param num_classes: if given, also draw a label per sample.
+    :return: (xT [N x C x H x W], y [N] or None).
+    """
+    xT, y = [], []
+    for index in indices:
+        g = torch.Generator().manual_seed(sample_seed(seed, int(index)))
+        xT.append(torch.randn(shape, generator=g))
+        if num_classes is not None:
+            y.append(torch.randint(num_classes, (1,), generator=g))
+    xT = torch.stack(xT).to(device)
+    return xT, (torch.cat(y).to(device) if num_classes is not None else None)
+
+
+class ShardWriter:
+    """
+    Write samples to fixed-size shards in `out_dir`, keeping a manifest of the
+    complete ones.
+
+    :param out_dir: directory of the shards and manifest.
+    :param shard_size: number of samples per shard (the last one may be smaller).
+    :param config: run settings stored in the manifest. When resuming, they must
+                   match the manifest, otherwise the shards would mix two runs.
+    :param resume: continue after the last complete shard of an existing manifest.
+    """
+
+    def __init__(self, out_dir, shard_size=1000, config={}, resume=True):
+        self.out_dir = out_dir
+        self.shard_size = shard_size
+        self.manifest = {"shard_size": shard_size, "config": config, "shards": [], "complete": False}
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, MANIFEST)
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            assert (
+                manifest["shard_size"] == shard_size and manifest["config"] == config
+            ), f"{path} was written by a different run: {manifest['config']}"
+            # keep the shards up to the first missing one
+            manifest["shards"] = list(
+                takewhile(lambda s: os.path.exists(os.path.join(out_dir, s["file"])), manifest["shards"])
+            )
+            manifest["complete"] = False
+            self.manifest = manifest
+        self.samples, self.labels = [], []
+
+    @property
+    def num_written(self):
+        """Number of samples in complete shards, i.e. the index to resume from."""
+        return sum(s["count"] for s in self.manifest["shards"])
+
+    @property
+    def num_buffered(self):
+        return sum(len(s) for s in self.samples)
+
+    def add(self, samples, labels=None):
+        """Buffer a batch of samples, writing every full shard."""
+        self.samples.append(np.asarray(samples))
+        if labels is not None:
+            self.labels.append(np.asarray(labels))
+        while self.num_buffered >= self.shard_size:
+            self.flush(self.shard_size)
+
+    def flush(self, count=None):
+        """Write the first `count` buffered samples (default: all) as one shard."""
+        if not self.samples:
+            return
+        samples = np.concatenate(self.samples)
+        labels = np.concatenate(self.labels) if self.labels else None
+        count = count or len(samples)
+        name = f"shard_{len(self.manifest['shards']):05d}.npz"
+        tmp = os.path.join(self.out_dir, name + ".tmp")
+        with open(tmp, "wb") as f:
+            if labels is None:
+                np.savez(f, samples[:count])
+            else:
+                np.savez(f, samples[:count], labels[:count])
+        os.replace(tmp, os.path.join(self.out_dir, name))
+        self.manifest["shards"].append({"file": name, "start": self.num_written, "count": count})
+        self.write_manifest()
+        self.samples = [samples[count:]] if count < len(samples) else []
+        self.labels = [labels[count:]] if labels is not None and count < len(labels) else []
+
+    def close(self):
+        """Write the remaining samples and mark the run as complete."""
+        self.flush()
+        self.manifest["complete"] = True
+        self.write_manifest()
+
+    def write_manifest(self):
+        path = os.path.join(self.out_dir, MANIFEST)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+
+def load_shards(out_dir):
+    """
+    Load all samples listed in the manifest of `out_dir`.
+
+    Return: (samples, labels), labels is None for unconditional runs.
+    """
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    samples, labels = [], []
+    for s in manifest["shards"]:
+        with np.load(os.path.join(out_dir, s["file"])) as shard:
+            samples.append(shard["arr_0"])
+            if "arr_1" in shard:
+                labels.append(shard["arr_1"])
+    return np.concatenate(samples), (np.concatenate(labels) if labels else None)
@@ -0,0 +1,220 @@
+import os
+import argparse
+import numpy as np
+from time import time
+from easydict import EasyDict
+
+import torch
+from torch import nn
+
+
+def model_timesteps(model, t, sub_t):
+    """
+    Frozen models (unets.FrozenUNet) are indexed by the step of their schedule
+    instead of the timestep of the full diffusion process.
+    """
+    return sub_t if getattr(model, "takes_step_index", False) else t
+
+
+class ReverseStep(nn.Module):
+    """
+    A single update of the reverse process (denoiser + update math) with a
+    fixed sub-sampled schedule, so it can be compiled as one graph.
+
+    :param model: diffusion model, called as model(x, t, **model_kwargs).
+    :param diffusion: GuassianDiffusion providing the x0 / posterior mean helpers.
+    :param scalars: the (sub-sampled) schedule scalars used by the sampler.
+    :param ddim: use the deterministic DDIM update.
+    """
+
+    def __init__(self, model, diffusion, scalars, ddim=False):
+        super().__init__()
+        self.model = model
+        self.diffusion = diffusion
+        self.scalars = scalars
+        self.ddim = ddim
+
+    def forward(self, xt, t, sub_t, noise, y=None):
+        """
+        :param xt: an [N x C x H x W] Tensor, the current state.
+        :param t: an [N] Tensor of timesteps of the full diffusion process.
+        :param sub_t: an [N] Tensor of indices into the sub-sampled schedule.
+        :param noise: an [N x C x H x W] Tensor, used by the non-DDIM update.
+        :return: (pred_mean, x_prev). At the last step pred_mean is the sample.
+        """
+        scalars = self.scalars
+        output = self.model(xt, model_timesteps(self.model, t, sub_t), y=y)
+        # using xt+x0 to derive mu_t, instead of using xt+eps (former is more stable)
+        pred_epsilon, pred_x0 = self.diffusion.get_eps_x0(xt, output, sub_t, scalars)
+        pred_mean = self.diffusion.get_pred_mean_from_x0_xt(xt, pred_x0, sub_t, scalars)
+        if self.ddim:
+            alpha_bar_prev = scalars.alpha_bar[sub_t - 1][..., None, None, None]
+            x_prev = alpha_bar_prev.sqrt() * pred_x0 + (1 - alpha_bar_prev).sqrt() * pred_epsilon
+        else:
+            x_prev = pred_mean + scalars.beta_tilde[sub_t].sqrt()[..., None, None, None] * noise
+        return pred_mean, x_prev
+
+
+class DenoiseStep(nn.Module):
+    """
+    Self-contained denoise step for a sub-sampled schedule: (x_t, step) -> (pred_eps,
+    pred_x0), with the schedule stored as buffers so the step can be exported as one graph.
+    The model output is converted according to diffusion.prediction, so exported steps
+    always return eps.
+
+    :param model: diffusion model (or an inference-frozen one).
+    :param diffusion: GuassianDiffusion providing the schedule and the x0 helper.
+    :param timesteps: number of sampling steps of the schedule.
+    """
+
+    def __init__(self, model, diffusion, timesteps):
+        super().__init__()
+        self.model = model
+        self.diffusion = diffusion
+        new_timesteps, scalars = diffusion.get_sampling_scalars(timesteps)
+        self.register_buffer("timesteps", torch.as_tensor(new_timesteps, dtype=torch.int64))
+        self.register_buffer("alpha_bar", scalars.alpha_bar.cpu())
+
+    def forward(self, xt, step):
+        t = self.timesteps[step]
+        output = self.model(xt, model_timesteps(self.model, t, step))
+        return self.diffusion.get_eps_x0(
+            xt, output, step, EasyDict({"alpha_bar": self.alpha_bar})
+        )
+
+
+class Denoiser(nn.Module):
+    """
+    Gradient-free denoiser forward, for loops (like the guided control loop) where
+    the update math needs autograd through the state but not through the model.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, xt, t, sub_t, y=None):
+        with torch.no_grad():
+            return self.model(xt.detach(), model_timesteps(self.model, t, sub_t), y=y)
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Persist compiled graphs across processes. Must be called before the first compilation.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(cache_dir)
+    import torch._inductor.config as inductor_config
+
+    inductor_config.fx_graph_cache = True
+
+
+def uses_cudagraphs(device):
+    return torch.device(device).type == "cuda"
+
+
+def compile_module(module, device, cache_dir=None):
+    """
+    Compile a fixed-shape module. On GPU we use CUDA graphs (mode="reduce-overhead")
+    so that the whole step is replayed without per-kernel launch overhead, on CPU
+    the default inductor backend is used.
+    """
+    if cache_dir:
+        enable_compile_cache(cache_dir)
+    mode = "reduce-overhead" if uses_cudagraphs(device) else "default"
+    return torch.compile(module, mode=mode, dynamic=False)
+
+
+def mark_step(device):
+    """
+    Call before every invocation of a compiled module whose previous outputs are
+    fed back as inputs (CUDA graphs reuse their output buffers).
+    """
+    if uses_cudagraphs(device):
+        torch.compiler.cudagraph_mark_step_begin()
+
+
+def warmup(diffusion, model, shape, timesteps=None, ddim=False, model_kwargs={}, iters=3):
+    """
+    Trigger compilation (and CUDA graph capture) of the reverse step for a given
+    input shape and schedule, so that the first real sampling call is fast.
+
+    Return: seconds spent in the warm-up.
+    """
+    start = time()
+    xT = torch.randn(shape, device=diffusion.device)
+    step, _ = diffusion.get_reverse_step(model, timesteps, ddim, compiled=True)
+    t = torch.zeros(shape[0], dtype=torch.int64, device=diffusion.device)
+    with torch.no_grad():
+        for _ in range(iters):
+            mark_step(diffusion.device)
+            step(xT, t, t + 1, torch.zeros_like(xT), **model_kwargs)
+    if uses_cudagraphs(diffusion.device):
+        torch.cuda.synchronize()
+    return time() - start
+
+
+def benchmark_sampler(diffusion, model, shape, timesteps=50, ddim=True, repeats=3):
+    """
+    Compare eager and compiled sampling with the same model and schedule.
+
+    Return: EasyDict with the warm-up time and mean seconds per sampling call
+        for both modes.
+    """
+
+    def run(compiled):
+        times = []
+        for _ in range(repeats):
+            xT = torch.randn(shape, device=diffusion.device)
+            start = time()
+            diffusion.sample_from_reverse_process(
+                model, xT, timesteps, {"y": None}, ddim, compiled=compiled
+            )
+            if uses_cudagraphs(diffusion.device):
+                torch.cuda.synchronize()
+            times.append(time() - start)
+        return float(np.mean(times))
+
+    warmup_time = warmup(diffusion, model, shape, timesteps, ddim)
+    eager, compiled = run(False), run(True)
+    return EasyDict(
+        {
+            "warmup_s": warmup_time,
+            "eager_s": eager,
+            "compiled_s": compiled,
+            "eager_steps_per_s": timesteps / eager,
+            "compiled_steps_per_s": timesteps / compiled,
+            "speedup": eager / compiled,
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("Eager vs compiled reverse process")
+    parser.add_argument("--arch", type=str, default="UNetSmall")
+    parser.add_argument("--image-size", type=int, default=64)
+    parser.add_argument("--num-channels", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--sampling-steps", type=int, default=50)
+    parser.add_argument("--ddim", action="store_true", default=False)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--compile-cache-dir", type=str, default="./compile_cache/")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    import unets
+    from main import GuassianDiffusion
+
+    enable_compile_cache(args.compile_cache_dir)
+    model = unets.__dict__[args.arch](
+        image_size=args.image_size,
+        in_channels=args.num_channels,
+        out_channels=args.num_channels,
+    ).to(args.device)
+    diffusion = GuassianDiffusion(1000, args.device)
+    shape = (args.batch_size, args.num_channels, args.image_size, args.image_size)
+    print(benchmark_sampler(diffusion, model, shape, args.sampling_steps, args.ddim, args.repeats))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,5 +2,9 @@
 
 # Change data-dir to refer to the path of training dataset on your machine
 # Following datasets needs to be manually downloaded before training: melanoma, afhq, celeba, cars, flowers, gtsrb.
-CUDA_VISIBLE_DEVICES=1,2,3,4 python -m torch.distributed.launch --nproc_per_node=4 main.py \
+CUDA_VISIBLE_DEVICES=1,2,3,4 torchrun --nproc_per_node=4 main.py \
     --arch UNet --dataset lyapunov --epochs 500
+
+# Coarse (32x32) model for the cascaded control loop (restoration_control.py --coarse-ckpt)
+CUDA_VISIBLE_DEVICES=1,2,3,4 torchrun --nproc_per_node=4 main.py \
+    --arch UNet --dataset lyapunov --epochs 500 --image-size 32
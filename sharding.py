@@ -0,0 +1,160 @@
+"""
+Sharding of the training state across data-parallel processes, for models such as
+UNetBig whose replicated optimizer state and EMA cap the batch size per process.
+
+    none: DDP. Every process holds the model and the AdamW state, rank 0 the EMA.
+    zero: DDP with ZeroRedundancyOptimizer, every process holds the AdamW state of
+          1 / world_size of the parameters.
+    fsdp: fully_shard (FSDP2) with one unit per ResBlock / AttentionBlock, on GPU or
+          CPU (gloo). Parameters, gradients, AdamW state and EMA are all sharded,
+          every process keeps the EMA of its own parameter shards.
+
+With --ema-device cpu, the EMA is kept in host memory instead. Checkpoints are
+consolidated: rank 0 saves full state dicts, so the exported model and EMA do not
+depend on the sharding, and a checkpoint resumes with any number of processes.
+"""
+from contextlib import contextmanager
+
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from torch.distributed.fsdp import fully_shard
+from torch.distributed.tensor import DTensor, distribute_tensor
+from torch.distributed.checkpoint.state_dict import (
+    StateDictOptions,
+    get_model_state_dict,
+    get_optimizer_state_dict,
+    set_model_state_dict,
+    set_optimizer_state_dict,
+)
+
+from distributed import wrap_ddp
+from checkpoint import match_keys
+import unets
+
+SHARDING = ("none", "zero", "fsdp")
+
+# full state dicts, gathered on rank 0 in host memory
+FULL_STATE_DICT = StateDictOptions(full_state_dict=True, cpu_offload=True)
+
+
+def wrap_model(model, args):
+    """Wrap `model` for data-parallel training with args.sharding."""
+    if args.sharding == "fsdp":
+        for module in model.modules():
+            if isinstance(module, (unets.ResBlock, unets.AttentionBlock)):
+                fully_shard(module)
+        return fully_shard(model)
+    if args.world_size > 1:
+        return wrap_ddp(model, args)
+    return model
+
+
+def create_optimizer(model, args):
+    """AdamW, with its state sharded over the processes for --sharding zero."""
+    if args.sharding == "zero" and args.world_size > 1:
+        return ZeroRedundancyOptimizer(
+            model.parameters(), optimizer_class=torch.optim.AdamW, lr=args.lr
+        )
+    return torch.optim.AdamW(model.parameters(), lr=args.lr)
+
+
+@contextmanager
+def gradient_sync(model, enabled=True):
+    """Skip the gradient reduction of DDP / FSDP inside the block unless enabled (gradient accumulation)."""
+    if enabled:
+        yield
+    elif hasattr(model, "no_sync"):
+        with model.no_sync():
+            yield
+    elif hasattr(model, "set_requires_gradient_sync"):
+        model.set_requires_gradient_sync(False)
+        try:
+            yield
+        finally:
+            model.set_requires_gradient_sync(True)
+    else:
+        yield
+
+
+def ema_device(args):
+    return args.ema_device or args.device
+
+
+def ema_source(model, args):
+    """Tensors tracked by the EMA: the local parameter shards under FSDP, the state dict otherwise."""
+    if getattr(args, "sharding", "none") == "fsdp":
+        return {k: p.detach().to_local() for k, p in model.named_parameters()}
+    return model.state_dict()
+
+
+def init_ema(model, args):
+    """EMA of this process: its shards under FSDP, the full state dict on rank 0, None elsewhere."""
+    if args.sharding != "fsdp" and args.rank != 0:
+        return None
+    return {k: v.detach().to(ema_device(args), copy=True) for k, v in ema_source(model, args).items()}
+
+
+def update_ema(ema_dict, model, args):
+    if ema_dict is None:
+        return
+    for k, v in ema_source(model, args).items():
+        ema_dict[k] = args.ema_w * ema_dict[k] + (1 - args.ema_w) * v.to(ema_dict[k].device)
+
+
+def gather_ema(model, ema_dict):
+    """Full EMA tensors from the shards of all processes. Collective call."""
+    full = {}
+    for k, p in model.named_parameters():
+        shard = DTensor.from_local(
+            ema_dict[k].to(p.device), p.device_mesh, p.placements, shape=p.shape, stride=p.stride()
+        )
+        full[k] = shard.full_tensor().cpu()
+    return full
+
+
+def consolidated_state(model, ema_dict, optimizer, args):
+    """
+    Full (model, EMA, optimizer) state dicts on rank 0 and (None, None, None) on the
+    other ranks. Collective call under zero and fsdp.
+    """
+    if args.sharding == "fsdp":
+        model_state = get_model_state_dict(model, options=FULL_STATE_DICT)
+        optimizer_state = get_optimizer_state_dict(model, optimizer, options=FULL_STATE_DICT)
+        ema_state = gather_ema(model, ema_dict)
+    else:
+        if isinstance(optimizer, ZeroRedundancyOptimizer):
+            optimizer.consolidate_state_dict(to=0)
+        model_state, ema_state = model.state_dict(), ema_dict
+        optimizer_state = optimizer.state_dict() if args.rank == 0 else None
+    if args.rank != 0:
+        return None, None, None
+    return model_state, ema_state, optimizer_state
+
+
+def load_state(state, model, optimizer, args):
+    """
+    checkpoint.resume loader: restore model and optimizer from the full state dicts of
+    a checkpoint and return the EMA of this process (see init_ema).
+    """
+    if args.sharding != "fsdp":
+        reference = model.state_dict()
+        model.load_state_dict(match_keys(state["model"], reference))
+        optimizer.load_state_dict(state["optimizer"])
+        if args.rank != 0:
+            return None
+        return {k: v.to(ema_device(args)) for k, v in match_keys(state["ema"], reference).items()}
+    # every rank reads the full state dicts and keeps its shards
+    params = dict(model.named_parameters())
+    set_model_state_dict(
+        model, match_keys(state["model"], params), options=StateDictOptions(full_state_dict=True)
+    )
+    set_optimizer_state_dict(
+        model, optimizer, state["optimizer"], options=StateDictOptions(full_state_dict=True)
+    )
+    ema = match_keys(state["ema"], params)
+    return {
+        k: distribute_tensor(ema[k].to(p.device), p.device_mesh, p.placements)
+        .to_local()
+        .to(ema_device(args))
+        for k, p in params.items()
+    }
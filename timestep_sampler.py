@@ -0,0 +1,129 @@
+"""
+Strategies to draw the diffusion timesteps of a training batch.
+
+Samplers return the timesteps together with importance weights 1 / (T * p(t)),
+so that the weighted loss is an unbiased estimate of the loss under uniform
+timesteps whatever distribution p the sampler uses. With stratified=True, the
+timesteps of a batch are drawn from one stratum each of the (inverse) CDF of p,
+which spreads them over the noise levels and lowers the variance of the loss.
+"""
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+
+TIMESTEP_SAMPLERS = ("uniform", "loss-aware")
+
+
+def uniform_draws(batch_size, device, stratified=False):
+    """
+    Uniform numbers in [0, 1). Stratified draws put exactly one number in each of the
+    batch_size strata [i / batch_size, (i + 1) / batch_size), in random order.
+    """
+    u = torch.rand(batch_size, device=device)
+    if stratified:
+        u = (torch.randperm(batch_size, device=device) + u) / batch_size
+    return u
+
+
+class UniformSampler:
+    def __init__(self, timesteps):
+        self.timesteps = timesteps
+
+    def sample(self, batch_size, device, stratified=False):
+        u = uniform_draws(batch_size, device, stratified)
+        t = (u * self.timesteps).long().clamp(max=self.timesteps - 1)
+        return t, torch.ones(batch_size, device=device)
+
+    def update(self, t, losses):
+        pass
+
+    def state_dict(self):
+        return {}
+
+    def load_state_dict(self, state):
+        pass
+
+
+class LossAwareSampler:
+    """
+    Sample timesteps proportionally to the RMS of their recent loss.
+
+    The timesteps are grouped in `num_buckets` contiguous buckets. Each bucket keeps
+    the last `history` losses seen at its timesteps, a bucket is drawn with
+    probability proportional to the RMS of its history and t uniformly within it.
+    Timesteps are uniform until every bucket has a full history, and a fraction
+    `uniform_prob` of the probability mass always stays uniform.
+
+    The history lives on the device and is updated without host syncs. With a
+    process group, losses of all processes are gathered so that every process
+    keeps the same history.
+    """
+
+    def __init__(self, timesteps, num_buckets=50, history=10, uniform_prob=0.001, device="cpu"):
+        self.timesteps = timesteps
+        self.num_buckets = num_buckets
+        self.history = history
+        self.uniform_prob = uniform_prob
+        # bucket of every timestep and number of timesteps per bucket
+        self.bucket_of = torch.arange(timesteps, device=device) * num_buckets // timesteps
+        self.bucket_size = torch.bincount(self.bucket_of, minlength=num_buckets).float()
+        self.bucket_start = torch.cumsum(self.bucket_size, 0) - self.bucket_size
+        self.losses = torch.zeros(num_buckets, history, device=device)
+        self.counts = torch.zeros(num_buckets, dtype=torch.int64, device=device)
+
+    def bucket_probs(self):
+        rms = self.losses.pow(2).mean(dim=1).sqrt()
+        probs = rms / rms.sum().clamp(min=1e-12)
+        probs = (1 - self.uniform_prob) * probs + self.uniform_prob * self.bucket_size / self.timesteps
+        uniform = self.bucket_size / self.timesteps
+        return torch.where((self.counts >= self.history).all(), probs, uniform)
+
+    def timestep_probs(self):
+        """p(t) for every timestep."""
+        return (self.bucket_probs() / self.bucket_size)[self.bucket_of]
+
+    def sample(self, batch_size, device, stratified=False):
+        probs = self.bucket_probs()
+        # inverse CDF of the bucket distribution
+        u = uniform_draws(batch_size, probs.device, stratified)
+        buckets = torch.searchsorted(torch.cumsum(probs, 0), u, right=True).clamp(max=self.num_buckets - 1)
+        offset = (torch.rand(batch_size, device=probs.device) * self.bucket_size[buckets]).long()
+        t = (self.bucket_start[buckets].long() + offset).clamp(max=self.timesteps - 1)
+        weights = 1 / (self.timesteps * (probs / self.bucket_size)[buckets])
+        return t.to(device), weights.to(device)
+
+    def update(self, t, losses):
+        """Add the per-sample losses of a batch to the history of their buckets."""
+        t, losses = t.to(self.losses.device), losses.detach().float().to(self.losses.device)
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            t_all = [torch.zeros_like(t) for _ in range(dist.get_world_size())]
+            losses_all = [torch.zeros_like(losses) for _ in range(dist.get_world_size())]
+            dist.all_gather(t_all, t)
+            dist.all_gather(losses_all, losses)
+            t, losses = torch.cat(t_all), torch.cat(losses_all)
+        buckets = self.bucket_of[t]
+        one_hot = F.one_hot(buckets, self.num_buckets)
+        # position of every sample among the samples of its bucket in this batch
+        occurrence = (one_hot.cumsum(0) - 1).gather(1, buckets[:, None])[:, 0]
+        in_batch = one_hot.sum(0)
+        # only the last `history` samples of a bucket are kept, so no slot is written twice
+        keep = occurrence >= in_batch[buckets] - self.history
+        buckets, occurrence, losses = buckets[keep], occurrence[keep], losses[keep]
+        slots = (self.counts[buckets] + occurrence) % self.history
+        self.losses[buckets, slots] = losses
+        self.counts += in_batch
+
+    def state_dict(self):
+        return {"losses": self.losses, "counts": self.counts}
+
+    def load_state_dict(self, state):
+        self.losses.copy_(state["losses"])
+        self.counts.copy_(state["counts"])
+
+
+def create_timestep_sampler(name, timesteps, device="cpu", **kwargs):
+    if name == "uniform":
+        return UniformSampler(timesteps)
+    if name == "loss-aware":
+        return LossAwareSampler(timesteps, device=device, **kwargs)
+    raise ValueError(f"unknown timestep sampler: {name}")
@@ -0,0 +1,163 @@
+"""
+Capture of the intermediate states of the control loop, and their rendering off the
+sampling path.
+
+TrajectoryBuffer preallocates one memory-mapped .npy file per quantity (x_t, pred_x0,
+V, loss, phi) and every `stride`-th step of the reverse process copies its tensors
+into the next slot, so capturing costs the device-to-host copies and nothing else.
+Figures are drawn later with the Agg backend (no display, no pyplot state), either on
+a background thread (render_async) or offline:
+
+    python trajectory.py --dir ./trajectory --out ./figures --every 10
+"""
+import os
+import json
+import math
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch.nn.functional as F
+from easydict import EasyDict
+
+
+class TrajectoryBuffer:
+    """
+    :param out_dir: directory of the .npy files and of meta.json.
+    :param num_steps: number of steps of the reverse process.
+    :param stride: capture every `stride`-th step, starting with the first one.
+    :param grid_size: grid of the stored fields. States of coarse steps (cascades) are
+                      upsampled to it.
+
+    The files are allocated at the first capture, with the shapes of its tensors.
+    """
+
+    def __init__(self, out_dir, num_steps, stride=1, grid_size=64):
+        self.out_dir = out_dir
+        self.stride = stride
+        self.grid_size = grid_size
+        self.capacity = math.ceil(num_steps / stride)
+        self.arrays = None
+        self.calls = 0
+        self.count = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def should_capture(self):
+        """Advance by one step, True if the step is captured (so its tensors are worth gathering)."""
+        self.calls += 1
+        return (self.calls - 1) % self.stride == 0 and self.count < self.capacity
+
+    def allocate(self, arrays):
+        self.arrays = {
+            name: np.lib.format.open_memmap(
+                os.path.join(self.out_dir, f"{name}.npy"),
+                mode="w+",
+                dtype=x.dtype,
+                shape=(self.capacity, *x.shape),
+            )
+            for name, x in arrays.items()
+        }
+
+    def to_host(self, x):
+        x = x.detach()
+        if x.dim() >= 2 and x.shape[-1] != self.grid_size:
+            shape = x.shape
+            x = F.interpolate(
+                x.float().reshape(1, -1, *shape[-2:]), size=self.grid_size, mode="bilinear", align_corners=True
+            ).reshape(*shape[:-2], self.grid_size, self.grid_size)
+        return x.cpu().numpy()
+
+    def capture(self, t, **tensors):
+        """Store the tensors of a step (e.g. x_t, pred_x0, V, loss, phi) at timestep t."""
+        arrays = {name: self.to_host(x) for name, x in tensors.items()}
+        arrays["t"] = np.asarray(t, dtype=np.int64)
+        if self.arrays is None:
+            self.allocate(arrays)
+        for name, x in arrays.items():
+            self.arrays[name][self.count] = x
+        self.count += 1
+
+    def close(self):
+        names = list(self.arrays or {})
+        for array in (self.arrays or {}).values():
+            array.flush()
+        with open(os.path.join(self.out_dir, "meta.json"), "w") as f:
+            json.dump({"count": self.count, "stride": self.stride, "grid_size": self.grid_size, "names": names}, f)
+
+
+def load_trajectory(out_dir):
+    """The captured steps of a TrajectoryBuffer, as memory-mapped arrays."""
+    with open(os.path.join(out_dir, "meta.json")) as f:
+        meta = json.load(f)
+    return EasyDict(
+        {
+            name: np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode="r")[: meta["count"]]
+            for name in meta["names"]
+        }
+    )
+
+
+def render_panels(panels, path, ncols=None):
+    """Save {title: 2D array} as one row of heatmaps with a colorbar each, with the Agg backend."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    ncols = ncols or len(panels)
+    nrows = math.ceil(len(panels) / ncols)
+    fig = Figure(figsize=(4 * ncols, 4 * nrows))
+    FigureCanvasAgg(fig)
+    for k, (title, image) in enumerate(panels.items()):
+        ax = fig.add_subplot(nrows, ncols, k + 1)
+        fig.colorbar(ax.imshow(image), ax=ax)
+        ax.set(title=title)
+    fig.savefig(path)
+
+
+def render_fields(stack, path, v=None):
+    """(f1, f2, V) panels of a [3 x H x W] array, with an optional reference V."""
+    panels = {"f1": stack[0], "f2": stack[1], "DDIM V": stack[2]}
+    if v is not None:
+        panels["True V"] = v / np.abs(v).max()
+    render_panels(panels, path)
+
+
+def render_trajectory(out_dir, fig_dir, every=1):
+    """Render every `every`-th captured step of a trajectory to <fig_dir>/step_<t>.png."""
+    os.makedirs(fig_dir, exist_ok=True)
+    traj = load_trajectory(out_dir)
+    for k in range(0, len(traj.t), every):
+        phi = ", ".join(f"{p:.3f}" for p in traj.phi[k])
+        panels = {
+            "f1 (x_t)": traj.x_t[k, 0],
+            "f2 (x_t)": traj.x_t[k, 1],
+            "f1 (pred x0)": traj.pred_x0[k, 0],
+            "f2 (pred x0)": traj.pred_x0[k, 1],
+            f"V, loss {traj.loss[k]:.4f}, phi ({phi})": traj.V[k],
+        }
+        render_panels(panels, os.path.join(fig_dir, f"step_{traj.t[k]:04d}.png"))
+    return len(range(0, len(traj.t), every))
+
+
+_renderer = None
+
+
+def render_async(fn, *args):
+    """Run a render function (with host arrays) on a background thread, return its future."""
+    global _renderer
+    if _renderer is None:
+        _renderer = ThreadPoolExecutor(max_workers=1)
+    return _renderer.submit(fn, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser("Render a captured control trajectory")
+    parser.add_argument("--dir", type=str, required=True, help="Directory of the TrajectoryBuffer")
+    parser.add_argument("--out", type=str, required=True, help="Directory of the figures")
+    parser.add_argument("--every", type=int, default=1, help="Render every n-th captured step")
+    args = parser.parse_args()
+    n = render_trajectory(args.dir, args.out, args.every)
+    print(f"Rendered {n} steps to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
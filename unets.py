@@ -1,11 +1,13 @@
 # Borrowed from https://github.com/openai/guided-diffusion
 from abc import abstractmethod
 
+import copy
 import math
 import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 
 class GroupNorm32(nn.GroupNorm):
@@ -107,45 +109,17 @@ def checkpoint(func, inputs, params, flag):
     :param func: the function to evaluate.
     :param inputs: the argument sequence to pass to `func`.
     :param params: a sequence of parameters `func` depends on but does not
-                   explicitly take as arguments.
+                   explicitly take as arguments. Unused by the non-reentrant
+                   implementation, kept for API compatibility.
     :param flag: if False, disable gradient checkpointing.
     """
-    if flag:
-        args = tuple(inputs) + tuple(params)
-        return CheckpointFunction.apply(func, len(inputs), *args)
+    if flag and th.is_grad_enabled():
+        return th.utils.checkpoint.checkpoint(func, *inputs, use_reentrant=False)
     else:
         return func(*inputs)
 
 
-class CheckpointFunction(th.autograd.Function):
-    @staticmethod
-    def forward(ctx, run_function, length, *args):
-        ctx.run_function = run_function
-        ctx.input_tensors = list(args[:length])
-        ctx.input_params = list(args[length:])
-        with th.no_grad():
-            output_tensors = ctx.run_function(*ctx.input_tensors)
-        return output_tensors
-
-    @staticmethod
-    def backward(ctx, *output_grads):
-        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
-        with th.enable_grad():
-            # Fixes a bug where the first op in run_function modifies the
-            # Tensor storage in place, which is not allowed for detach()'d
-            # Tensors.
-            shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
-            output_tensors = ctx.run_function(*shallow_copies)
-        input_grads = th.autograd.grad(
-            output_tensors,
-            ctx.input_tensors + ctx.input_params,
-            output_grads,
-            allow_unused=True,
-        )
-        del ctx.input_tensors
-        del ctx.input_params
-        del output_tensors
-        return (None, None) + input_grads
+CHECKPOINT_POLICIES = ("none", "attention", "resolutions", "all")
 
 
 class AttentionPool2d(nn.Module):
@@ -398,6 +372,7 @@ class AttentionBlock(nn.Module):
         num_head_channels=-1,
         use_checkpoint=False,
         use_new_attention_order=False,
+        attention_backend="auto",
     ):
         super().__init__()
         self.channels = channels
@@ -413,15 +388,15 @@ class AttentionBlock(nn.Module):
         self.qkv = conv_nd(1, channels, channels * 3, 1)
         if use_new_attention_order:
             # split qkv before split heads
-            self.attention = QKVAttention(self.num_heads)
+            self.attention = QKVAttention(self.num_heads, attention_backend)
         else:
             # split heads before split qkv
-            self.attention = QKVAttentionLegacy(self.num_heads)
+            self.attention = QKVAttentionLegacy(self.num_heads, attention_backend)
 
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
@@ -452,14 +427,74 @@ def count_flops_attn(model, _x, y):
     model.total_ops += th.DoubleTensor([matmul_ops])
 
 
+ATTENTION_BACKENDS = ("auto", "einsum", "sdpa", "chunked")
+
+
+def resolve_attention_backend(backend):
+    """
+    Map "auto" to the fastest backend available in this torch build.
+    """
+    assert backend in ATTENTION_BACKENDS, f"unsupported attention backend: {backend}"
+    if backend == "auto":
+        return "sdpa" if hasattr(F, "scaled_dot_product_attention") else "chunked"
+    return backend
+
+
+def qkv_attention(q, k, v, backend="auto", chunk_size=256):
+    """
+    Scaled dot-product attention over the last (token) dimension.
+
+    :param q, k, v: [B x C x T] Tensors of queries, keys and values.
+    :param backend: "einsum" builds the full [B x T x T] weight matrix,
+                    "sdpa" uses F.scaled_dot_product_attention (fused /
+                    memory-efficient kernels), "chunked" processes
+                    `chunk_size` queries at a time to bound the weight matrix
+                    to [B x chunk_size x T] (fallback for older torch versions),
+                    "auto" picks one with resolve_attention_backend.
+    :return: a [B x C x T] Tensor.
+    """
+    backend = resolve_attention_backend(backend)
+    ch = q.shape[1]
+    if backend == "sdpa":
+        a = F.scaled_dot_product_attention(
+            q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        )
+        return a.transpose(1, 2)
+    scale = 1 / math.sqrt(math.sqrt(ch))
+    q, k = q * scale, k * scale  # More stable with f16 than dividing afterwards
+    if backend == "chunked":
+        out = []
+        for qc in q.split(chunk_size, dim=2):
+            weight = th.einsum("bct,bcs->bts", qc, k)
+            weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
+            out.append(th.einsum("bts,bcs->bct", weight, v))
+        return th.cat(out, dim=2)
+    weight = th.einsum("bct,bcs->bts", q, k)
+    weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
+    return th.einsum("bts,bcs->bct", weight, v)
+
+
+def set_attention_backend(model, backend):
+    """
+    Switch the attention backend of every attention layer in `model`. Attention
+    layers have no parameters, so this does not affect checkpoints.
+    """
+    backend = resolve_attention_backend(backend)
+    for module in model.modules():
+        if isinstance(module, (QKVAttention, QKVAttentionLegacy)):
+            module.backend = backend
+    return model
+
+
 class QKVAttentionLegacy(nn.Module):
     """
     A module which performs QKV attention. Matches legacy QKVAttention + input/ouput heads shaping
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="auto"):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = resolve_attention_backend(backend)
 
     def forward(self, qkv):
         """
@@ -471,12 +506,7 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts", q * scale, k * scale
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v)
+        a = qkv_attention(q, k, v, self.backend)
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -489,9 +519,10 @@ class QKVAttention(nn.Module):
     A module which performs QKV attention and splits in a different order.
     """
 
-    def __init__(self, n_heads):
+    def __init__(self, n_heads, backend="auto"):
         super().__init__()
         self.n_heads = n_heads
+        self.backend = resolve_attention_backend(backend)
 
     def forward(self, qkv):
         """
@@ -503,14 +534,12 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
-        scale = 1 / math.sqrt(math.sqrt(ch))
-        weight = th.einsum(
-            "bct,bcs->bts",
-            (q * scale).view(bs * self.n_heads, ch, length),
-            (k * scale).view(bs * self.n_heads, ch, length),
-        )  # More stable with f16 than dividing afterwards
-        weight = th.softmax(weight.float(), dim=-1).type(weight.dtype)
-        a = th.einsum("bts,bcs->bct", weight, v.reshape(bs * self.n_heads, ch, length))
+        a = qkv_attention(
+            q.reshape(bs * self.n_heads, ch, length),
+            k.reshape(bs * self.n_heads, ch, length),
+            v.reshape(bs * self.n_heads, ch, length),
+            self.backend,
+        )
         return a.reshape(bs, -1, length)
 
     @staticmethod
@@ -537,7 +566,8 @@ class UNetModel(nn.Module):
     :param dims: determines if the signal is 1D, 2D, or 3D.
     :param num_classes: if specified (as an int), then this model will be
         class-conditional with `num_classes` classes.
-    :param use_checkpoint: use gradient checkpointing to reduce memory usage.
+    :param use_checkpoint: use gradient checkpointing on every block (same as
+                           checkpoint_policy="all").
     :param num_heads: the number of attention heads in each attention layer.
     :param num_heads_channels: if specified, ignore num_heads and instead use
                                a fixed channel width per attention head.
@@ -547,6 +577,12 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: one of ATTENTION_BACKENDS, see qkv_attention.
+    :param checkpoint_policy: which blocks use gradient checkpointing, one of
+        "none", "attention" (attention blocks only), "resolutions" (every block
+        at a downsample rate in checkpoint_resolutions) or "all".
+    :param checkpoint_resolutions: a collection of downsample rates, used with
+        checkpoint_policy="resolutions" (same convention as attention_resolutions).
     """
 
     def __init__(
@@ -571,11 +607,19 @@ class UNetModel(nn.Module):
         use_scale_shift_norm=False,
         resblock_updown=False,
         use_new_attention_order=False,
+        attention_backend="auto",
+        checkpoint_policy="attention",
+        checkpoint_resolutions=(),
     ):
         super().__init__()
 
         if num_heads_upsample == -1:
             num_heads_upsample = num_heads
+        if use_checkpoint:
+            checkpoint_policy = "all"
+        assert (
+            checkpoint_policy in CHECKPOINT_POLICIES
+        ), f"unsupported checkpoint policy: {checkpoint_policy}"
 
         self.image_size = image_size
         self.in_channels = in_channels
@@ -588,6 +632,8 @@ class UNetModel(nn.Module):
         self.conv_resample = conv_resample
         self.num_classes = num_classes
         self.use_checkpoint = use_checkpoint
+        self.checkpoint_policy = checkpoint_policy
+        self.checkpoint_resolutions = checkpoint_resolutions
         self.dtype = th.float16 if use_fp16 else th.float32
         self.num_heads = num_heads
         self.num_head_channels = num_head_channels
@@ -619,7 +665,7 @@ class UNetModel(nn.Module):
                         dropout,
                         out_channels=int(mult * model_channels),
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
+                        use_checkpoint=self.checkpoint_enabled("resblock", ds),
                         use_scale_shift_norm=use_scale_shift_norm,
                     )
                 ]
@@ -628,10 +674,11 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=self.checkpoint_enabled("attention", ds),
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_backend=attention_backend,
                         )
                     )
                 self.input_blocks.append(TimestepEmbedSequential(*layers))
@@ -647,7 +694,7 @@ class UNetModel(nn.Module):
                             dropout,
                             out_channels=out_ch,
                             dims=dims,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=self.checkpoint_enabled("resblock", ds),
                             use_scale_shift_norm=use_scale_shift_norm,
                             down=True,
                         )
@@ -668,22 +715,23 @@ class UNetModel(nn.Module):
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=self.checkpoint_enabled("resblock", ds),
                 use_scale_shift_norm=use_scale_shift_norm,
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=self.checkpoint_enabled("attention", ds),
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
+                attention_backend=attention_backend,
             ),
             ResBlock(
                 ch,
                 time_embed_dim,
                 dropout,
                 dims=dims,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=self.checkpoint_enabled("resblock", ds),
                 use_scale_shift_norm=use_scale_shift_norm,
             ),
         )
@@ -700,7 +748,7 @@ class UNetModel(nn.Module):
                         dropout,
                         out_channels=int(model_channels * mult),
                         dims=dims,
-                        use_checkpoint=use_checkpoint,
+                        use_checkpoint=self.checkpoint_enabled("resblock", ds),
                         use_scale_shift_norm=use_scale_shift_norm,
                     )
                 ]
@@ -709,10 +757,11 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=self.checkpoint_enabled("attention", ds),
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
+                            attention_backend=attention_backend,
                         )
                     )
                 if level and i == num_res_blocks:
@@ -724,7 +773,7 @@ class UNetModel(nn.Module):
                             dropout,
                             out_channels=out_ch,
                             dims=dims,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=self.checkpoint_enabled("resblock", ds),
                             use_scale_shift_norm=use_scale_shift_norm,
                             up=True,
                         )
@@ -741,6 +790,19 @@ class UNetModel(nn.Module):
             zero_module(conv_nd(dims, input_ch, out_channels, 3, padding=1)),
         )
 
+    def checkpoint_enabled(self, block, ds):
+        """
+        Whether a block of the given kind ("resblock" or "attention") at
+        downsample rate `ds` uses gradient checkpointing under the policy.
+        """
+        if self.checkpoint_policy == "all":
+            return True
+        if self.checkpoint_policy == "attention":
+            return block == "attention"
+        if self.checkpoint_policy == "resolutions":
+            return ds in self.checkpoint_resolutions
+        return False
+
     def forward(self, x, timesteps, y=None):
         """
         Apply the model to an input batch.
@@ -771,12 +833,151 @@ class UNetModel(nn.Module):
         return self.out(h)
 
 
+def expand_channels(v, x):
+    """
+    Broadcast a [C] or [N x C] Tensor of per-channel values against an
+    [N x C x ...] Tensor.
+    """
+    if v.dim() == 1:
+        v = v[None]
+    return v.reshape(*v.shape, *([1] * (x.dim() - 2)))
+
+
+class GroupNormSiLU(nn.Module):
+    """
+    GroupNorm (computed in float32, like GroupNorm32) followed by SiLU. The
+    affine transform can be overridden per sample, which is used to fold a
+    FiLM-like scale/shift into the normalization.
+    """
+
+    def __init__(self, norm):
+        super().__init__()
+        self.num_groups = norm.num_groups
+        self.eps = norm.eps
+        self.weight = norm.weight
+        self.bias = norm.bias
+
+    def forward(self, x, weight=None, bias=None):
+        if weight is None:
+            h = F.group_norm(x.float(), self.num_groups, self.weight, self.bias, self.eps)
+        else:
+            h = F.group_norm(x.float(), self.num_groups, eps=self.eps)
+            h = h * expand_channels(weight, h) + expand_channels(bias, h)
+        return F.silu(h, inplace=True).type(x.dtype)
+
+
+class FrozenResBlock(TimestepBlock):
+    """
+    Inference-only ResBlock with the timestep projection precomputed for every
+    step of a fixed schedule. It is called with a step index instead of an
+    embedding.
+    :param block: the ResBlock to freeze.
+    :param emb_out: an [S x C'] Tensor, output of block.emb_layers for each step.
+    """
+
+    def __init__(self, block, emb_out):
+        super().__init__()
+        self.updown = block.updown
+        self.use_scale_shift_norm = block.use_scale_shift_norm
+        self.in_act = GroupNormSiLU(block.in_layers[0])
+        self.in_conv = block.in_layers[2]
+        self.h_upd, self.x_upd = block.h_upd, block.x_upd
+        self.out_act = GroupNormSiLU(block.out_layers[0])
+        self.out_conv = block.out_layers[-1]
+        self.skip_connection = block.skip_connection
+        if self.use_scale_shift_norm:
+            # norm(h) * (1 + scale) + shift, folded into the GroupNorm affine
+            scale, shift = th.chunk(emb_out, 2, dim=1)
+            weight, bias = block.out_layers[0].weight, block.out_layers[0].bias
+            self.register_buffer("out_weight", weight * (1 + scale))
+            self.register_buffer("out_bias", bias * (1 + scale) + shift)
+        else:
+            self.register_buffer("emb_out", emb_out)
+
+    def forward(self, x, step):
+        h = self.in_act(x)
+        if self.updown:
+            h = self.h_upd(h)
+            x = self.x_upd(x)
+        h = self.in_conv(h)
+        if self.use_scale_shift_norm:
+            h = self.out_act(h, self.out_weight[step], self.out_bias[step])
+        else:
+            h = self.out_act(h + expand_channels(self.emb_out[step], h).type(h.dtype))
+        return self.skip_connection(x) + self.out_conv(h)
+
+
+class FrozenUNet(nn.Module):
+    """
+    An inference-only UNetModel specialized to a fixed sampling schedule.
+    Timestep embeddings and the per-block scale/shift tensors are precomputed,
+    dropout is removed and GroupNorm+SiLU pairs are fused.
+    :param model: a (non class-conditional) UNetModel.
+    :param timesteps: the timesteps of the schedule, indexed by step.
+    """
+
+    takes_step_index = True
+
+    def __init__(self, model, timesteps):
+        super().__init__()
+        assert model.num_classes is None, "cannot freeze a class-conditional model"
+        model = copy.deepcopy(model).eval().requires_grad_(False)
+        timesteps = th.as_tensor(np.asarray(timesteps), dtype=th.int64)
+        device = next(model.parameters()).device
+        with th.no_grad():
+            emb = model.time_embed(
+                timestep_embedding(timesteps.to(device), model.model_channels)
+            )
+            for seq in [*model.input_blocks, model.middle_block, *model.output_blocks]:
+                for i, layer in enumerate(seq):
+                    if isinstance(layer, ResBlock):
+                        seq[i] = FrozenResBlock(layer, layer.emb_layers(emb))
+                    elif isinstance(layer, AttentionBlock):
+                        layer.use_checkpoint = False
+        self.dtype = model.dtype
+        self.input_blocks = model.input_blocks
+        self.middle_block = model.middle_block
+        self.output_blocks = model.output_blocks
+        self.out_act = GroupNormSiLU(model.out[0])
+        self.out_conv = model.out[2]
+        self.register_buffer("timesteps", timesteps.to(device))
+
+    def forward(self, x, step, y=None):
+        """
+        Apply the model to an input batch.
+        :param x: an [N x C x ...] Tensor of inputs.
+        :param step: an int, or an [N] Tensor, of indices into the schedule.
+        :return: an [N x C x ...] Tensor of outputs.
+        """
+        assert y is None, "frozen models are not class-conditional"
+        hs = []
+        h = x.type(self.dtype)
+        for module in self.input_blocks:
+            h = module(h, step)
+            hs.append(h)
+        h = self.middle_block(h, step)
+        for module in self.output_blocks:
+            h = th.cat([h, hs.pop()], dim=1)
+            h = module(h, step)
+        return self.out_conv(self.out_act(h.type(x.dtype)))
+
+
+def freeze_for_inference(model, timesteps):
+    """
+    Return a FrozenUNet for a fixed sampling schedule, see FrozenUNet.
+    """
+    return FrozenUNet(getattr(model, "module", model), timesteps)
+
+
 def UNetBig(
     image_size,
     in_channels=3,
     out_channels=3,
     base_width=192,
     num_classes=None,
+    attention_backend="auto",
+    checkpoint_policy="attention",
+    checkpoint_resolutions=(),
 ):
     if image_size == 128:
         channel_mult = (1, 1, 2, 3, 4)
@@ -786,6 +987,8 @@ def UNetBig(
         channel_mult = (1, 2, 2, 2)
     elif image_size == 28:
         channel_mult = (1, 2, 2, 2)
+    elif image_size == 16:
+        channel_mult = (1, 2, 2)
     else:
         raise ValueError(f"unsupported image size: {image_size}")
 
@@ -815,6 +1018,11 @@ def UNetBig(
         use_scale_shift_norm=True,
         resblock_updown=True,
         use_new_attention_order=True,
+        attention_backend=attention_backend,
+        checkpoint_policy=checkpoint_policy,
+        checkpoint_resolutions=tuple(
+            image_size // int(res) for res in checkpoint_resolutions
+        ),
     )
 
 
@@ -824,6 +1032,9 @@ def UNet(
     out_channels=3,
     base_width=64,
     num_classes=None,
+    attention_backend="auto",
+    checkpoint_policy="attention",
+    checkpoint_resolutions=(),
 ):
     if image_size == 128:
         channel_mult = (1, 1, 2, 3, 4)
@@ -833,6 +1044,8 @@ def UNet(
         channel_mult = (1, 2, 2, 2)
     elif image_size == 28:
         channel_mult = (1, 2, 2, 2)
+    elif image_size == 16:
+        channel_mult = (1, 2, 2)
     else:
         raise ValueError(f"unsupported image size: {image_size}")
 
@@ -862,6 +1075,11 @@ def UNet(
         use_scale_shift_norm=True,
         resblock_updown=True,
         use_new_attention_order=True,
+        attention_backend=attention_backend,
+        checkpoint_policy=checkpoint_policy,
+        checkpoint_resolutions=tuple(
+            image_size // int(res) for res in checkpoint_resolutions
+        ),
     )
 
 
@@ -871,6 +1089,9 @@ def UNetSmall(
     out_channels=3,
     base_width=32,
     num_classes=None,
+    attention_backend="auto",
+    checkpoint_policy="attention",
+    checkpoint_resolutions=(),
 ):
     if image_size == 128:
         channel_mult = (1, 1, 2, 3, 4)
@@ -880,6 +1101,8 @@ def UNetSmall(
         channel_mult = (1, 2, 2, 2)
     elif image_size == 28:
         channel_mult = (1, 2, 2, 2)
+    elif image_size == 16:
+        channel_mult = (1, 2, 2)
     else:
         raise ValueError(f"unsupported image size: {image_size}")
 
@@ -910,4 +1133,9 @@ def UNetSmall(
         use_scale_shift_norm=True,
         resblock_updown=True,
         use_new_attention_order=True,
+        attention_backend=attention_backend,
+        checkpoint_policy=checkpoint_policy,
+        checkpoint_resolutions=tuple(
+            image_size // int(res) for res in checkpoint_resolutions
+        ),
     )